@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+
+## Benchmark of ii_bulk_decoder against decoding each record with ii_decoder,
+## checking that both give exactly the same values
+##
+## Usage : python bench/bench_bulk_decoder.py [--payloads N] [--records-per-payload N]
+
+import os, sys, time, random, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "processor"))
+import ii_decoder, ii_bulk_decoder
+from bench_decoder import make_record
+
+
+def make_payload(i, records_per_payload):
+    records = []
+    for j in range(records_per_payload):
+        record = make_record(i * records_per_payload + j)
+        ## Include some records without a gps fix
+        if random.random() < 0.05:
+            record['Fields'][0]['Lat'] = 0
+        records.append(record)
+    return {"Records" : records}
+
+
+def decode_payload(decoder, records):
+    ## Records without fields are skipped, as ii_bulk_decoder does
+    return [decoder.decode(r) for r in records if 'Fields' in r]
+
+
+def same_value(expected, actual):
+    if expected is None:
+        return actual is None or actual != actual or actual == -1
+    return expected == actual
+
+
+def check_matches(payloads, columns, odometer_offset, machine_hours_offset):
+    decoder = ii_decoder.record_decoder(odometer_offset=odometer_offset, machine_hours_offset=machine_hours_offset)
+
+    i = 0
+    for payload in payloads:
+        for d in decode_payload(decoder, payload['Records']):
+            position = None
+            if columns['position_valid'][i]:
+                position = {'lat' : columns['lat'][i], 'long' : columns['long'][i], 'alt' : columns['alt'][i]}
+
+            checks = [
+                (d.position, position),
+                (d.speed_kmh, columns['speed_kmh'][i]),
+                (d.gps_accuracy_m, columns['gps_accuracy_m'][i]),
+                (d.ignition_on, columns['ignition_on'][i]),
+                (d.batt_voltage, columns['batt_voltage'][i]),
+                (d.sys_voltage, columns['sys_voltage'][i]),
+                (d.device_temp, columns['device_temp'][i]),
+                (d.data_signal_strength, columns['data_signal_strength'][i]),
+                (d.device_odometer, columns['device_odometer'][i]),
+                (d.device_run_hours, columns['device_run_hours'][i]),
+                (d.device_time_utc, columns['device_time_utc'][i]),
+            ]
+            for expected, actual in checks:
+                if not same_value(expected, actual):
+                    raise Exception("Mismatch on record " + str(i) + " : " + str(expected) + " != " + str(actual))
+            i += 1
+
+    if i != len(columns):
+        raise Exception("Record count mismatch : " + str(i) + " != " + str(len(columns)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk decoder benchmark, checked against the per record decoder")
+    parser.add_argument("--payloads", type=int, default=20000)
+    parser.add_argument("--records-per-payload", type=int, default=10)
+    args = parser.parse_args()
+
+    num_payloads = args.payloads
+    records_per_payload = args.records_per_payload
+    num_records = num_payloads * records_per_payload
+
+    random.seed(0)
+    payloads = [make_payload(i, records_per_payload) for i in range(num_payloads)]
+
+    start = time.perf_counter()
+    decoder = ii_decoder.record_decoder(odometer_offset=12.5)
+    for payload in payloads:
+        decode_payload(decoder, payload['Records'])
+    per_record_time = time.perf_counter() - start
+    print("records              : " + str(num_records))
+    print("per record decoder   : %.3f s (%.0f records/s)" % (per_record_time, num_records / per_record_time))
+
+    modes = [False]
+    if ii_bulk_decoder.np is not None:
+        modes.append(True)
+
+    for use_numpy in modes:
+        start = time.perf_counter()
+        columns = ii_bulk_decoder.bulk_decode(payloads, odometer_offset=12.5, use_numpy=use_numpy)
+        bulk_time = time.perf_counter() - start
+
+        check_matches(payloads, columns, 12.5, None)
+
+        name = "bulk (numpy)" if use_numpy else "bulk (array)"
+        print("%-20s : %.3f s (%.0f records/s) - matches per record decoder" % (name, bulk_time, num_records / bulk_time))
+
+
+if __name__ == "__main__":
+    main()
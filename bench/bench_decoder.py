@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+## Benchmark of ii_decoder.record_decoder against the original inline FType loop
+## from target.uplink, on synthetic records shaped like dm_oem_uplink_recv payloads, checking
+## that both give the same values. The decoder is not expected to be faster, see ii_decoder.py
+##
+## Usage : python bench/bench_decoder.py [num_records]
+
+import os, sys, time, random, gc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "processor"))
+import ii_decoder
+
+
+def make_record(i):
+    return {
+        "SeqNo" : i,
+        "Reason" : random.choice([1, 2, 3, 11]),
+        "DateUTC" : "2023-01-01T00:00:00",
+        "Fields" : [
+            {"FType" : 0, "Lat" : -33.8 + i * 1e-5, "Long" : 151.2, "Alt" : 20, "Spd" : random.randint(0, 3000), "PosAcc" : random.randint(1, 40)},
+            {"FType" : 2, "DIn" : random.randint(0, 7), "DOut" : 0, "DevStat" : 0},
+            {"FType" : 6, "AnalogueData" : {"1" : 4012, "2" : 1275, "3" : 2810, "4" : random.randint(0, 31)}},
+            {"FType" : 27, "Odo" : 1234500 + i, "RH" : 360000 + i},
+        ],
+    }
+
+
+def get_agent_settings(agent_settings, filter_key):
+    output = agent_settings['deployment_config']
+    return output.get(filter_key)
+
+
+def legacy_decode(record, agent_settings):
+    ## The per-field loop as it was written in target.uplink, which looked up the
+    ## agent settings offsets for every FType 27 field
+    position = None
+    gps_accuracy_m = None
+    speed_kmh = None
+    ignition_on = None
+    device_run_hours = None
+    device_odometer = None
+    sys_voltage = None
+    batt_voltage = None
+    device_temp = None
+    data_signal_strength = None
+
+    for f in record['Fields']:
+
+        if not 'FType' in f:
+            continue
+
+        if f['FType'] == 0:
+            gps_accuracy_m = 99
+            if f['Lat'] != 0 and f['Long'] != 0:
+                position = {
+                    'lat': f['Lat'],
+                    'long': f['Long'],
+                    'alt': f['Alt'],
+                }
+                speed_kmh = f['Spd'] * ( 3.6 / 100)
+                gps_accuracy_m = f['PosAcc']
+
+        if f['FType'] == 2:
+            ignition_on = (f['DIn'] & 0b001 != 0)
+
+        if f['FType'] == 6:
+            batt_voltage = f['AnalogueData']['1'] / 1000
+            sys_voltage = f['AnalogueData']['2'] / 100
+            device_temp = f['AnalogueData']['3'] / 100
+            data_signal_strength = round( f['AnalogueData']['4'] * (100/31) )
+
+        if f['FType'] == 27:
+            device_odometer = f['Odo'] / 100
+            device_run_hours = f['RH'] / (60 * 60)
+
+            odometer_offset = get_agent_settings(agent_settings, 'ODO_OFFSET')
+            machine_hours_offset = get_agent_settings(agent_settings, 'MACHINE_HOURS_OFFSET')
+
+            if odometer_offset is not None:
+                device_odometer = device_odometer + odometer_offset
+
+            if machine_hours_offset is not None:
+                device_run_hours = device_run_hours + machine_hours_offset
+
+    return (position, gps_accuracy_m, speed_kmh, ignition_on, device_run_hours, device_odometer,
+        sys_voltage, batt_voltage, device_temp, data_signal_strength)
+
+
+def as_tuple(d):
+    return (d.position, d.gps_accuracy_m, d.speed_kmh, d.ignition_on, d.device_run_hours, d.device_odometer,
+        d.sys_voltage, d.batt_voltage, d.device_temp, d.data_signal_strength)
+
+
+def best_time(func, records, repeats=5):
+    best = None
+    for i in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        func(records)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    num_records = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    random.seed(0)
+    records = [make_record(i) for i in range(num_records)]
+
+    agent_settings = {'deployment_config' : {'ODO_OFFSET' : 12.5}}
+    decoder = ii_decoder.record_decoder(odometer_offset=12.5, machine_hours_offset=None)
+
+    ## Check both paths agree before timing them
+    for r in records[:1000]:
+        if legacy_decode(r, agent_settings) != as_tuple(decoder.decode(r)):
+            raise Exception("Decoder output does not match legacy loop for record " + str(r))
+
+    legacy_time = best_time(lambda recs: [legacy_decode(r, agent_settings) for r in recs], records)
+    decoder_time = best_time(lambda recs: [decoder.decode(r) for r in recs], records)
+
+    print("records        : " + str(num_records))
+    print("legacy loop    : %.3f s (%.0f records/s)" % (legacy_time, num_records / legacy_time))
+    print("record_decoder : %.3f s (%.0f records/s)" % (decoder_time, num_records / decoder_time))
+    print("relative cost  : %.2fx the legacy loop" % (decoder_time / legacy_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+
+## Microbenchmark of the JSON work done per publish, for the payload shapes the processor sends
+##
+##   uplink ui_state - building and encoding the ui_state update for one record, as originally
+##                     written and with target.get_ui_state_msg
+##   deploy schema   - encoding the DEPLOY ui_state schema on every deploy, and the cached msg_str
+##   channel details - decoding a channel details response from the API
+##
+## Every available serializer is timed - the stdlib json module, and orjson when installed.
+##
+## Usage : python bench/bench_json.py [iterations]
+
+import os, sys, time, json, gc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "processor"))
+import pydoover as pd
+import ii_decoder
+import ui_schema
+import target
+
+from bench_decoder import make_record
+
+
+def legacy_ui_state_msg(decoded):
+    ## get_ui_state_msg as it was written in target.py - the reason lookup table was rebuilt
+    ## on every call, which copying UPLINK_REASONS stands in for here
+    reasons = dict(target.UPLINK_REASONS)
+    reason = reasons.get(decoded.device_uplink_reason, "Unknown reason")
+
+    if not decoded.ignition_on:
+        status_icon = "off"
+        display_string = "Off"
+    elif decoded.speed_kmh is None or decoded.speed_kmh <= 1:
+        status_icon = "idle"
+        display_string = "Idle"
+    else:
+        status_icon = None
+        display_string = "Running"
+
+    return {
+        "state" : {
+            "displayString" : display_string,
+            "statusIcon" : status_icon,
+            "children" : {
+                "location" : {
+                    "currentValue" : decoded.position,
+                },
+                "speed" : {
+                    "currentValue" : decoded.speed_kmh,
+                },
+                "gpsAccuracy" : {
+                    "currentValue" : decoded.gps_accuracy_m,
+                },
+                "ignitionOn" : {
+                    "currentValue" : decoded.ignition_on,
+                },
+                "deviceRunHours" : {
+                    "currentValue" : decoded.device_run_hours,
+                },
+                "deviceOdometer" : {
+                    "currentValue" : decoded.device_odometer,
+                },
+                "sysVoltage" : {
+                    "currentValue" : decoded.sys_voltage,
+                },
+                "battVoltage" : {
+                    "currentValue" : decoded.batt_voltage,
+                },
+                "dataSignalStrength" : {
+                    "currentValue" : decoded.data_signal_strength,
+                },
+                "deviceTemp" : {
+                    "currentValue" : decoded.device_temp,
+                },
+                "lastUplinkReason" : {
+                    "currentValue" : reason,
+                },
+                "deviceTimeUtc" : {
+                    "currentValue" : decoded.device_time_utc,
+                },
+            }
+        }
+    }
+
+
+def current_ui_state_msg(decoded, t):
+    return t.get_ui_state_msg(decoded)
+
+
+def make_channel_details(num_messages):
+    return {
+        'channel' : "0f4b3a52-8a3c-4d0e-9a43-3c1f2a6f8b10",
+        'owner' : "9843b273-6580-4520-bdb0-0afb7bfec049",
+        'name' : "ui_state",
+        'aggregate' : {'payload' : ui_schema.build_ui_schema()},
+        'messages' : [
+            {'message' : "message-" + str(i), 'agent' : "9843b273-6580-4520-bdb0-0afb7bfec049"}
+            for i in range(num_messages)
+        ],
+    }
+
+
+def best_time(func, iterations, repeats=5):
+    ## Best time per call in microseconds
+    best = None
+    for i in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        for j in range(iterations):
+            func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / iterations * 1e6
+
+
+def get_serializers():
+    serializers = [pd.stdlib_serializer()]
+    if pd.orjson is not None:
+        serializers.append(pd.orjson_serializer())
+    return serializers
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    decoded = ii_decoder.record_decoder().decode(make_record(1))
+    schema = ui_schema.get_ui_schema()
+    details_text = json.dumps(make_channel_details(200))
+    details_bytes = details_text.encode()
+
+    t = target.target(agent_id="bench-agent")
+
+    ## Both builders must produce the same message before they are compared
+    if legacy_ui_state_msg(decoded) != current_ui_state_msg(decoded, t):
+        raise Exception("ui_state message does not match the original message")
+
+    results = []
+    for s in get_serializers():
+        results.append(( "uplink ui_state  original + " + s.name, best_time(lambda: s.dumps(legacy_ui_state_msg(decoded)), iterations) ))
+        results.append(( "uplink ui_state  current  + " + s.name, best_time(lambda: s.dumps(current_ui_state_msg(decoded, t)), iterations) ))
+        results.append(( "deploy schema    build    + " + s.name, best_time(lambda: s.dumps(ui_schema.build_ui_schema()), iterations // 10) ))
+        results.append(( "channel details  loads str  " + s.name, best_time(lambda: s.loads(details_text), iterations // 10) ))
+        results.append(( "channel details  loads bytes " + s.name, best_time(lambda: s.loads(details_bytes), iterations // 10) ))
+
+    results.append(( "deploy schema    cached msg_str", best_time(lambda: ui_schema.get_ui_schema().msg_str, iterations) ))
+
+    print("ui_state msg : " + str(len(pd.dumps(current_ui_state_msg(decoded, t)))) + " bytes")
+    print("deploy schema : " + str(len(schema.msg_str)) + " bytes")
+    print("channel details : " + str(len(details_bytes)) + " bytes")
+    print("")
+    for name, elapsed in results:
+        print("%-42s %10.2f us" % (name, elapsed))
+
+
+if __name__ == "__main__":
+    main()
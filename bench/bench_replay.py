@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+
+## Replays recorded Internet Innovations uplink payloads through target.execute, against the
+## local stand-in Doover API in bench/stub_server.py, for each task config in doover_config.json
+##
+## Reports invocations/sec, p50/p99 latency, HTTP calls per invocation and the kB sent and
+## received on the wire per invocation for every task.
+##
+## Usage : python bench/bench_replay.py [--iterations 200] [--latency-ms 5] [--error-rate 0] [--gzip-min-size 256]
+##             [--payloads bench/payloads/sample_uplinks.jsonl] [--package-config '{"uplink_mode": "batch"}']
+
+import os, sys, json, time, argparse
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.join(bench_dir, "..")
+sys.path.insert(0, os.path.join(repo_dir, "processor"))
+sys.path.insert(0, bench_dir)
+
+import target
+import ii_bulk_decoder
+from stub_server import stub_server, load_deployment_channel_messages
+
+
+AGENT_ID = "9843b273-6580-4520-bdb0-0afb7bfec049"
+
+
+def percentile(values, pct):
+    if len(values) == 0:
+        return 0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def load_tasks(config_path):
+    with open(config_path) as f:
+        config = json.load(f)
+    return config['processor_deployments']['tasks']
+
+
+def make_msg_obj(task, payload, i):
+    ## The message that would have triggered the task, on the task's subscribed channel
+    channel_name = task['subscriptions'][0]['channel_name']
+    return {
+        'message' : "replay-" + str(i),
+        'channel' : channel_name,
+        'payload' : payload,
+    }
+
+
+def get_task_payloads(task, uplink_payloads):
+    message_type = task['task_config'].get('message_type')
+    if message_type == "UPLINK":
+        return uplink_payloads
+    if message_type == "DOWNLINK":
+        return [{'cmds' : {}}]
+    return [{'new_deployment' : True}]
+
+
+def run_task(server, task, payloads, iterations, package_config_overrides):
+
+    package_config = dict(task['task_config'])
+    package_config.update(package_config_overrides)
+
+    server.state.reset_counts()
+    latencies = []
+    errors = 0
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        payload = payloads[i % len(payloads)]
+        t = target.target(
+            agent_id=AGENT_ID,
+            access_token="replay-token",
+            api_endpoint=server.endpoint,
+            package_config=package_config,
+            msg_obj=make_msg_obj(task, payload, i),
+            task_id="replay-task-" + task['name'],
+            log_channel="replay-log-" + task['name'],
+            agent_settings={'deployment_config' : {}},
+        )
+
+        invocation_start = time.perf_counter()
+        failed = False
+        try:
+            t.execute()
+        except Exception:
+            failed = True
+        latencies.append(time.perf_counter() - invocation_start)
+
+        if failed or t.get_log().level_counts.get("ERROR", 0) > 0:
+            errors += 1
+
+    elapsed = time.perf_counter() - start
+
+    return {
+        'task' : task['name'],
+        'invocations' : iterations,
+        'invocations_per_sec' : iterations / elapsed,
+        'p50_ms' : percentile(latencies, 50) * 1000,
+        'p99_ms' : percentile(latencies, 99) * 1000,
+        'http_calls_per_invocation' : server.state.total_requests / iterations,
+        'kb_sent_per_invocation' : server.state.bytes_received / iterations / 1024,
+        'kb_received_per_invocation' : server.state.bytes_sent / iterations / 1024,
+        'invocations_with_errors' : errors,
+        'request_counts' : dict(server.state.request_counts),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay benchmark for the message processor")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--latency-jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--gzip-min-size", type=int, default=256, help="smallest response the stub server gzips, -1 for never")
+    parser.add_argument("--payloads", default=os.path.join(bench_dir, "payloads", "sample_uplinks.jsonl"))
+    parser.add_argument("--config", default=os.path.join(repo_dir, "doover_config.json"))
+    parser.add_argument("--package-config", default="{}", help="json merged into every task_config")
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    args = parser.parse_args()
+
+    uplink_payloads = list(ii_bulk_decoder.iter_payloads_from_file(args.payloads))
+    package_config_overrides = json.loads(args.package_config)
+
+    server = stub_server(
+        latency_ms=args.latency_ms,
+        latency_jitter_ms=args.latency_jitter_ms,
+        error_rate=args.error_rate,
+        gzip_min_size=None if args.gzip_min_size < 0 else args.gzip_min_size,
+    ).start()
+    server.state.deploy_agent(AGENT_ID, load_deployment_channel_messages(args.config))
+
+    results = []
+    try:
+        for task in load_tasks(args.config):
+            payloads = get_task_payloads(task, uplink_payloads)
+            results.append( run_task(server, task, payloads, args.iterations, package_config_overrides) )
+    finally:
+        server.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("%-12s %10s %10s %10s %12s %10s %10s %8s" % ("task", "inv/s", "p50 ms", "p99 ms", "http/inv", "kB up/inv", "kB dn/inv", "errors"))
+    for r in results:
+        print("%-12s %10.1f %10.1f %10.1f %12.2f %10.2f %10.2f %8d" % (
+            r['task'],
+            r['invocations_per_sec'],
+            r['p50_ms'],
+            r['p99_ms'],
+            r['http_calls_per_invocation'],
+            r['kb_sent_per_invocation'],
+            r['kb_received_per_invocation'],
+            r['invocations_with_errors'],
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+## Compares processing a stream of uplinks one target invocation at a time (as the lambda
+## style entry point does) with processor/worker.py pulling the same uplinks from a queue,
+## against the local stand-in Doover API in bench/stub_server.py
+##
+## Usage : python bench/bench_worker.py [--messages 400] [--agents 20] [--latency-ms 5]
+##             [--concurrency 8] [--processes] [--package-config '{"uplink_mode": "batch"}']
+
+import os, sys, json, time, argparse
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, "..", "processor"))
+sys.path.insert(0, bench_dir)
+
+import target
+import worker
+import ii_bulk_decoder
+from stub_server import stub_server, load_deployment_channel_messages
+
+
+def make_messages(payloads, num_messages, num_agents):
+    return [
+        worker.make_uplink_message("bench-agent-" + str(i % num_agents), payloads[i % len(payloads)], i)
+        for i in range(num_messages)
+    ]
+
+
+def run_per_invocation(server, messages, package_config):
+    server.state.reset_counts()
+    errors = 0
+    start = time.perf_counter()
+    for message in messages:
+        t = target.target(
+            agent_id=message['agent_id'],
+            access_token="bench-token",
+            api_endpoint=server.endpoint,
+            package_config=package_config,
+            msg_obj=message['msg_obj'],
+            task_id="bench-task",
+            agent_settings={'deployment_config' : {}},
+        )
+        t.execute()
+        if t.get_log().level_counts.get("ERROR", 0) > 0:
+            errors += 1
+    elapsed = time.perf_counter() - start
+    return len(messages) / elapsed, errors, server.state.total_requests / len(messages)
+
+
+def run_worker(server, messages, package_config, concurrency, use_processes):
+    source = worker.local_queue()
+    for message in messages:
+        source.put(message)
+
+    server.state.reset_counts()
+    w = worker.uplink_worker(
+        source,
+        api_endpoint=server.endpoint,
+        access_token="bench-token",
+        package_config=package_config,
+        concurrency=concurrency,
+        use_processes=use_processes,
+    )
+    stats = w.run(max_messages=len(messages))
+    return stats['messages_per_sec'], stats['errors'], server.state.total_requests / len(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-invocation vs long running worker benchmark")
+    parser.add_argument("--messages", type=int, default=400)
+    parser.add_argument("--agents", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--processes", action="store_true")
+    parser.add_argument("--payloads", default=os.path.join(bench_dir, "payloads", "sample_uplinks.jsonl"))
+    parser.add_argument("--package-config", default="{}", help="json merged into the UPLINK task_config")
+    args = parser.parse_args()
+
+    package_config = {"message_type" : "UPLINK"}
+    package_config.update(json.loads(args.package_config))
+
+    payloads = list(ii_bulk_decoder.iter_payloads_from_file(args.payloads))
+    messages = make_messages(payloads, args.messages, args.agents)
+
+    server = stub_server(latency_ms=args.latency_ms).start()
+    channel_messages = load_deployment_channel_messages(os.path.join(bench_dir, "..", "doover_config.json"))
+    for agent_id in dict.fromkeys(m['agent_id'] for m in messages):
+        server.state.deploy_agent(agent_id, channel_messages)
+    try:
+        results = [
+            ("per invocation", ) + run_per_invocation(server, messages, package_config),
+            ("worker x" + str(args.concurrency), ) + run_worker(server, messages, package_config, args.concurrency, args.processes),
+        ]
+    finally:
+        server.stop()
+
+    print("%-16s %10s %8s %10s" % ("mode", "msg/s", "errors", "http/msg"))
+    for name, rate, errors, http_per_message in results:
+        print("%-16s %10.1f %8d %10.2f" % (name, rate, errors, http_per_message))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+#!/usr/bin/python3
+
+## A local stand-in for the Doover channels API, implementing the /ch/v1/agent/... and
+## /ch/v1/channel/... routes used by pydoover.doover_api_iface
+##
+## Channels are created by the first publish to them, and like Doover a GET of a channel that
+## does not exist returns a 404. Publishes update the channel aggregate (merged
+## like Doover does) and are kept as messages. Latency and error injection can be set
+## when starting the server, and every request is counted so that the number of HTTP
+## calls per invocation can be reported. fail_next makes the next few requests fail, for
+## testing retries deterministically. When valid_tokens is set, requests with any other
+## token get a 401, as an expired token does. New connections are counted too, to check
+## that clients keep their connections alive.
+##
+## Like the Doover API, responses of at least gzip_min_size bytes are gzipped for clients
+## that accept it, and gzipped request bodies are accepted. The bytes sent and received on
+## the wire are counted.
+##
+## Usage : python bench/stub_server.py [--port 8000] [--latency-ms 20] [--error-rate 0.01]
+
+import json, gzip, time, uuid, random, argparse, threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+def merge_aggregate(aggregate, update):
+    if not isinstance(aggregate, dict) or not isinstance(update, dict):
+        return update
+    result = dict(aggregate)
+    for key, value in update.items():
+        if key in result and isinstance(value, dict):
+            result[key] = merge_aggregate(result[key], value)
+        else:
+            result[key] = value
+    return result
+
+
+class stub_state:
+
+    def __init__(self, latency_ms=0, latency_jitter_ms=0, error_rate=0, error_status=503, gzip_min_size=256):
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.gzip_min_size = gzip_min_size
+
+        ## The next fail_count requests fail with fail_status, before any random errors
+        self.fail_count = 0
+        self.fail_status = 503
+
+        ## None accepts any token
+        self.valid_tokens = None
+
+        self.lock = threading.Lock()
+        self.channels = {}          ## channel_id -> channel dict
+        self.channel_names = {}     ## (agent_id, channel_name) -> channel_id
+        self.request_counts = {}    ## (method, route) -> count
+        self.total_requests = 0
+        self.connections = 0        ## TCP connections accepted
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    def reset_counts(self):
+        with self.lock:
+            self.request_counts = {}
+            self.total_requests = 0
+            self.connections = 0
+            self.bytes_received = 0
+            self.bytes_sent = 0
+
+    def count_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def count_bytes(self, received=0, sent=0):
+        with self.lock:
+            self.bytes_received += received
+            self.bytes_sent += sent
+
+    def fail_next(self, count, status=503):
+        with self.lock:
+            self.fail_count = count
+            self.fail_status = status
+
+    def take_failure(self):
+        ## Returns the status to fail this request with, or None
+        with self.lock:
+            if self.fail_count <= 0:
+                return None
+            self.fail_count -= 1
+            return self.fail_status
+
+    def count_request(self, method, route):
+        with self.lock:
+            key = method + " " + route
+            self.request_counts[key] = self.request_counts.get(key, 0) + 1
+            self.total_requests += 1
+
+    def get_channel(self, agent_id=None, channel_name=None, channel_id=None, create=True):
+        with self.lock:
+            if channel_id is None:
+                channel_id = self.channel_names.get((agent_id, channel_name))
+                if channel_id is None:
+                    if not create:
+                        return None
+                    channel_id = str(uuid.uuid4())
+                    self.channel_names[(agent_id, channel_name)] = channel_id
+                    self.channels[channel_id] = {
+                        'channel' : channel_id,
+                        'owner' : agent_id,
+                        'name' : channel_name,
+                        'aggregate' : {'payload' : None},
+                        'messages' : [],
+                    }
+            return self.channels.get(channel_id)
+
+    def publish(self, ch, body):
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = body
+
+        message_id = str(uuid.uuid4())
+        with self.lock:
+            ch['aggregate']['payload'] = merge_aggregate(ch['aggregate']['payload'], payload)
+            ch['messages'].append({
+                'message' : message_id,
+                'agent' : ch['owner'],
+                'payload' : payload,
+                'timestamp' : time.time(),
+            })
+        return message_id
+
+    def deploy_agent(self, agent_id, channel_messages):
+        ## Creates an agent's channels the way a deployment does, by publishing each of the
+        ## deployment_channel_messages from doover_config.json to it
+        for m in channel_messages:
+            ch = self.get_channel(agent_id=agent_id, channel_name=m['channel_name'])
+            self.publish(ch, json.dumps(m.get('channel_message', {})))
+
+
+def load_deployment_channel_messages(config_path):
+    with open(config_path) as f:
+        return json.load(f).get('deployment_channel_messages', [])
+
+
+def make_handler(state):
+
+    class stub_handler(BaseHTTPRequestHandler):
+
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def setup(self):
+            ## One handler is created per connection, which keep-alive requests then share
+            super().setup()
+            state.count_connection()
+
+        def send_body(self, status, body):
+            if not isinstance(body, bytes):
+                body = body.encode()
+
+            compressed = False
+            accept_encoding = self.headers.get("Accept-Encoding", "")
+            if state.gzip_min_size is not None and len(body) >= state.gzip_min_size and "gzip" in accept_encoding:
+                body = gzip.compress(body)
+                compressed = True
+
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            if compressed:
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            state.count_bytes(sent=len(body))
+
+        def read_body(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length) if length > 0 else b""
+            state.count_bytes(received=len(body))
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            return body
+
+        def inject(self, route):
+            ## Simulated latency and errors, applied to every request
+            state.count_request(self.command, route)
+
+            delay = state.latency_ms
+            if state.latency_jitter_ms:
+                delay += random.uniform(0, state.latency_jitter_ms)
+            if delay > 0:
+                time.sleep(delay / 1000)
+
+            if state.valid_tokens is not None:
+                auth = self.headers.get("Authorization", "")
+                if not auth.startswith("Token ") or auth[len("Token "):] not in state.valid_tokens:
+                    self.send_body(401, json.dumps({'error' : 'invalid token'}))
+                    return True
+
+            fail_status = state.take_failure()
+            if fail_status is not None:
+                self.send_body(fail_status, json.dumps({'error' : 'injected error'}))
+                return True
+
+            if state.error_rate and random.random() < state.error_rate:
+                self.send_body(state.error_status, json.dumps({'error' : 'injected error'}))
+                return True
+            return False
+
+        def route(self, create=False):
+            ## Returns (route name, channel dict or agent id, remaining path parts)
+            ## The channel is None when it does not exist, unless create is set
+            parsed = urlparse(self.path)
+            parts = [p for p in parsed.path.split("/") if p]
+            self.query = parse_qs(parsed.query)
+
+            if len(parts) < 3 or parts[0] != "ch" or parts[1] != "v1":
+                return "unknown", None, []
+
+            if parts[2] == "agent" and len(parts) == 4:
+                return "agent", parts[3], []
+
+            if parts[2] == "agent" and len(parts) >= 5:
+                ch = state.get_channel(agent_id=parts[3], channel_name=parts[4], create=create)
+                return "channel", ch, parts[5:]
+
+            if parts[2] == "channel" and len(parts) >= 4:
+                ch = state.get_channel(channel_id=parts[3])
+                if ch is None and create:
+                    ## Unknown ids are treated as free standing channels e.g. task log channels
+                    with state.lock:
+                        ch = {
+                            'channel' : parts[3],
+                            'owner' : None,
+                            'name' : parts[3],
+                            'aggregate' : {'payload' : None},
+                            'messages' : [],
+                        }
+                        state.channels[parts[3]] = ch
+                return "channel", ch, parts[4:]
+
+            return "unknown", None, []
+
+        def do_GET(self):
+            route, target, rest = self.route()
+            route_name = route + ("/" + rest[0] if len(rest) > 0 else "")
+            if self.inject(route_name):
+                return
+
+            if route == "agent":
+                with state.lock:
+                    channels = [
+                        {'channel' : c['channel'], 'agent' : c['owner'], 'name' : c['name']}
+                        for c in state.channels.values() if c['owner'] == target
+                    ]
+                return self.send_body(200, json.dumps({'agent' : target, 'channels' : channels}))
+
+            if route == "channel" and target is None:
+                return self.send_body(404, json.dumps({'error' : 'channel not found'}))
+
+            if route == "channel" and len(rest) == 0:
+                details = {k : v for k, v in target.items() if k != 'messages'}
+                return self.send_body(200, json.dumps(details))
+
+            if route == "channel" and rest[0] == "messages":
+                messages = target['messages']
+                if 'ids' in self.query:
+                    ids = set(self.query['ids'][0].split(","))
+                    result = [m for m in messages if m['message'] in ids]
+                else:
+                    result = [{'message' : m['message'], 'agent' : m['agent']} for m in messages]
+                    if 'limit' in self.query:
+                        limit = int(self.query['limit'][0])
+                        page = int(self.query.get('page', ['1'])[0])
+                        result = result[(page - 1) * limit : page * limit]
+                return self.send_body(200, json.dumps({'messages' : result}))
+
+            if route == "channel" and rest[0] == "message" and len(rest) > 1:
+                for m in target['messages']:
+                    if m['message'] == rest[1]:
+                        return self.send_body(200, json.dumps(m))
+                return self.send_body(404, json.dumps({'error' : 'message not found'}))
+
+            self.send_body(404, json.dumps({'error' : 'unknown route'}))
+
+        def do_POST(self):
+            body = self.read_body()
+            route, target, rest = self.route(create=True)
+            if self.inject(route):
+                return
+
+            if route == "channel" and len(rest) == 0:
+                return self.send_body(200, state.publish(target, body))
+
+            self.send_body(404, json.dumps({'error' : 'unknown route'}))
+
+    return stub_handler
+
+
+class stub_server:
+
+    def __init__(self, host="127.0.0.1", port=0, **kwargs):
+        self.state = stub_state(**kwargs)
+        self.httpd = ThreadingHTTPServer((host, port), make_handler(self.state))
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://" + host + ":" + str(port)
+
+    def start(self):
+        ## A short poll interval so that stop() returns quickly, as tests start a server each
+        self.thread = threading.Thread(target=self.httpd.serve_forever, kwargs={'poll_interval' : 0.05}, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in Doover API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--latency-jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--gzip-min-size", type=int, default=256, help="-1 to never compress responses")
+    args = parser.parse_args()
+
+    server = stub_server(
+        host=args.host,
+        port=args.port,
+        latency_ms=args.latency_ms,
+        latency_jitter_ms=args.latency_jitter_ms,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        gzip_min_size=None if args.gzip_min_size < 0 else args.gzip_min_size,
+    )
+    print("Stub Doover API listening on " + server.endpoint)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+
+## Fleet deploy
+
+## Runs the DEPLOY path of target.py across a list of agents, rather than triggering it once
+## per agent through the deployments channel. Agents are deployed on a bounded thread pool
+## sharing one pooled doover_iface, and every request is held to an optional rate limit so a
+## large rollout does not trip the API's rate limits. The ui_state schema is built and
+## serialised once, before any agent is deployed.
+##
+## The report has, for each agent, its status - "deployed", "unchanged" (the schema was
+## already deployed, so only the reprocess trigger was sent) or "failed" - with the latency,
+## HTTP request count and first error.
+##
+## Usage :
+##   python processor/fleet_deploy.py --agents agents.txt --endpoint https://my.doover.com --token <token>
+##       [--concurrency 8] [--requests-per-s 20] [--force] [--report report.json]
+##
+## agents.txt has one agent id per line. A report written with --report can be passed back
+## with --retry-failed to deploy only the agents that failed.
+
+import os, sys, json, time, argparse, traceback
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pydoover as pd
+import target
+import ui_schema
+
+
+def percentile(values, pct):
+    if len(values) == 0:
+        return 0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class fleet_deploy:
+
+    def __init__(
+            self,
+            agent_ids,
+            api_endpoint,
+            access_token,
+            access_token_expiry=None,
+            token_refresh_callback=None,
+            package_config=None,
+            deployment_configs=None,
+            concurrency=8,
+            requests_per_s=None,
+            burst=None,
+            client_options=None,
+        ):
+
+        ## Agents listed more than once are only deployed once
+        self.agent_ids = list(dict.fromkeys(str(a) for a in agent_ids))
+        self.api_endpoint = api_endpoint
+        self.concurrency = concurrency
+
+        self.package_config = {"message_type" : "DEPLOY"}
+        self.package_config.update(package_config or {})
+
+        ## An optional dict of agent_id -> deployment_config
+        self.deployment_configs = deployment_configs or {}
+
+        limiter = None
+        if requests_per_s:
+            limiter = pd.rate_limiter(requests_per_s, burst=burst)
+
+        client_options = dict(client_options or {})
+        client_options.setdefault('pool_size', max(10, concurrency))
+
+        self.cli = pd.doover_iface(
+            access_token=access_token,
+            endpoint=api_endpoint,
+            access_token_expiry=access_token_expiry,
+            token_refresh_callback=token_refresh_callback,
+            rate_limiter=limiter,
+            **client_options
+        )
+
+    def deploy_agent(self, agent_id):
+        start = time.perf_counter()
+        result = {
+            'agent_id' : agent_id,
+            'status' : "failed",
+            'latency_ms' : None,
+            'http_requests' : 0,
+            'error' : None,
+        }
+
+        try:
+            t = target.target(
+                agent_id=agent_id,
+                access_token=self.cli.access_token,
+                api_endpoint=self.api_endpoint,
+                package_config=self.package_config,
+                msg_obj={
+                    'message' : None,
+                    'channel' : "deployments",
+                    'payload' : {'new_deployment' : True},
+                },
+                task_id="fleet-deploy",
+                agent_settings={'deployment_config' : self.deployment_configs.get(agent_id, {})},
+                doover_client=self.cli,
+            )
+            t.execute()
+
+            log = t.get_log()
+            if log.level_counts.get("ERROR", 0) > 0:
+                result['error'] = log.first_error
+            else:
+                result['status'] = getattr(t, 'deploy_status', "failed")
+
+            result['http_requests'] = t.get_metrics().get_summary()['http']['requests']
+
+        except Exception as e:
+            result['error'] = str(e)
+            traceback.print_exc()
+
+        result['latency_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        return result
+
+    def run(self, progress_callback=None):
+        ## Returns the report, calling progress_callback with each agent's result as it finishes
+
+        ## Build and serialise the schema once up front, rather than in the first deploys
+        schema = ui_schema.get_ui_schema()
+
+        start = time.time()
+        results = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency), thread_name_prefix="fleet-deploy") as executor:
+            futures = [executor.submit(self.deploy_agent, agent_id) for agent_id in self.agent_ids]
+            for f in as_completed(futures):
+                result = f.result()
+                results[result['agent_id']] = result
+                if progress_callback is not None:
+                    progress_callback(result)
+
+        ## The report lists agents in the order given
+        results = [results[agent_id] for agent_id in self.agent_ids]
+
+        self.cli.flush_publishes()
+
+        return self.get_report(results, schema.schema_hash, time.time() - start)
+
+    def get_report(self, results, schema_hash, elapsed):
+        counts = {}
+        for r in results:
+            counts[r['status']] = counts.get(r['status'], 0) + 1
+
+        latencies = [r['latency_ms'] for r in results]
+        return {
+            'schema_hash' : schema_hash,
+            'agents' : len(results),
+            'status_counts' : counts,
+            'elapsed_s' : round(elapsed, 3),
+            'agents_per_sec' : round(len(results) / elapsed, 2) if elapsed > 0 else 0,
+            'p50_ms' : percentile(latencies, 50),
+            'p99_ms' : percentile(latencies, 99),
+            'http_requests' : sum(r['http_requests'] for r in results),
+            'results' : results,
+        }
+
+
+def load_agent_ids(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+
+
+def load_failed_agent_ids(report_path):
+    with open(report_path) as f:
+        report = json.load(f)
+    return [r['agent_id'] for r in report['results'] if r['status'] == "failed"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deploy the ui_state schema to a fleet of agents")
+    parser.add_argument("--agents", default=None, help="file of agent ids, one per line")
+    parser.add_argument("--retry-failed", default=None, help="deploy the failed agents from an earlier report")
+    parser.add_argument("--endpoint", default="https://my.doover.dev")
+    parser.add_argument("--token", default=os.environ.get('DOOVER_ACCESS_TOKEN'))
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests-per-s", type=float, default=None)
+    parser.add_argument("--burst", type=float, default=None)
+    parser.add_argument("--force", action="store_true", help="publish the schema even where it is already deployed")
+    parser.add_argument("--package-config", default="{}", help="json merged into the DEPLOY task config")
+    parser.add_argument("--report", default=None, help="write the full report to this file")
+    args = parser.parse_args()
+
+    if args.retry_failed is not None:
+        agent_ids = load_failed_agent_ids(args.retry_failed)
+    elif args.agents is not None:
+        agent_ids = load_agent_ids(args.agents)
+    else:
+        parser.error("one of --agents or --retry-failed is required")
+
+    package_config = json.loads(args.package_config)
+    if args.force:
+        package_config['deploy_force'] = True
+
+    deploy = fleet_deploy(
+        agent_ids,
+        api_endpoint=args.endpoint,
+        access_token=args.token,
+        package_config=package_config,
+        concurrency=args.concurrency,
+        requests_per_s=args.requests_per_s,
+        burst=args.burst,
+    )
+
+    def print_result(result):
+        line = "%-40s %-10s %10.1f ms" % (result['agent_id'], result['status'], result['latency_ms'])
+        if result['error'] is not None:
+            line += "  " + result['error'][:200]
+        print(line)
+
+    report = deploy.run(progress_callback=print_result)
+
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+    summary = {k : v for k, v in report.items() if k != 'results'}
+    print(json.dumps(summary, indent=2))
+
+    if report['status_counts'].get("failed", 0) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
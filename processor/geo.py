@@ -0,0 +1,40 @@
+#!/usr/bin/python3
+
+## Small helpers shared by the uplink processing stages - distances between positions,
+## and record timestamps
+
+import math
+from datetime import datetime, timezone
+
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def distance_m(lat_1, long_1, lat_2, long_2):
+    ## Great circle (haversine) distance in metres between two lat/long points
+    phi_1 = math.radians(lat_1)
+    phi_2 = math.radians(lat_2)
+    d_phi = phi_2 - phi_1
+    d_lambda = math.radians(long_2 - long_1)
+
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi_1) * math.cos(phi_2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def position_distance_m(position_1, position_2):
+    ## Distance between two position dicts as built by ii_decoder e.g. {'lat' : .., 'long' : .., 'alt' : ..}
+    return distance_m(position_1['lat'], position_1['long'], position_2['lat'], position_2['long'])
+
+
+def parse_timestamp(value):
+    ## DateUTC is sent as e.g. "2023-01-01 00:00:00", returns seconds since the epoch or None
+    ## Times without an offset are UTC, whatever the local timezone of the container
+    if value is None:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
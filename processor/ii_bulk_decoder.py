@@ -0,0 +1,242 @@
+#!/usr/bin/python3
+
+## Offline bulk decoder for historical ii_oem_uplink_recv payloads
+
+## Records are first unpacked into flat rows of raw values, and then all the scaling done by
+## ii_decoder is applied to whole columns at once, with NumPy.
+##
+## Without NumPy the scaling can run over stdlib arrays as plain loops (use_numpy=False), but
+## that is slower than decoding each record with ii_decoder.record_decoder, so it is never
+## picked automatically and is kept for checking the numpy path.
+##
+## Missing values are NaN in float columns, and -1 in ignition_on.
+## Scaled values match ii_decoder.record_decoder exactly, see bench/bench_bulk_decoder.py
+
+import json
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+NAN = float('nan')
+
+## Same expressions as ii_decoder, so both paths round identically
+SPEED_SCALE = ( 3.6 / 100)
+SIGNAL_SCALE = (100/31)
+RUN_HOURS_SCALE = (60 * 60)
+
+RAW_COLUMNS = (
+    'reason',
+    'seq_no',
+    'lat',
+    'long',
+    'alt',
+    'spd',
+    'pos_acc',
+    'din',
+    'analogue_1',
+    'analogue_2',
+    'analogue_3',
+    'analogue_4',
+    'odo',
+    'rh',
+)
+
+
+class columnar_records:
+
+    def __init__(self, columns, device_time_utc, use_numpy):
+        self.columns = columns
+        self.device_time_utc = device_time_utc
+        self.use_numpy = use_numpy
+
+    def __len__(self):
+        return len(self.device_time_utc)
+
+    def __getitem__(self, key):
+        if key == 'device_time_utc':
+            return self.device_time_utc
+        return self.columns[key]
+
+    def keys(self):
+        return ['device_time_utc'] + list(self.columns.keys())
+
+
+def extract_raw_rows(payloads):
+
+    ## A flat list holding one row of RAW_COLUMNS per record
+    rows = []
+    device_time_utc = []
+
+    add_row = rows.extend
+    add_date = device_time_utc.append
+
+    for payload in payloads:
+        if payload is None or not 'Records' in payload:
+            continue
+
+        for record in payload['Records']:
+            if not 'Fields' in record:
+                continue
+
+            ## Later fields of the same FType override earlier ones, as in ii_decoder
+            lat = long = alt = spd = pos_acc = NAN
+            din = an_1 = an_2 = an_3 = an_4 = odo = rh = NAN
+
+            for f in record['Fields']:
+                ftype = f.get('FType')
+
+                if ftype == 0:
+                    pos_acc = 99
+                    if f['Lat'] != 0 and f['Long'] != 0:
+                        lat = f['Lat']
+                        long = f['Long']
+                        alt = f['Alt']
+                        spd = f['Spd']
+                        pos_acc = f['PosAcc']
+
+                elif ftype == 2:
+                    din = f['DIn']
+
+                elif ftype == 6:
+                    analogue_data = f['AnalogueData']
+                    an_1 = analogue_data['1']
+                    an_2 = analogue_data['2']
+                    an_3 = analogue_data['3']
+                    an_4 = analogue_data['4']
+
+                elif ftype == 27:
+                    odo = f['Odo']
+                    rh = f['RH']
+
+            ## A SeqNo sent as null is missing too, while 0 is a real sequence number
+            seq_no = record.get('SeqNo')
+            if seq_no is None:
+                seq_no = -1
+
+            add_row((
+                record['Reason'], seq_no,
+                lat, long, alt, spd, pos_acc,
+                din, an_1, an_2, an_3, an_4,
+                odo, rh,
+            ))
+            add_date(record['DateUTC'])
+
+    ## Converting the flat list in one go is much cheaper than building the array per record
+    return array('d', rows), device_time_utc
+
+
+def scale_numpy(rows, odometer_offset, machine_hours_offset):
+
+    ## Wraps the array buffer directly rather than copying it
+    table = np.frombuffer(rows, dtype=np.float64).reshape(-1, len(RAW_COLUMNS))
+
+    col = {}
+    for i, key in enumerate(RAW_COLUMNS):
+        col[key] = table[:, i]
+    col['reason'] = col['reason'].astype(np.int64)
+    col['seq_no'] = col['seq_no'].astype(np.int64)
+
+    din = col['din']
+    ignition_on = np.full(len(din), -1, dtype=np.int8)
+    has_din = ~np.isnan(din)
+    ignition_on[has_din] = (din[has_din].astype(np.int64) & 0b001 != 0)
+
+    device_odometer = col['odo'] / 100
+    if odometer_offset is not None:
+        device_odometer = device_odometer + odometer_offset
+
+    device_run_hours = col['rh'] / RUN_HOURS_SCALE
+    if machine_hours_offset is not None:
+        device_run_hours = device_run_hours + machine_hours_offset
+
+    return {
+        'reason' : col['reason'],
+        'seq_no' : col['seq_no'],
+        'lat' : col['lat'],
+        'long' : col['long'],
+        'alt' : col['alt'],
+        'position_valid' : ~np.isnan(col['lat']),
+        'speed_kmh' : col['spd'] * SPEED_SCALE,
+        'gps_accuracy_m' : col['pos_acc'],
+        'din' : din,
+        'ignition_on' : ignition_on,
+        'batt_voltage' : col['analogue_1'] / 1000,
+        'sys_voltage' : col['analogue_2'] / 100,
+        'device_temp' : col['analogue_3'] / 100,
+        ## np.round rounds half to even, the same as python's round()
+        'data_signal_strength' : np.round(col['analogue_4'] * SIGNAL_SCALE),
+        'device_odometer' : device_odometer,
+        'device_run_hours' : device_run_hours,
+    }
+
+
+def scale_array(rows, odometer_offset, machine_hours_offset):
+
+    raw = {}
+    width = len(RAW_COLUMNS)
+    for i, key in enumerate(RAW_COLUMNS):
+        raw[key] = rows[i::width]
+
+    def scaled(values, func):
+        return array('d', [NAN if v != v else func(v) for v in values])
+
+    odometer_offset = odometer_offset or 0
+    machine_hours_offset = machine_hours_offset or 0
+
+    return {
+        'reason' : array('q', [int(v) for v in raw['reason']]),
+        'seq_no' : array('q', [int(v) for v in raw['seq_no']]),
+        'lat' : raw['lat'],
+        'long' : raw['long'],
+        'alt' : raw['alt'],
+        'position_valid' : array('b', [v == v for v in raw['lat']]),
+        'speed_kmh' : scaled(raw['spd'], lambda v: v * SPEED_SCALE),
+        'gps_accuracy_m' : raw['pos_acc'],
+        'din' : raw['din'],
+        'ignition_on' : array('b', [-1 if v != v else (int(v) & 0b001 != 0) for v in raw['din']]),
+        'batt_voltage' : scaled(raw['analogue_1'], lambda v: v / 1000),
+        'sys_voltage' : scaled(raw['analogue_2'], lambda v: v / 100),
+        'device_temp' : scaled(raw['analogue_3'], lambda v: v / 100),
+        'data_signal_strength' : scaled(raw['analogue_4'], lambda v: round(v * SIGNAL_SCALE)),
+        'device_odometer' : scaled(raw['odo'], lambda v: v / 100 + odometer_offset),
+        'device_run_hours' : scaled(raw['rh'], lambda v: v / RUN_HOURS_SCALE + machine_hours_offset),
+    }
+
+
+def bulk_decode(payloads, odometer_offset=None, machine_hours_offset=None, use_numpy=None):
+
+    if use_numpy is None:
+        if np is None:
+            raise Exception("NumPy is not installed - decode per record with ii_decoder.record_decoder, or pass use_numpy=False for the slower array path")
+        use_numpy = True
+    elif use_numpy and np is None:
+        raise Exception("NumPy is not installed - use_numpy must be False")
+
+    rows, device_time_utc = extract_raw_rows(payloads)
+
+    if use_numpy:
+        columns = scale_numpy(rows, odometer_offset, machine_hours_offset)
+    else:
+        columns = scale_array(rows, odometer_offset, machine_hours_offset)
+
+    return columnar_records(columns, device_time_utc, use_numpy)
+
+
+def iter_payloads_from_file(path):
+    ## Reads a file of json payloads - either one per line, or a single json list
+    with open(path) as f:
+        first_char = f.read(1)
+        f.seek(0)
+        if first_char == '[':
+            for payload in json.load(f):
+                yield payload
+            return
+
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
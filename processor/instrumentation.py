@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+## Per-invocation timing and HTTP accounting
+
+## An invocation_metrics object times named phases of an invocation, and counts the HTTP
+## requests made through pydoover per endpoint (requests, bytes sent and received, status
+## codes and time spent). get_summary() returns a single json-serialisable record, and
+## emit() passes that record to every registered metrics hook e.g.
+##
+##   import instrumentation
+##   instrumentation.add_metrics_hook(lambda summary: statsd_client.send(summary))
+
+import time, threading
+from contextlib import contextmanager
+
+
+_metrics_hooks = []
+
+
+def add_metrics_hook(hook):
+    if hook not in _metrics_hooks:
+        _metrics_hooks.append(hook)
+    return hook
+
+
+def remove_metrics_hook(hook):
+    if hook in _metrics_hooks:
+        _metrics_hooks.remove(hook)
+
+
+def normalise_endpoint(method, url):
+    ## Replaces ids in a Doover API path so requests group by route e.g.
+    ## /ch/v1/agent/<uuid>/ui_state/ -> /ch/v1/agent/{agent_id}/ui_state/
+    path = url.split("?")[0]
+    parts = path.split("/")
+    for i, part in enumerate(parts):
+        if i == 0:
+            continue
+        previous = parts[i - 1]
+        if previous == "agent" and part:
+            parts[i] = "{agent_id}"
+        elif previous == "channel" and part:
+            parts[i] = "{channel_id}"
+        elif previous == "message" and part:
+            parts[i] = "{message_id}"
+    return method + " " + "/".join(parts)
+
+
+class invocation_metrics:
+
+    def __init__(self, **labels):
+        ## labels are included in the summary as-is e.g. task_id, agent_id, message_type
+        self.labels = labels
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+        self.phases = {}
+        self.endpoints = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase_time(name, time.perf_counter() - start)
+
+    def add_phase_time(self, name, elapsed):
+        with self.lock:
+            phase = self.phases.get(name)
+            if phase is None:
+                phase = {'count' : 0, 'total_s' : 0.0}
+                self.phases[name] = phase
+            phase['count'] += 1
+            phase['total_s'] += elapsed
+
+    def record_request(self, method, url, status_code, bytes_sent, bytes_received, elapsed):
+        key = normalise_endpoint(method, url)
+        with self.lock:
+            endpoint = self.endpoints.get(key)
+            if endpoint is None:
+                endpoint = {
+                    'requests' : 0,
+                    'bytes_sent' : 0,
+                    'bytes_received' : 0,
+                    'total_s' : 0.0,
+                    'status_codes' : {},
+                }
+                self.endpoints[key] = endpoint
+            endpoint['requests'] += 1
+            endpoint['bytes_sent'] += bytes_sent
+            endpoint['bytes_received'] += bytes_received
+            endpoint['total_s'] += elapsed
+            status = str(status_code)
+            endpoint['status_codes'][status] = endpoint['status_codes'].get(status, 0) + 1
+
+    def get_summary(self):
+        with self.lock:
+            phases = {}
+            for name, phase in self.phases.items():
+                phases[name] = {'count' : phase['count'], 'total_ms' : round(phase['total_s'] * 1000, 2)}
+
+            endpoints = {}
+            totals = {'requests' : 0, 'bytes_sent' : 0, 'bytes_received' : 0}
+            for key, endpoint in self.endpoints.items():
+                endpoints[key] = {
+                    'requests' : endpoint['requests'],
+                    'bytes_sent' : endpoint['bytes_sent'],
+                    'bytes_received' : endpoint['bytes_received'],
+                    'total_ms' : round(endpoint['total_s'] * 1000, 2),
+                    'status_codes' : dict(endpoint['status_codes']),
+                }
+                for total_key in totals:
+                    totals[total_key] += endpoint[total_key]
+
+        summary = dict(self.labels)
+        summary['start_time'] = self.start_time
+        summary['duration_ms'] = round((time.time() - self.start_time) * 1000, 2)
+        summary['phases'] = phases
+        summary['http'] = totals
+        summary['endpoints'] = endpoints
+        return summary
+
+    def emit(self):
+        summary = self.get_summary()
+        for hook in list(_metrics_hooks):
+            try:
+                hook(summary)
+            except Exception as e:
+                print("Metrics hook failed : " + str(e))
+        return summary
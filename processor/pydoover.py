@@ -1,6 +1,469 @@
 #!/usr/bin/python3
 
-import os, json, requests, time, base64, shutil
+import os, json, gzip, requests, time, base64, shutil, threading, asyncio, random, atexit
+import http.cookiejar
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError, ConnectTimeoutError
+
+## aiohttp is optional - without it the async client runs the pooled requests
+## session on a thread pool, which still keeps the event loop free
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+## orjson is optional - when installed it is used to encode publishes and decode responses
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+## Invocations seen by this process, used to report cold and warm starts
+## These live here rather than in target.py, as the platform may re-execute target.py for each
+## invocation, while imported modules like this one stay in sys.modules for the process
+_process_loaded_at = time.time()
+_invocation_count = 0
+_invocation_count_lock = threading.Lock()
+
+
+def count_invocation():
+    ## Returns this invocation's number in the process, starting at 1, and when the process loaded pydoover
+    global _invocation_count
+    with _invocation_count_lock:
+        _invocation_count += 1
+        return _invocation_count, _process_loaded_at
+
+
+## Pooled HTTP sessions are kept at module level so that they are shared by every
+## doover_api_iface pointing at the same endpoint, and survive warm lambda reuse
+_session_pool = {}
+_session_pool_lock = threading.Lock()
+
+
+def get_pooled_session(
+        endpoint,
+        pool_size=10,
+        keep_alive=True,
+    ):
+
+    key = (endpoint, pool_size, keep_alive)
+
+    with _session_pool_lock:
+        if key in _session_pool:
+            return _session_pool[key]
+
+        ## Transport level retries are off - doover_api_iface retries requests itself, so that
+        ## every attempt goes through its jittered backoff, circuit breaker and request accounting
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=0,
+        )
+
+        session = requests.Session()
+        ## The session is shared between agents and tokens, so it never keeps cookies
+        session.cookies.set_policy( http.cookiejar.DefaultCookiePolicy(allowed_domains=[]) )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if not keep_alive:
+            session.headers["Connection"] = "close"
+
+        _session_pool[key] = session
+        return session
+
+
+def close_pooled_sessions():
+    with _session_pool_lock:
+        for session in _session_pool.values():
+            session.close()
+        _session_pool.clear()
+
+
+## aiohttp sessions are bound to the event loop they were created on, so they are pooled per loop
+## as well as per endpoint. target.py runs the async client on one event loop per thread (see
+## get_thread_event_loop), so warm invocations reuse the session and its open connections.
+_aiohttp_session_pool = {}
+_aiohttp_session_pool_lock = threading.Lock()
+
+
+def get_pooled_aiohttp_session(
+        endpoint,
+        pool_size=10,
+        keep_alive=True,
+        verify=True,
+    ):
+
+    loop = asyncio.get_running_loop()
+    key = (loop, endpoint, pool_size, keep_alive, verify)
+
+    with _aiohttp_session_pool_lock:
+        ## The sessions of a loop that has since been closed can never be used again
+        for k in [k for k in _aiohttp_session_pool if k[0].is_closed()]:
+            del _aiohttp_session_pool[k]
+
+        session = _aiohttp_session_pool.get(key)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=pool_size,
+                force_close=not keep_alive,
+                ssl=None if verify else False,
+            )
+            session = aiohttp.ClientSession(connector=connector)
+            _aiohttp_session_pool[key] = session
+        return session
+
+
+def take_pooled_aiohttp_sessions(loop=None, endpoint=None):
+    ## Removes and returns the pooled (loop, session) pairs, only those matching loop and endpoint if given
+    with _aiohttp_session_pool_lock:
+        result = []
+        for key in list(_aiohttp_session_pool.keys()):
+            if loop is not None and key[0] is not loop:
+                continue
+            if endpoint is not None and key[1] != endpoint:
+                continue
+            result.append(( key[0], _aiohttp_session_pool.pop(key) ))
+        return result
+
+
+def close_pooled_aiohttp_sessions():
+    ## Called at process exit, once no event loop is running the sessions
+    for loop, session in take_pooled_aiohttp_sessions():
+        if session.closed or loop.is_closed() or loop.is_running():
+            continue
+        try:
+            loop.run_until_complete(session.close())
+        except Exception:
+            pass
+
+
+atexit.register(close_pooled_aiohttp_sessions)
+
+
+## Pluggable JSON serializer used for request and response bodies
+## Any object with dumps(obj) -> str and loads(str or bytes) -> obj can be set with set_serializer
+class stdlib_serializer:
+
+    name = "json"
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class orjson_serializer:
+
+    name = "orjson"
+
+    def dumps(self, obj):
+        ## orjson writes compact json, and NaN / Infinity as null
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+def get_named_serializer(name):
+    ## orjson falls back to the stdlib serializer when it is not installed
+    if name == "orjson" and orjson is not None:
+        return orjson_serializer()
+    return stdlib_serializer()
+
+
+def get_default_serializer():
+    ## PYDOOVER_JSON=json forces the stdlib serializer even when orjson is installed
+    if os.environ.get('PYDOOVER_JSON') == 'json':
+        return stdlib_serializer()
+    return get_named_serializer("orjson")
+
+
+_serializer = get_default_serializer()
+
+
+def get_serializer():
+    return _serializer
+
+
+def set_serializer(serializer):
+    ## serializer is either a serializer object, or the name of a built in one ("json" or "orjson")
+    global _serializer
+    if isinstance(serializer, str):
+        serializer = get_named_serializer(serializer)
+    _serializer = serializer
+
+
+def dumps(obj):
+    return _serializer.dumps(obj)
+
+
+def loads(data):
+    return _serializer.loads(data)
+
+
+## Raised when a Doover API request fails, rather than returning None
+## status_code is None when no response was received e.g. a timeout or connection error
+## request_sent is False only when the request is known to have never reached the server
+class doover_api_error(Exception):
+
+    def __init__(self, message, method=None, url=None, status_code=None, body=None, request_sent=True):
+        super().__init__(message)
+        self.method = method
+        self.url = url
+        self.status_code = status_code
+        self.body = body
+        self.request_sent = request_sent
+
+
+## Raised without making a request while the endpoint's circuit breaker is open
+class circuit_open_error(doover_api_error):
+
+    def __init__(self, message, method=None, url=None):
+        super().__init__(message, method=method, url=url, request_sent=False)
+
+
+def is_connect_error(e):
+    ## Errors raised while connecting, before any of the request was sent
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if aiohttp is not None and isinstance(e, aiohttp.ClientConnectorError):
+        return True
+    if isinstance(e, requests.ConnectionError) and len(e.args) > 0:
+        return isinstance(getattr(e.args[0], 'reason', None), (NewConnectionError, ConnectTimeoutError))
+    return False
+
+
+def is_unsent_error(e):
+    return isinstance(e, doover_api_error) and not e.request_sent
+
+
+## A cached channel id only falls back to addressing the channel by name when the id no
+## longer exists. Any other error may have reached the server, so a publish is never resent.
+MISSING_CHANNEL_STATUS_CODES = frozenset([404, 410])
+
+
+def is_missing_channel_error(e):
+    return isinstance(e, doover_api_error) and e.status_code in MISSING_CHANNEL_STATUS_CODES
+
+
+## Responses to the batch message request that mean the server does not support it
+BATCH_UNSUPPORTED_STATUS_CODES = frozenset([400, 404, 501])
+
+
+## Responses worth retrying - anything else is returned or raised straight away
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+MAX_RETRY_DELAY = 10
+
+
+def get_retry_delay(attempt, retry_backoff, retry_after=None):
+    ## Exponential backoff with full jitter, so that retries from many concurrent
+    ## invocations spread out rather than arriving together
+    delay = random.uniform(0, min(MAX_RETRY_DELAY, retry_backoff * (2 ** attempt)))
+    if retry_after is not None:
+        try:
+            delay = max(delay, min(MAX_RETRY_DELAY, float(retry_after)))
+        except ValueError:
+            pass
+    return delay
+
+
+## Per endpoint circuit breaker, shared by every client in the process with the same settings
+## After failure_threshold consecutive failures (no response, 429 or 5xx) the circuit opens
+## and requests fail fast with circuit_open_error. Once reset_timeout has passed a single
+## trial request is let through - success closes the circuit, failure opens it again.
+class circuit_breaker:
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if time.time() - self.opened_at < self.reset_timeout:
+                return False
+            ## Let one trial request through per reset_timeout
+            self.state = "half_open"
+            self.opened_at = time.time()
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.state = "closed"
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.time()
+
+    def get_retry_in(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+            return max(0, self.reset_timeout - (time.time() - self.opened_at))
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(endpoint, failure_threshold=5, reset_timeout=30):
+    ## Keyed on the settings too, so a client configured with its own thresholds gets a breaker
+    ## that uses them rather than whichever was created first for the endpoint
+    key = (endpoint, failure_threshold, reset_timeout)
+    with _circuit_breakers_lock:
+        breaker = _circuit_breakers.get(key)
+        if breaker is None:
+            breaker = circuit_breaker(failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+            _circuit_breakers[key] = breaker
+        return breaker
+
+
+## Token bucket limiting the request rate of every client it is passed to
+## Each request attempt, including retries, takes one token. Up to burst requests can be
+## sent at once, after which requests are spaced out to rate per second.
+class rate_limiter:
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def get_wait(self):
+        ## Takes a token and returns 0, or returns how long to wait before trying again
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.get_wait()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while True:
+            wait = self.get_wait()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+
+def is_failure_status(status_code):
+    ## Statuses that count against the circuit breaker
+    return status_code == 429 or status_code >= 500
+
+
+## Compressed responses are always accepted, and decompressed by requests / aiohttp as they are read
+ACCEPT_ENCODING = "gzip, deflate"
+
+
+def encode_body(data):
+    if data is None or isinstance(data, bytes):
+        return data
+    return data.encode()
+
+
+def get_wire_length(headers, body):
+    ## The size of a response body as sent, which for a compressed response is its Content-Length
+    if headers.get("Content-Encoding") and headers.get("Content-Length") is not None:
+        try:
+            return int(headers["Content-Length"])
+        except ValueError:
+            pass
+    return len(body)
+
+
+## Process level cache of (agent_id, channel_name) -> channel id and metadata
+## This lets warm containers publish straight to /ch/v1/channel/<id>/ without
+## resolving channels by name again
+class channel_cache:
+
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, agent_id, channel_name):
+        key = (str(agent_id), str(channel_name))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry['cached_at'] > self.ttl:
+                del self.entries[key]
+                return None
+            return entry
+
+    def set(self, agent_id, channel_name, channel_id, metadata=None):
+        if agent_id is None or channel_name is None or channel_id is None:
+            return
+        key = (str(agent_id), str(channel_name))
+        with self.lock:
+            self.entries[key] = {
+                'channel_id' : channel_id,
+                'metadata' : metadata or {},
+                'cached_at' : time.time(),
+            }
+
+    def invalidate(self, agent_id=None, channel_name=None):
+        ## With no arguments everything is cleared, otherwise only matching entries
+        with self.lock:
+            for key in list(self.entries.keys()):
+                if agent_id is not None and key[0] != str(agent_id):
+                    continue
+                if channel_name is not None and key[1] != str(channel_name):
+                    continue
+                del self.entries[key]
+
+    def invalidate_channel_id(self, channel_id):
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if entry['channel_id'] == channel_id:
+                    del self.entries[key]
+
+
+_channel_cache = channel_cache()
+
+
+def get_channel_cache():
+    return _channel_cache
+
+
+def invalidate_channel_cache(agent_id=None, channel_name=None):
+    _channel_cache.invalidate(agent_id=agent_id, channel_name=channel_name)
+
+
+def get_channel_metadata(details):
+    ## Only the stable parts of a channel are cached, never the aggregate or messages
+    return {
+        'channel' : details.get('channel'),
+        'owner' : details.get('owner'),
+        'name' : details.get('name'),
+    }
 
 
 class doover_api_iface:
@@ -12,46 +475,270 @@ class doover_api_iface:
             endpoint="https://my.doover.dev",
             debug_mode=False,
             verify=True,
+            pool_size=10,
+            keep_alive=True,
+            max_retries=3,
+            retry_backoff=0.3,
+            connect_timeout=3.05,
+            read_timeout=10,
+            circuit_failure_threshold=5,
+            circuit_reset_timeout=30,
+            access_token_expiry=None,
+            token_refresh_callback=None,
+            token_refresh_margin=60,
+            compress_requests=False,
+            compress_threshold=1024,
+            compress_level=5,
+            rate_limiter=None,
+            metrics=None,
         ):
 
         self.agent_id = agent_id
-        self.access_token = access_token
+
+        ## Request bodies of at least compress_threshold bytes are gzipped when compress_requests
+        ## is set. It is off by default, as not every server accepts compressed bodies.
+        self.compress_requests = compress_requests
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+        ## An optional rate_limiter, which can be shared between clients
+        self.rate_limiter = rate_limiter
+
+        ## token_refresh_callback is called with no arguments to get a new token, and returns
+        ## either the token or a (token, expiry) tuple, with expiry in seconds since the epoch.
+        ## The token is refreshed token_refresh_margin seconds before it expires, and once
+        ## after any 401 response before the request is retried.
+        self.token_refresh_callback = token_refresh_callback
+        self.token_refresh_margin = token_refresh_margin
+        self.token_lock = threading.Lock()
+        self.set_access_token(access_token, access_token_expiry)
         
         self.endpoint = endpoint
 
+        ## GETs are retried up to max_retries times, and POSTs only when marked retry_safe
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.timeout = (connect_timeout, read_timeout)
+        self.circuit_breaker = get_circuit_breaker(
+            endpoint,
+            failure_threshold=circuit_failure_threshold,
+            reset_timeout=circuit_reset_timeout,
+        )
+
+        ## An optional instrumentation.invocation_metrics object to account requests against
+        self.thread_metrics = threading.local()
+        self.metrics = metrics
+
         self.debug_mode = debug_mode
         self.verify = verify
 
-    def set_access_token(self, access_token):
+        ## None until the batch message endpoint has been tried
+        self.batch_messages_supported = None
+
+        ## Created on the first buffered publish, see publish_writer
+        self.publish_writer = None
+        self.publish_writer_options = {}
+
+        self.session = get_pooled_session(
+            endpoint=endpoint,
+            pool_size=pool_size,
+            keep_alive=keep_alive,
+        )
+
+    def set_access_token(self, access_token, access_token_expiry=None):
+        ## The auth headers are built once per token rather than on every request
+        ## They are kept on the client, not the pooled session, as sessions are shared between tokens
         self.access_token = access_token
+        self.access_token_expiry = access_token_expiry
+        self.headers = {"Authorization": "Token " + str(access_token), "Accept-Encoding": ACCEPT_ENCODING}
+        self.compressed_headers = dict(self.headers, **{"Content-Encoding": "gzip"})
 
     def get_headers(self):
-        return {"Authorization": "Token " + str(self.access_token)}
+        return self.headers
+
+    def prepare_body(self, data):
+        ## Returns the body to send and the headers to send it with
+        ## The body is only compressed once, and reused for any retries
+        data = encode_body(data)
+        if data is None or not self.compress_requests or len(data) < self.compress_threshold:
+            return data, self.get_headers()
+        return gzip.compress(data, compresslevel=self.compress_level), self.compressed_headers
+
+    def token_expiring(self):
+        if self.access_token_expiry is None:
+            return False
+        return time.time() >= self.access_token_expiry - self.token_refresh_margin
+
+    def refresh_access_token(self, failed_token=None):
+        ## Only one thread refreshes - the others find the token already replaced
+        if self.token_refresh_callback is None:
+            return False
+
+        with self.token_lock:
+            if failed_token is not None and self.access_token != failed_token:
+                return True
+            if failed_token is None and not self.token_expiring():
+                return True
+
+            result = self.token_refresh_callback()
+            if isinstance(result, (tuple, list)):
+                self.set_access_token(result[0], result[1])
+            else:
+                self.set_access_token(result)
+            return True
+
+    def ensure_access_token(self):
+        if self.token_refresh_callback is not None and self.token_expiring():
+            self.refresh_access_token()
+
+    @property
+    def metrics(self):
+        ## Metrics bound to the current thread take precedence, so that a client shared
+        ## between worker threads accounts each request to the right invocation
+        metrics = getattr(self.thread_metrics, 'metrics', None)
+        if metrics is not None:
+            return metrics
+        return self.default_metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        self.default_metrics = metrics
+
+    def bind_metrics(self, metrics):
+        ## Binds metrics to requests made from the current thread, None unbinds
+        self.thread_metrics.metrics = metrics
+
+    def get_publish_writer(self):
+        if self.publish_writer is None:
+            self.publish_writer = publish_writer(**self.publish_writer_options)
+        return self.publish_writer
+
+    def flush_publishes(self, timeout=None, agent_id=None):
+        ## Returns the buffered publishes that failed every attempt since the last flush,
+        ## only those for agent_id if given
+        if self.publish_writer is None:
+            return []
+        return self.publish_writer.flush(timeout, agent_id=agent_id)
+
+    def close_publishes(self, timeout=None, agent_id=None):
+        ## As flush_publishes, and then stops the writer's threads
+        ## A later buffered publish starts a new writer
+        if self.publish_writer is None:
+            return []
+        writer = self.publish_writer
+        self.publish_writer = None
+        return writer.close(timeout, agent_id=agent_id)
+
+    def record_request(self, method, url, status_code, bytes_sent, bytes_received, start):
+        ## Passes request accounting to the metrics object, if one is attached
+        if self.metrics is not None:
+            self.metrics.record_request(method, url, status_code, bytes_sent, bytes_received, time.perf_counter() - start)
+
+    ## The retry, circuit breaker and metrics handling below is shared by send_request here
+    ## and in async_doover_api_iface, which only differ in how the request is made
+
+    def get_attempts(self, method, retry_safe=None):
+        ## GETs are always safe to retry, POSTs only when the caller says so
+        if retry_safe is None:
+            retry_safe = method == "GET"
+        return 1 + (self.max_retries if retry_safe else 0)
+
+    def check_circuit(self, method, url):
+        if not self.circuit_breaker.allow_request():
+            raise circuit_open_error(
+                "Circuit open for " + self.endpoint + " - retry in " + str(round(self.circuit_breaker.get_retry_in(), 1)) + "s",
+                method=method,
+                url=url,
+            )
 
-    def make_get_request(self, url, data=None):
-        full_url = self.endpoint + url
-        r = requests.get(full_url, data=data, headers=self.get_headers(), verify=self.verify)
-        if r.status_code == 200:
+    def handle_exception(self, method, url, e, bytes_sent, start):
+        ## Returns the error for a request that got no response
+        self.record_request(method, url, "exception", bytes_sent, 0, start)
+        self.circuit_breaker.record_failure()
+        return doover_api_error(
+            method + " " + url + " failed - " + (str(e) or repr(e)),
+            method=method,
+            url=url,
+            request_sent=not is_connect_error(e),
+        )
+
+    def handle_status(self, method, url, status_code, get_text):
+        ## Returns None for a 200, the error to retry for a retryable status, and raises the
+        ## error for any other status - get_text is only called when the body is needed
+        if status_code == 200:
+            self.circuit_breaker.record_success()
             if self.debug_mode:
-                print(r.text)
-            return r
-        else:
-            print("ERROR : " + str(r.status_code))
-            print(r.text)
+                print(get_text())
             return None
 
+        if is_failure_status(status_code):
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+
+        text = get_text()
+        error = doover_api_error(
+            method + " " + url + " returned " + str(status_code) + " : " + text[:500],
+            method=method,
+            url=url,
+            status_code=status_code,
+            body=text,
+        )
+        if status_code not in RETRY_STATUS_CODES:
+            raise error
+        return error
+
+    def make_request(self, method, url, data=None, params=None, retry_safe=None):
+        ## Returns the response for a 200, and otherwise raises doover_api_error
+
+        self.ensure_access_token()
+        token = self.access_token
+        try:
+            return self.send_request(method, url, data=data, params=params, retry_safe=retry_safe)
+        except doover_api_error as e:
+            ## A 401 gets one retry with a refreshed token
+            if e.status_code != 401 or self.token_refresh_callback is None:
+                raise
+            self.refresh_access_token(failed_token=token)
+            return self.send_request(method, url, data=data, params=params, retry_safe=retry_safe)
+
+    def send_request(self, method, url, data=None, params=None, retry_safe=None):
+        attempts = self.get_attempts(method, retry_safe)
 
-    def make_post_request(self, url, data=None):
         full_url = self.endpoint + url
-        r = requests.post(full_url, data=data, headers=self.get_headers(), verify=self.verify)
-        if r.status_code == 200:
-            if self.debug_mode:
-                print(r.text)
-            return r
-        else:
-            print("ERROR : " + str(r.status_code))
-            print(r.text)
-            return None
+        data, headers = self.prepare_body(data)
+        bytes_sent = len(data) if data is not None else 0
+        error = None
+        for attempt in range(attempts):
+
+            self.check_circuit(method, url)
+
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            retry_after = None
+            start = time.perf_counter()
+            try:
+                r = self.session.request(method, full_url, data=data, params=params, headers=headers, verify=self.verify, timeout=self.timeout)
+            except requests.RequestException as e:
+                error = self.handle_exception(method, url, e, bytes_sent, start)
+            else:
+                self.record_request(method, url, r.status_code, bytes_sent, get_wire_length(r.headers, r.content), start)
+                error = self.handle_status(method, url, r.status_code, lambda: r.text)
+                if error is None:
+                    return r
+                retry_after = r.headers.get("Retry-After")
+
+            if attempt + 1 < attempts:
+                time.sleep( get_retry_delay(attempt, self.retry_backoff, retry_after) )
+
+        raise error
+
+    def make_get_request(self, url, data=None, params=None):
+        return self.make_request("GET", url, data=data, params=params)
+
+    def make_post_request(self, url, data=None, retry_safe=False):
+        return self.make_request("POST", url, data=data, retry_safe=retry_safe)
 
 
     def get_agent_details(self, agent_id):
@@ -62,42 +749,63 @@ class doover_api_iface:
             data=None,
         )
 
-        return json.loads( res.text )
+        return loads( res.content )
 
     
-    def get_channel_details(self, channel_id=None, agent_id=None, channel_name=None):
+    def get_channel_url(self, channel_id=None, agent_id=None, channel_name=None, caller_name="get_channel_url"):
 
         if channel_id is not None:
-            url = '/ch/v1/channel/' + str(channel_id) + '/'
-            msgs_url = '/ch/v1/channel/' + str(channel_id) + '/messages/'
+            return '/ch/v1/channel/' + str(channel_id) + '/'
         elif agent_id is not None and channel_name is not None:
-            url = "/ch/v1/agent/" + str(agent_id) + "/" + str(channel_name) + "/"
-            msgs_url = "/ch/v1/agent/" + str(agent_id) + "/" + str(channel_name) + "/messages/"
-        else:
-            args = {
-                "channel_id" : channel_id,
-                "agent_id" : agent_id,
-                "channel_name" : channel_name,
-            }
-            raise Exception("Incorrect arguments supplied to get_channel_details : " + str(args))
+            return "/ch/v1/agent/" + str(agent_id) + "/" + str(channel_name) + "/"
+
+        args = {
+            "channel_id" : channel_id,
+            "agent_id" : agent_id,
+            "channel_name" : channel_name,
+        }
+        raise Exception("Incorrect arguments supplied to " + caller_name + " : " + str(args))
 
-        res = json.loads( 
+
+    def get_channel_details(self, channel_id=None, agent_id=None, channel_name=None, include_messages=True):
+
+        url = self.get_channel_url(channel_id, agent_id, channel_name, caller_name="get_channel_details")
+
+        res = loads(
             self.make_get_request(
                 url=url,
                 data=None,
-            ).text
+            ).content
         )
 
-        msgs_res = json.loads(
+        ## The message list can be large, so callers that only need the aggregate skip it
+        if include_messages:
+            res['messages'] = self.get_channel_messages(channel_id, agent_id, channel_name)
+
+        return res
+
+
+    def get_channel_messages(self, channel_id=None, agent_id=None, channel_name=None, since=None, limit=None, page=None):
+
+        url = self.get_channel_url(channel_id, agent_id, channel_name, caller_name="get_channel_messages") + 'messages/'
+
+        params = {}
+        if since is not None:
+            params['since'] = since
+        if limit is not None:
+            params['limit'] = limit
+        if page is not None:
+            params['page'] = page
+
+        res = loads(
             self.make_get_request(
-                url=msgs_url,
+                url=url,
                 data=None,
-            ).text
+                params=params or None,
+            ).content
         )
 
-        res['messages'] = msgs_res['messages']
-
-        return res
+        return res['messages']
 
     
     def get_message_details(self, channel_id, message_id):
@@ -108,27 +816,65 @@ class doover_api_iface:
             data=None,
         )
 
-        return json.loads( res.text )
+        return loads( res.content )
 
 
-    def publish_to_channel(self, msg_str, channel_id=None, agent_id=None, channel_name=None):
+    def get_message_details_batch(self, channel_id, message_ids, raise_missing=False):
+        ## Asks the messages endpoint for several messages with their payloads at once
+        ## Returns a dict of message_id -> details for the messages returned, or None if the
+        ## server does not support it, in which case it is not asked again by this client
+        ## raise_missing raises a 404 / 410 instead, as a stale channel id gets one too
 
-        if channel_id is not None:
-            url = '/ch/v1/channel/' + str(channel_id) + '/'
-        elif agent_id is not None and channel_name is not None:
-            url = "/ch/v1/agent/" + str(agent_id) + "/" + str(channel_name) + "/"
-        else:
-            args = {
-                "channel_id" : channel_id,
-                "agent_id" : agent_id,
-                "channel_name" : channel_name,
-            }
-            raise Exception("Incorrect arguments supplied to publish_to_channel : " + str(args))
+        if self.batch_messages_supported is False or len(message_ids) == 0:
+            return None
+
+        url = '/ch/v1/channel/' + str(channel_id) + '/messages/'
+        try:
+            res = self.make_get_request(
+                url=url,
+                data=None,
+                params={
+                    'ids' : ','.join([str(m) for m in message_ids]),
+                    'include_payload' : 'true',
+                },
+            )
+        except doover_api_error as e:
+            if raise_missing and is_missing_channel_error(e):
+                raise
+            ## Only these mean the request is not understood - anything else e.g. a 429 or
+            ## a 401 is a real failure, and says nothing about whether batches are supported
+            if e.status_code not in BATCH_UNSUPPORTED_STATUS_CODES:
+                raise
+            self.batch_messages_supported = False
+            return None
+
+        return self.read_message_batch( res.content )
+
+
+    def read_message_batch(self, content):
+        ## A server that ignores the ids parameter returns the plain message list, without any
+        ## payloads. Messages missing from a batch are left for the caller to fetch one by one.
+        result = {}
+        for m in loads( content ).get('messages', []):
+            if 'payload' in m:
+                result[m['message']] = m
+
+        if len(result) == 0:
+            self.batch_messages_supported = False
+            return None
+
+        self.batch_messages_supported = True
+        return result
+
+
+    def publish_to_channel(self, msg_str, channel_id=None, agent_id=None, channel_name=None, retry_safe=False):
+
+        url = self.get_channel_url(channel_id, agent_id, channel_name, caller_name="publish_to_channel")
 
-          
         res = self.make_post_request(
             url=url,
             data=msg_str,
+            retry_safe=retry_safe,
         ).text
 
         output = {
@@ -165,6 +911,9 @@ class message_log:
 
         return result
 
+    def set_details(self, result):
+        self.json_result = result
+
     def get_payload(self):
         if self.json_result is None:
             self.update()
@@ -189,22 +938,52 @@ class channel:
         self.agent_id = agent_id
         self.channel_name = channel_name
 
+        ## True when channel_id came from the channel cache rather than the caller
+        self.channel_id_cached = False
+
         self.json_result = None
+        self.messages_result = None
+
+
+    def drop_cached_id(self):
+        ## The cached channel id may be stale e.g. the channel was recreated on redeploy
+        ## so forget it and fall back to addressing the channel by name
+        _channel_cache.invalidate(self.agent_id, self.channel_name)
+        self.channel_id = None
+        self.channel_id_cached = False
+
+
+    def set_details(self, result):
+
+        self.json_result = result
+
+        self.channel_id = result['channel']
+        self.agent_id = result['owner']
+        self.channel_name = result['name']
+
+        _channel_cache.set(self.agent_id, self.channel_name, self.channel_id, get_channel_metadata(result))
 
 
     def update(self):
 
+        if self.channel_id_cached:
+            try:
+                result = self.api_client.get_channel_details(channel_id=self.channel_id, include_messages=False)
+                self.set_details(result)
+                return
+            except doover_api_error as e:
+                if not is_missing_channel_error(e):
+                    raise
+                self.drop_cached_id()
+
         result = self.api_client.get_channel_details(
             channel_id=self.channel_id,
             agent_id=self.agent_id,
             channel_name=self.channel_name,
+            include_messages=False,
         )
 
-        self.json_result = result
-
-        self.channel_id = result['channel']
-        self.agent_id = result['owner']
-        self.channel_name = result['name']
+        self.set_details(result)
 
 
     def get_aggregate(self):
@@ -215,37 +994,166 @@ class channel:
         return self.json_result['aggregate']['payload']
 
 
+    def get_channel_messages(self, since=None, limit=None, page=None):
+        ## A cached channel id that no longer exists is dropped, and the channel looked up by
+        ## name again, as in update and publish
+        if self.channel_id_cached:
+            try:
+                return self.api_client.get_channel_messages(channel_id=self.channel_id, since=since, limit=limit, page=page)
+            except doover_api_error as e:
+                if not is_missing_channel_error(e):
+                    raise
+                self.drop_cached_id()
+                self.update()
+
+        return self.api_client.get_channel_messages(
+            channel_id=self.channel_id,
+            agent_id=self.agent_id,
+            channel_name=self.channel_name,
+            since=since,
+            limit=limit,
+            page=page,
+        )
+
+
+    def get_message_details_batch(self, message_ids, messages):
+        ## As get_channel_messages, for the batch message request. The message_log objects
+        ## in messages are moved to the channel's new id if the cached one was gone.
+        if self.channel_id_cached:
+            try:
+                return self.api_client.get_message_details_batch(self.channel_id, message_ids, raise_missing=True)
+            except doover_api_error as e:
+                if not is_missing_channel_error(e):
+                    raise
+                self.drop_cached_id()
+                self.update()
+                for m in messages:
+                    m.channel_id = self.channel_id
+
+        return self.api_client.get_message_details_batch(self.channel_id, message_ids)
+
+
     def get_messages(self):
 
-        if self.json_result is None:
+        if self.messages_result is None:
+            self.messages_result = self.get_channel_messages()
+
+        ## message_log objects need the channel id, which a channel named by agent may not have yet
+        if self.channel_id is None:
             self.update()
 
-        messages = self.json_result['messages']
         result = []
-        for m in messages:
+        for m in self.messages_result:
+            result.append( self.make_message_log(m) )
 
-            message_id = m['message']
-            agent_id = m['agent']
-            channel_id = self.channel_id
+        return result
 
-            new_message = message_log(
-                api_client=self.api_client,
-                channel_id=channel_id,
-                message_id=message_id,
-            )
 
-            result.append(new_message)
+    def make_message_log(self, m):
+        return message_log(
+            api_client=self.api_client,
+            channel_id=self.channel_id,
+            message_id=m['message'],
+        )
 
-        return result
+
+    def fetch_payloads(self, messages, concurrency=10, batch_size=100):
+        ## Fetches the payloads of many message_log objects, returning them in the same order
+        ## A batch request is used where the server supports it, otherwise the individual
+        ## requests are spread over a bounded thread pool
+
+        pending = [m for m in messages if m.json_result is None]
+
+        for i in range(0, len(pending), batch_size):
+            chunk = pending[i:i + batch_size]
+            batch = self.get_message_details_batch([m.message_id for m in chunk], pending)
+            if batch is None:
+                break
+            for m in chunk:
+                details = batch.get(m.message_id)
+                if details is not None:
+                    m.set_details(details)
+
+        pending = [m for m in pending if m.json_result is None]
+        if len(pending) > 0:
+            ## Requests from the pool threads are accounted to the caller's metrics
+            metrics = self.api_client.metrics
+
+            def update(m):
+                self.api_client.bind_metrics(metrics)
+                try:
+                    m.update()
+                finally:
+                    self.api_client.bind_metrics(None)
+
+            with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+                list( executor.map(update, pending) )
+
+        return [m.get_payload() for m in messages]
+
+
+    def iter_messages(self, since=None, limit=None, page_size=100):
+        ## Yields message_log objects one page at a time, rather than loading the full history
+
+        if self.channel_id is None:
+            self.update()
+
+        ## The page size is fixed for the whole walk, as the server pages by page * page_size,
+        ## and the last page is truncated here instead
+        if limit is not None:
+            page_size = max(1, min(page_size, limit))
+
+        count = 0
+        page = 1
+        first_ids = set()
+        while limit is None or count < limit:
+
+            messages = self.get_channel_messages(since=since, limit=page_size, page=page)
+            if len(messages) == 0:
+                return
+
+            ## Stop if the server ignores paging and hands back a page already seen
+            if messages[0]['message'] in first_ids:
+                return
+            first_ids.add(messages[0]['message'])
+
+            for m in messages:
+                if limit is not None and count >= limit:
+                    return
+                yield self.make_message_log(m)
+                count += 1
+
+            if len(messages) < page_size:
+                return
+            page += 1
  
 
-    def publish(self, msg_str, save_log=True, log_aggregate=False ):
+    def publish(self, msg_str, save_log=True, log_aggregate=False, retry_safe=False, buffered=False ):
+        ## retry_safe marks a publish that can be repeated without harm e.g. an aggregate update
+        ## buffered queues the publish on the client's publish_writer and returns None straight away
+
+        if buffered:
+            self.api_client.get_publish_writer().enqueue(self, msg_str, retry_safe=retry_safe)
+            return None
+
+        if self.channel_id_cached:
+            try:
+                return self.api_client.publish_to_channel(
+                    msg_str=msg_str,
+                    channel_id=self.channel_id,
+                    retry_safe=retry_safe,
+                )
+            except doover_api_error as e:
+                if not is_missing_channel_error(e):
+                    raise
+                self.drop_cached_id()
 
         result = self.api_client.publish_to_channel(
             msg_str=msg_str,
             channel_id=self.channel_id,
             agent_id=self.agent_id,
             channel_name=self.channel_name,
+            retry_safe=retry_safe,
         )
 
         return result
@@ -291,6 +1199,8 @@ class agent:
                 channel_name=channel_name,
             )
 
+            _channel_cache.set(agent_id, channel_name, channel_id, get_channel_metadata(c))
+
             result[channel_name] = new_channel
 
         return result
@@ -306,24 +1216,78 @@ class doover_iface:
             endpoint="https://my.doover.dev",
             debug_mode=False,
             verify_ssl=True,
+            pool_size=10,
+            keep_alive=True,
+            max_retries=3,
+            retry_backoff=0.3,
+            connect_timeout=3.05,
+            read_timeout=10,
+            circuit_failure_threshold=5,
+            circuit_reset_timeout=30,
+            access_token_expiry=None,
+            token_refresh_callback=None,
+            token_refresh_margin=60,
+            compress_requests=False,
+            compress_threshold=1024,
+            compress_level=5,
+            rate_limiter=None,
+            metrics=None,
         ):
 
         self.agent_id = agent_id
-        self.access_token = access_token
-        self.access_token_expiry = None
 
         self.endpoint = endpoint
         self.debug_mode = debug_mode
         self.verify_ssl = verify_ssl
 
+        ## All channel, agent and message_log objects built from this interface share
+        ## this api_client, and so share its pooled keep-alive session
         self.api_client = doover_api_iface(
             agent_id=agent_id,
             access_token=access_token,
             endpoint=endpoint,
             debug_mode=debug_mode,
             verify=verify_ssl,
+            pool_size=pool_size,
+            keep_alive=keep_alive,
+            max_retries=max_retries,
+            retry_backoff=retry_backoff,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            circuit_failure_threshold=circuit_failure_threshold,
+            circuit_reset_timeout=circuit_reset_timeout,
+            access_token_expiry=access_token_expiry,
+            token_refresh_callback=token_refresh_callback,
+            token_refresh_margin=token_refresh_margin,
+            compress_requests=compress_requests,
+            compress_threshold=compress_threshold,
+            compress_level=compress_level,
+            rate_limiter=rate_limiter,
+            metrics=metrics,
         )
 
+    ## The token lives on the api_client, which refreshes it
+    @property
+    def access_token(self):
+        return self.api_client.access_token
+
+    @property
+    def access_token_expiry(self):
+        return self.api_client.access_token_expiry
+
+    def set_access_token(self, access_token, access_token_expiry=None):
+        self.api_client.set_access_token(access_token, access_token_expiry)
+
+    def set_publish_writer_options(self, **options):
+        ## e.g. max_pending, flush_interval, max_attempts, concurrency, coalesce_channels
+        self.api_client.publish_writer_options = options
+
+    def flush_publishes(self, timeout=None, agent_id=None):
+        return self.api_client.flush_publishes(timeout, agent_id=agent_id)
+
+    def close_publishes(self, timeout=None, agent_id=None):
+        return self.api_client.close_publishes(timeout, agent_id=agent_id)
+
     def get_agent(self, agent_id):
 
         return agent(
@@ -333,9 +1297,934 @@ class doover_iface:
 
     def get_channel(self, channel_id=None, channel_name=None, agent_id=None):
 
-        return channel(
+        channel_id_cached = False
+        if channel_id is None and agent_id is not None and channel_name is not None:
+            cached = _channel_cache.get(agent_id, channel_name)
+            if cached is not None:
+                channel_id = cached['channel_id']
+                channel_id_cached = True
+
+        result = channel(
             channel_id=channel_id,
             channel_name=channel_name,
             agent_id=agent_id,
             api_client=self.api_client
-        )
\ No newline at end of file
+        )
+        result.channel_id_cached = channel_id_cached
+
+        return result
+
+    def resolve_channels(self, channel_names, agent_id=None):
+        ## Returns channel objects for channel_names, fetching the details of those whose id is
+        ## not already cached in parallel, so that they are ready to publish to and read from
+        if agent_id is None:
+            agent_id = self.agent_id
+
+        result = {}
+        for channel_name in channel_names:
+            result[channel_name] = self.get_channel(channel_name=channel_name, agent_id=agent_id)
+
+        pending = [ch for ch in result.values() if not ch.channel_id_cached]
+        if len(pending) == 1:
+            pending[0].update()
+        elif len(pending) > 1:
+            ## Requests from the pool threads are accounted to the caller's metrics
+            metrics = self.api_client.metrics
+
+            def update(ch):
+                self.api_client.bind_metrics(metrics)
+                try:
+                    ch.update()
+                finally:
+                    self.api_client.bind_metrics(None)
+
+            executor = get_async_executor()
+            futures = [executor.submit(update, ch) for ch in pending]
+            for f in futures:
+                f.result()
+
+        return result
+
+    def prefetch_channels(self, agent_id=None):
+        ## A single agent lookup fills the channel cache for all of an agent's channels
+        if agent_id is None:
+            agent_id = self.agent_id
+        return self.get_agent(agent_id).get_channels()
+
+    def invalidate_channel_cache(self, agent_id=None, channel_name=None):
+        invalidate_channel_cache(agent_id=agent_id, channel_name=channel_name)
+
+
+## Thread pool used by the async client when aiohttp is not available
+_async_executor = None
+_async_executor_lock = threading.Lock()
+
+
+def get_async_executor(max_workers=10):
+    global _async_executor
+    with _async_executor_lock:
+        if _async_executor is None:
+            _async_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pydoover")
+        return _async_executor
+
+
+## Each thread keeps one event loop for running the async client from sync code, rather than
+## asyncio.run creating and closing a loop (and with it the aiohttp session) on every call
+_thread_loops = threading.local()
+
+
+def get_thread_event_loop():
+    loop = getattr(_thread_loops, 'loop', None)
+    if loop is None or loop.is_closed():
+        loop = asyncio.new_event_loop()
+        _thread_loops.loop = loop
+    return loop
+
+
+def run_coroutine(coro):
+    ## Runs coro to completion on this thread's event loop
+    return get_thread_event_loop().run_until_complete(coro)
+
+
+def merge_payloads(base, update):
+    ## Merges update into base the way a channel aggregate does
+    if not isinstance(base, dict) or not isinstance(update, dict):
+        return update
+    result = dict(base)
+    for key, value in update.items():
+        if key in result and isinstance(value, dict):
+            result[key] = merge_payloads(result[key], value)
+        else:
+            result[key] = value
+    return result
+
+
+def get_channel_key(ch):
+    if ch.channel_id is not None:
+        return ("id", str(ch.channel_id))
+    return ("name", str(ch.agent_id), str(ch.channel_name))
+
+
+## Buffered publishing for a single api client
+## channel.publish(..., buffered=True) queues the message here and returns straight away.
+## Queued messages are sent from a background thread once max_pending messages are waiting
+## or flush_interval seconds have passed, or when flush() is called. Messages to the same
+## channel are sent in order, and different channels are sent concurrently.
+##
+## Messages to a channel in coalesce_channels are merged into a single publish, which suits
+## channels where only the aggregate matters e.g. ui_state. A message that fails is retried
+## up to max_attempts times, and then kept in failed. A message that is not retry_safe is
+## only retried when the error shows it never reached the server (the circuit was open, or
+## the connection could not be made) - after any other error it goes straight to failed,
+## rather than risk storing it twice.
+class publish_writer:
+
+    def __init__(
+            self,
+            max_pending=50,
+            flush_interval=0.5,
+            max_attempts=3,
+            retry_backoff=0.3,
+            concurrency=10,
+            coalesce_channels=None,
+        ):
+
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.concurrency = concurrency
+        self.coalesce_channels = set(coalesce_channels or [])
+
+        self.pending = {}           ## channel key -> {'channel' : channel, 'messages' : [...]}
+        self.pending_count = 0
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = []            ## failures not yet returned by a flush
+        self.failed_count = 0
+
+        self.lock = threading.Condition()
+        self.thread = None
+        self.closed = False
+
+        ## The writer's own pool, so that concurrency is the number of channels sent to at once
+        self.executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="pydoover-writer")
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="pydoover-writer", daemon=True)
+                self.thread.start()
+
+    def enqueue(self, ch, msg_str, retry_safe=False):
+        with self.lock:
+            if self.closed:
+                raise Exception("publish_writer is closed - cannot publish to " + str(ch.channel_name))
+
+            key = get_channel_key(ch)
+            group = self.pending.get(key)
+            if group is None:
+                group = {'channel' : ch, 'messages' : []}
+                self.pending[key] = group
+
+            messages = group['messages']
+            if ch.channel_name in self.coalesce_channels and len(messages) > 0 and messages[-1]['attempts'] == 0:
+                last = messages[-1]
+                try:
+                    merged = merge_payloads(loads(last['msg_str']), loads(msg_str))
+                    last['msg_str'] = dumps(merged)
+                    last['retry_safe'] = last['retry_safe'] and retry_safe
+                    last['coalesced'] += 1
+                    return
+                except ValueError:
+                    pass
+
+            messages.append({
+                'msg_str' : msg_str,
+                'retry_safe' : retry_safe,
+                'attempts' : 0,
+                'coalesced' : 1,
+                'error' : None,
+            })
+            self.pending_count += 1
+            if self.pending_count >= self.max_pending:
+                self.lock.notify_all()
+
+        self.start()
+
+    def take_pending(self):
+        ## Called with the lock held
+        batch = list(self.pending.values())
+        self.pending = {}
+        self.pending_count = 0
+        self.in_flight += len(batch)
+        return batch
+
+    def requeue(self, group, messages):
+        ## Called with the lock held - unsent messages go back ahead of anything queued since
+        key = get_channel_key(group['channel'])
+        current = self.pending.get(key)
+        if current is None:
+            self.pending[key] = {'channel' : group['channel'], 'messages' : messages}
+        else:
+            current['messages'] = messages + current['messages']
+        self.pending_count += len(messages)
+
+    def send_group(self, group):
+        ## Sends one channel's messages in order, returning any that were not sent
+        ch = group['channel']
+        messages = group['messages']
+        for i, m in enumerate(messages):
+            try:
+                ch.publish(msg_str=m['msg_str'], retry_safe=m['retry_safe'])
+            except Exception as e:
+                m['attempts'] += 1
+                m['error'] = e
+                return messages[i:]
+        return []
+
+    def can_retry(self, m):
+        return m['retry_safe'] or is_unsent_error(m['error'])
+
+    def send(self, batch):
+        futures = [(group, self.executor.submit(self.send_group, group)) for group in batch]
+
+        ## Wait without the lock held, so that publishes can still be queued meanwhile
+        results = []
+        for group, future in futures:
+            try:
+                unsent = future.result()
+            except Exception as e:
+                unsent = group['messages']
+                for m in unsent:
+                    m['attempts'] += 1
+                    m['error'] = e
+            results.append((group, unsent))
+
+        with self.lock:
+            for group, unsent in results:
+                self.sent += len(group['messages']) - len(unsent)
+                if len(unsent) > 0 and (unsent[0]['attempts'] >= self.max_attempts or not self.can_retry(unsent[0])):
+                    self.failed.append({
+                        'channel' : group['channel'],
+                        'msg_str' : unsent[0]['msg_str'],
+                        'error' : unsent[0]['error'],
+                    })
+                    self.failed_count += 1
+                    unsent = unsent[1:]
+                if len(unsent) > 0:
+                    self.requeue(group, unsent)
+
+            self.in_flight -= len(batch)
+            self.lock.notify_all()
+
+    def run(self):
+        while True:
+            with self.lock:
+                if self.pending_count < self.max_pending and not self.closed:
+                    self.lock.wait(self.flush_interval)
+                if self.pending_count == 0:
+                    if self.closed:
+                        return
+                    continue
+                batch = self.take_pending()
+            self.send(batch)
+
+    def take_failed(self, agent_id=None):
+        ## Hands off the failures not yet returned, only those for agent_id if given, so a
+        ## shared client never reports the same failure twice or to another agent's flush
+        with self.lock:
+            if agent_id is None:
+                failed = self.failed
+                self.failed = []
+            else:
+                failed = [f for f in self.failed if str(f['channel'].agent_id) == str(agent_id)]
+                self.failed = [f for f in self.failed if str(f['channel'].agent_id) != str(agent_id)]
+            return failed
+
+    def flush(self, timeout=None, agent_id=None):
+        ## Sends the whole queue, whichever thread or agent queued it, and waits for any
+        ## background sends. agent_id only limits which failures are returned - the messages
+        ## that failed every attempt since the last flush, see take_failed
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self.lock:
+                while self.in_flight > 0:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self.lock.wait(remaining)
+                if self.in_flight > 0 or self.pending_count == 0:
+                    break
+                batch = self.take_pending()
+
+            ## Back off before retrying a message that failed, but not before sending the
+            ## messages queued behind one that was dropped after max_attempts
+            attempts = max(group['messages'][0]['attempts'] for group in batch)
+            if attempts > 0:
+                time.sleep( get_retry_delay(attempts - 1, self.retry_backoff) )
+            self.send(batch)
+
+            if deadline is not None and time.time() > deadline:
+                break
+
+        return self.take_failed(agent_id)
+
+    def close(self, timeout=None, agent_id=None):
+        failed = self.flush(timeout, agent_id=agent_id)
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+            thread = self.thread
+
+        ## The background thread sends anything still pending before it exits
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+        self.executor.shutdown(wait=False)
+        return failed
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'sent' : self.sent,
+                'pending' : self.pending_count,
+                'failed' : self.failed_count,
+            }
+
+
+class async_doover_api_iface:
+
+    def __init__(
+            self,
+            agent_id=None,
+            access_token=None,
+            endpoint="https://my.doover.dev",
+            debug_mode=False,
+            verify=True,
+            pool_size=10,
+            keep_alive=True,
+            max_retries=3,
+            retry_backoff=0.3,
+            connect_timeout=3.05,
+            read_timeout=10,
+            circuit_failure_threshold=5,
+            circuit_reset_timeout=30,
+            access_token_expiry=None,
+            token_refresh_callback=None,
+            token_refresh_margin=60,
+            compress_requests=False,
+            compress_threshold=1024,
+            compress_level=5,
+            rate_limiter=None,
+            use_aiohttp=True,
+            metrics=None,
+            sync_client=None,
+        ):
+
+        ## The sync client is used for url building, headers, tokens, metrics and as the fallback transport
+        ## An existing doover_api_iface can be passed in as sync_client to share its token and settings
+        if sync_client is not None:
+            self.sync_client = sync_client
+        else:
+            self.sync_client = doover_api_iface(
+                agent_id=agent_id,
+                access_token=access_token,
+                endpoint=endpoint,
+                debug_mode=debug_mode,
+                verify=verify,
+                pool_size=pool_size,
+                keep_alive=keep_alive,
+                max_retries=max_retries,
+                retry_backoff=retry_backoff,
+                connect_timeout=connect_timeout,
+                read_timeout=read_timeout,
+                circuit_failure_threshold=circuit_failure_threshold,
+                circuit_reset_timeout=circuit_reset_timeout,
+                access_token_expiry=access_token_expiry,
+                token_refresh_callback=token_refresh_callback,
+                token_refresh_margin=token_refresh_margin,
+                compress_requests=compress_requests,
+                compress_threshold=compress_threshold,
+                compress_level=compress_level,
+                rate_limiter=rate_limiter,
+                metrics=metrics,
+            )
+
+        self.agent_id = agent_id
+        self.endpoint = self.sync_client.endpoint
+        self.debug_mode = debug_mode
+        self.verify = self.sync_client.verify
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+
+        self.use_aiohttp = use_aiohttp and aiohttp is not None
+
+    def set_access_token(self, access_token, access_token_expiry=None):
+        self.sync_client.set_access_token(access_token, access_token_expiry)
+
+    def get_headers(self):
+        return self.sync_client.get_headers()
+
+    def get_aiohttp_session(self):
+        ## Shared by every client on the running loop with the same endpoint and settings
+        return get_pooled_aiohttp_session(
+            endpoint=self.endpoint,
+            pool_size=self.pool_size,
+            keep_alive=self.keep_alive,
+            verify=self.verify,
+        )
+
+    async def close(self):
+        ## Closes the pooled sessions for this endpoint on the running loop, which are shared
+        ## with any other client using them. Only needed before closing the loop itself.
+        for loop, session in take_pooled_aiohttp_sessions(asyncio.get_running_loop(), self.endpoint):
+            await session.close()
+
+    async def make_request(self, method, url, data=None, params=None, retry_safe=None):
+        ## Returns the response text for a 200, and otherwise raises doover_api_error
+        ## Token refresh, retries, timeouts and the circuit breaker follow doover_api_iface.make_request
+
+        if not self.use_aiohttp:
+            ## Requests from the executor thread are accounted to the caller's metrics
+            metrics = self.sync_client.metrics
+
+            def func():
+                self.sync_client.bind_metrics(metrics)
+                try:
+                    return self.sync_client.make_request(method, url, data=data, params=params, retry_safe=retry_safe)
+                finally:
+                    self.sync_client.bind_metrics(None)
+
+            loop = asyncio.get_running_loop()
+            r = await loop.run_in_executor(
+                get_async_executor(self.pool_size),
+                func,
+            )
+            return r.text
+
+        sync_client = self.sync_client
+        sync_client.ensure_access_token()
+        token = sync_client.access_token
+        try:
+            return await self.send_request(method, url, data=data, params=params, retry_safe=retry_safe)
+        except doover_api_error as e:
+            if e.status_code != 401 or sync_client.token_refresh_callback is None:
+                raise
+            sync_client.refresh_access_token(failed_token=token)
+            return await self.send_request(method, url, data=data, params=params, retry_safe=retry_safe)
+
+    async def send_request(self, method, url, data=None, params=None, retry_safe=None):
+        ## As doover_api_iface.send_request, on an aiohttp session
+        sync_client = self.sync_client
+        attempts = sync_client.get_attempts(method, retry_safe)
+
+        connect_timeout, read_timeout = sync_client.timeout
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+
+        full_url = self.endpoint + url
+        data, headers = sync_client.prepare_body(data)
+        bytes_sent = len(data) if data is not None else 0
+        session = self.get_aiohttp_session()
+        error = None
+        for attempt in range(attempts):
+
+            sync_client.check_circuit(method, url)
+
+            if sync_client.rate_limiter is not None:
+                await sync_client.rate_limiter.acquire_async()
+
+            retry_after = None
+            start = time.perf_counter()
+            try:
+                async with session.request(method, full_url, data=data, params=params, headers=headers, timeout=timeout) as r:
+                    body = await r.read()
+                    text = body.decode(r.get_encoding())
+                    status = r.status
+                    retry_after = r.headers.get("Retry-After")
+                    bytes_received = get_wire_length(r.headers, body)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = sync_client.handle_exception(method, url, e, bytes_sent, start)
+            else:
+                sync_client.record_request(method, url, status, bytes_sent, bytes_received, start)
+                error = sync_client.handle_status(method, url, status, lambda: text)
+                if error is None:
+                    return text
+
+            if attempt + 1 < attempts:
+                await asyncio.sleep( get_retry_delay(attempt, sync_client.retry_backoff, retry_after) )
+
+        raise error
+
+    async def make_get_request(self, url, data=None, params=None):
+        return await self.make_request("GET", url, data=data, params=params)
+
+    async def make_post_request(self, url, data=None, retry_safe=False):
+        return await self.make_request("POST", url, data=data, retry_safe=retry_safe)
+
+
+    async def get_agent_details(self, agent_id):
+
+        url = "/ch/v1/agent/" + str(agent_id) + "/"
+        res = await self.make_get_request(
+            url=url,
+            data=None,
+        )
+
+        return loads( res )
+
+
+    async def get_channel_details(self, channel_id=None, agent_id=None, channel_name=None, include_messages=True):
+
+        url = self.sync_client.get_channel_url(channel_id, agent_id, channel_name, caller_name="get_channel_details")
+
+        if not include_messages:
+            return loads( await self.make_get_request(url=url, data=None) )
+
+        ## Details and messages are independent, so fetch them together
+        res, messages = await asyncio.gather(
+            self.make_get_request(url=url, data=None),
+            self.get_channel_messages(channel_id, agent_id, channel_name),
+        )
+
+        res = loads( res )
+        res['messages'] = messages
+
+        return res
+
+
+    async def get_channel_messages(self, channel_id=None, agent_id=None, channel_name=None, since=None, limit=None, page=None):
+
+        url = self.sync_client.get_channel_url(channel_id, agent_id, channel_name, caller_name="get_channel_messages") + 'messages/'
+
+        params = {}
+        if since is not None:
+            params['since'] = since
+        if limit is not None:
+            params['limit'] = limit
+        if page is not None:
+            params['page'] = page
+
+        res = await self.make_get_request(url=url, data=None, params=params or None)
+
+        return loads( res )['messages']
+
+
+    async def get_message_details(self, channel_id, message_id):
+
+        url = '/ch/v1/channel/' + str(channel_id) + '/message/' + str(message_id)
+        res = await self.make_get_request(
+            url=url,
+            data=None,
+        )
+
+        return loads( res )
+
+
+    async def get_message_details_batch(self, channel_id, message_ids, raise_missing=False):
+
+        sync_client = self.sync_client
+        if sync_client.batch_messages_supported is False or len(message_ids) == 0:
+            return None
+
+        url = '/ch/v1/channel/' + str(channel_id) + '/messages/'
+        try:
+            res = await self.make_get_request(
+                url=url,
+                data=None,
+                params={
+                    'ids' : ','.join([str(m) for m in message_ids]),
+                    'include_payload' : 'true',
+                },
+            )
+        except doover_api_error as e:
+            if raise_missing and is_missing_channel_error(e):
+                raise
+            if e.status_code not in BATCH_UNSUPPORTED_STATUS_CODES:
+                raise
+            sync_client.batch_messages_supported = False
+            return None
+
+        return sync_client.read_message_batch( res )
+
+
+    async def publish_to_channel(self, msg_str, channel_id=None, agent_id=None, channel_name=None, retry_safe=False):
+
+        url = self.sync_client.get_channel_url(channel_id, agent_id, channel_name, caller_name="publish_to_channel")
+
+        res = await self.make_post_request(
+            url=url,
+            data=msg_str,
+            retry_safe=retry_safe,
+        )
+
+        output = {
+            'msg_id' : res
+        }
+
+        return output
+
+
+class async_message_log(message_log):
+
+    async def update(self):
+
+        result = await self.api_client.get_message_details(
+            channel_id=self.channel_id,
+            message_id=self.message_id,
+        )
+
+        self.json_result = result
+
+        return result
+
+    async def get_payload(self):
+        if self.json_result is None:
+            await self.update()
+
+        return self.json_result['payload']
+
+
+class async_channel(channel):
+
+    async def update(self):
+
+        if self.channel_id_cached:
+            try:
+                result = await self.api_client.get_channel_details(channel_id=self.channel_id, include_messages=False)
+                self.set_details(result)
+                return
+            except doover_api_error as e:
+                if not is_missing_channel_error(e):
+                    raise
+                self.drop_cached_id()
+
+        result = await self.api_client.get_channel_details(
+            channel_id=self.channel_id,
+            agent_id=self.agent_id,
+            channel_name=self.channel_name,
+            include_messages=False,
+        )
+
+        self.set_details(result)
+
+
+    async def get_aggregate(self):
+
+        if self.json_result is None:
+            await self.update()
+
+        return self.json_result['aggregate']['payload']
+
+
+    async def get_channel_messages(self, since=None, limit=None, page=None):
+        if self.channel_id_cached:
+            try:
+                return await self.api_client.get_channel_messages(channel_id=self.channel_id, since=since, limit=limit, page=page)
+            except doover_api_error as e:
+                if not is_missing_channel_error(e):
+                    raise
+                self.drop_cached_id()
+                await self.update()
+
+        return await self.api_client.get_channel_messages(
+            channel_id=self.channel_id,
+            agent_id=self.agent_id,
+            channel_name=self.channel_name,
+            since=since,
+            limit=limit,
+            page=page,
+        )
+
+
+    async def get_message_details_batch(self, message_ids, messages):
+        if self.channel_id_cached:
+            try:
+                return await self.api_client.get_message_details_batch(self.channel_id, message_ids, raise_missing=True)
+            except doover_api_error as e:
+                if not is_missing_channel_error(e):
+                    raise
+                self.drop_cached_id()
+                await self.update()
+                for m in messages:
+                    m.channel_id = self.channel_id
+
+        return await self.api_client.get_message_details_batch(self.channel_id, message_ids)
+
+
+    async def get_messages(self):
+
+        if self.messages_result is None:
+            self.messages_result = await self.get_channel_messages()
+
+        if self.channel_id is None:
+            await self.update()
+
+        result = []
+        for m in self.messages_result:
+            result.append( self.make_message_log(m) )
+
+        return result
+
+
+    def make_message_log(self, m):
+        return async_message_log(
+            api_client=self.api_client,
+            channel_id=self.channel_id,
+            message_id=m['message'],
+        )
+
+
+    async def fetch_payloads(self, messages, concurrency=10, batch_size=100):
+
+        pending = [m for m in messages if m.json_result is None]
+
+        for i in range(0, len(pending), batch_size):
+            chunk = pending[i:i + batch_size]
+            batch = await self.get_message_details_batch([m.message_id for m in chunk], pending)
+            if batch is None:
+                break
+            for m in chunk:
+                details = batch.get(m.message_id)
+                if details is not None:
+                    m.set_details(details)
+
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def fetch(m):
+            async with semaphore:
+                if m.json_result is None:
+                    await m.update()
+                return m.json_result['payload']
+
+        return await asyncio.gather(*[fetch(m) for m in messages])
+
+
+    async def iter_messages(self, since=None, limit=None, page_size=100):
+
+        if self.channel_id is None:
+            await self.update()
+
+        ## The page size is fixed for the whole walk, as the server pages by page * page_size,
+        ## and the last page is truncated here instead
+        if limit is not None:
+            page_size = max(1, min(page_size, limit))
+
+        count = 0
+        page = 1
+        first_ids = set()
+        while limit is None or count < limit:
+
+            messages = await self.get_channel_messages(since=since, limit=page_size, page=page)
+            if len(messages) == 0:
+                return
+
+            if messages[0]['message'] in first_ids:
+                return
+            first_ids.add(messages[0]['message'])
+
+            for m in messages:
+                if limit is not None and count >= limit:
+                    return
+                yield self.make_message_log(m)
+                count += 1
+
+            if len(messages) < page_size:
+                return
+            page += 1
+
+
+    async def publish(self, msg_str, save_log=True, log_aggregate=False, retry_safe=False ):
+
+        if self.channel_id_cached:
+            try:
+                return await self.api_client.publish_to_channel(
+                    msg_str=msg_str,
+                    channel_id=self.channel_id,
+                    retry_safe=retry_safe,
+                )
+            except doover_api_error as e:
+                if not is_missing_channel_error(e):
+                    raise
+                self.drop_cached_id()
+
+        result = await self.api_client.publish_to_channel(
+            msg_str=msg_str,
+            channel_id=self.channel_id,
+            agent_id=self.agent_id,
+            channel_name=self.channel_name,
+            retry_safe=retry_safe,
+        )
+
+        return result
+
+
+class async_agent(agent):
+
+    async def update(self):
+
+        result = await self.api_client.get_agent_details(self.agent_id)
+        self.json_result = result
+
+
+    async def get_channels(self):
+
+        if self.json_result is None:
+            await self.update()
+
+        result = {}
+        for c in self.json_result['channels']:
+            result[c['name']] = async_channel(
+                api_client=self.api_client,
+                channel_id=c['channel'],
+                agent_id=c['agent'],
+                channel_name=c['name'],
+            )
+            _channel_cache.set(c['agent'], c['name'], c['channel'], get_channel_metadata(c))
+
+        return result
+
+
+class async_doover_iface:
+
+    def __init__(
+            self,
+            agent_id=None,
+            access_token=None,
+            endpoint="https://my.doover.dev",
+            debug_mode=False,
+            verify_ssl=True,
+            pool_size=10,
+            keep_alive=True,
+            max_retries=3,
+            retry_backoff=0.3,
+            connect_timeout=3.05,
+            read_timeout=10,
+            circuit_failure_threshold=5,
+            circuit_reset_timeout=30,
+            access_token_expiry=None,
+            token_refresh_callback=None,
+            token_refresh_margin=60,
+            compress_requests=False,
+            compress_threshold=1024,
+            compress_level=5,
+            rate_limiter=None,
+            use_aiohttp=True,
+            metrics=None,
+            sync_client=None,
+        ):
+
+        self.agent_id = agent_id
+
+        self.endpoint = endpoint
+        self.debug_mode = debug_mode
+        self.verify_ssl = verify_ssl
+
+        self.api_client = async_doover_api_iface(
+            agent_id=agent_id,
+            access_token=access_token,
+            endpoint=endpoint,
+            debug_mode=debug_mode,
+            verify=verify_ssl,
+            pool_size=pool_size,
+            keep_alive=keep_alive,
+            max_retries=max_retries,
+            retry_backoff=retry_backoff,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            circuit_failure_threshold=circuit_failure_threshold,
+            circuit_reset_timeout=circuit_reset_timeout,
+            access_token_expiry=access_token_expiry,
+            token_refresh_callback=token_refresh_callback,
+            token_refresh_margin=token_refresh_margin,
+            compress_requests=compress_requests,
+            compress_threshold=compress_threshold,
+            compress_level=compress_level,
+            rate_limiter=rate_limiter,
+            use_aiohttp=use_aiohttp,
+            metrics=metrics,
+            sync_client=sync_client,
+        )
+
+    @property
+    def access_token(self):
+        return self.api_client.sync_client.access_token
+
+    @property
+    def access_token_expiry(self):
+        return self.api_client.sync_client.access_token_expiry
+
+    def set_access_token(self, access_token, access_token_expiry=None):
+        self.api_client.set_access_token(access_token, access_token_expiry)
+
+    async def close(self):
+        await self.api_client.close()
+
+    async def get_agent(self, agent_id):
+
+        return async_agent(
+            agent_id=agent_id,
+            api_client=self.api_client
+        )
+
+    async def get_agent_details(self, agent_id):
+
+        return await self.api_client.get_agent_details(agent_id)
+
+    async def get_channel(self, channel_id=None, channel_name=None, agent_id=None):
+
+        channel_id_cached = False
+        if channel_id is None and agent_id is not None and channel_name is not None:
+            cached = _channel_cache.get(agent_id, channel_name)
+            if cached is not None:
+                channel_id = cached['channel_id']
+                channel_id_cached = True
+
+        result = async_channel(
+            channel_id=channel_id,
+            channel_name=channel_name,
+            agent_id=agent_id,
+            api_client=self.api_client
+        )
+        result.channel_id_cached = channel_id_cached
+
+        return result
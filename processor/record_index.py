@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+
+## Duplicate and out of order record detection
+
+## Internet Innovations devices resend buffered Records after reconnecting, so an uplink can
+## hold records that were already processed, or records older than the newest processed.
+## A small index of each device's recently processed records (SeqNo and DateUTC) and the
+## newest record time is kept per agent, in a bounded LRU for warm workers, and persisted in
+## the aggregate of a channel (ii_record_index by default) so it survives cold starts.
+##
+## Before decoding, exact duplicates are dropped, and records older than the newest processed
+## are split out so they can be published as history without overwriting newer state.
+## Records are only added to the index once they have been published.
+##
+## Configured in the package config e.g.
+##
+##   "record_index" : {
+##       "enabled" : true,
+##       "channel" : "ii_record_index",
+##       "history_channel" : "location_history",
+##       "max_keys" : 256,
+##       "persist_interval_s" : 60
+##   }
+
+import time, threading
+from collections import OrderedDict
+
+import geo
+
+
+DEFAULT_MAX_KEYS = 256
+DEFAULT_MAX_AGENTS = 10000
+
+
+def get_record_key(record):
+    ## SeqNo wraps around, so it is paired with the record time
+    return str(record.get('SeqNo')) + "|" + str(record.get('DateUTC'))
+
+
+class record_index:
+
+    def __init__(self, keys=None, newest=None, max_keys=DEFAULT_MAX_KEYS):
+        self.max_keys = max_keys
+        self.keys = OrderedDict()
+        for key in keys or []:
+            self.keys[key] = True
+        self.newest = newest
+        self.dirty = False
+        self.persisted_at = None
+
+    def contains(self, key):
+        return key in self.keys
+
+    def is_older(self, timestamp):
+        return timestamp is not None and self.newest is not None and timestamp < self.newest
+
+    def add(self, record):
+        key = get_record_key(record)
+        self.keys[key] = True
+        self.keys.move_to_end(key)
+        while len(self.keys) > self.max_keys:
+            self.keys.popitem(last=False)
+
+        timestamp = geo.parse_timestamp(record.get('DateUTC'))
+        if timestamp is not None and (self.newest is None or timestamp > self.newest):
+            self.newest = timestamp
+
+        self.dirty = True
+
+    def get_aggregate_msg(self):
+        return {
+            'newest' : self.newest,
+            'keys' : list(self.keys.keys()),
+        }
+
+
+def load_record_index(aggregate, max_keys=DEFAULT_MAX_KEYS):
+    ## Builds an index from the channel aggregate, which may be empty or hold anything else
+    if not isinstance(aggregate, dict):
+        return record_index(max_keys=max_keys)
+
+    keys = aggregate.get('keys')
+    if not isinstance(keys, list):
+        keys = []
+
+    newest = aggregate.get('newest')
+    if not isinstance(newest, (int, float)) or isinstance(newest, bool):
+        newest = None
+
+    return record_index(keys=[str(k) for k in keys[-max_keys:]], newest=newest, max_keys=max_keys)
+
+
+## Process level LRU of agent_id -> record_index
+class record_index_cache:
+
+    def __init__(self, max_agents=DEFAULT_MAX_AGENTS, ttl=3600):
+        self.max_agents = max_agents
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, agent_id):
+        with self.lock:
+            entry = self.entries.get(str(agent_id))
+            if entry is None:
+                return None
+            if time.time() - entry['loaded_at'] > self.ttl:
+                del self.entries[str(agent_id)]
+                return None
+            self.entries.move_to_end(str(agent_id))
+            return entry['index']
+
+    def set(self, agent_id, index):
+        with self.lock:
+            self.entries[str(agent_id)] = {
+                'index' : index,
+                'loaded_at' : time.time(),
+            }
+            self.entries.move_to_end(str(agent_id))
+            while len(self.entries) > self.max_agents:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, agent_id=None):
+        with self.lock:
+            if agent_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(str(agent_id), None)
+
+
+_record_index_cache = record_index_cache()
+
+
+def get_record_index_cache():
+    return _record_index_cache
+
+
+class record_filter:
+
+    def __init__(self, agent_id, max_keys=DEFAULT_MAX_KEYS, persist_interval_s=60, cache=None):
+        self.agent_id = agent_id
+        self.max_keys = max_keys
+        self.persist_interval_s = persist_interval_s
+        self.cache = cache or _record_index_cache
+
+    def get_index(self, index_channel):
+        ## The aggregate is only read when this process has no index for the agent
+        index = self.cache.get(self.agent_id)
+        if index is None:
+            index = load_record_index( index_channel.get_aggregate(), self.max_keys )
+            self.cache.set(self.agent_id, index)
+        return index
+
+    def reset_index(self):
+        ## Starts the agent from an empty index, e.g. when its index channel does not exist yet
+        index = record_index(max_keys=self.max_keys)
+        self.cache.set(self.agent_id, index)
+        return index
+
+    def split(self, records, index_channel):
+        ## Returns the current records, the older records and the number of duplicates dropped
+        index = self.get_index(index_channel)
+
+        current = []
+        older = []
+        duplicates = 0
+        seen = set()
+        for record in records:
+            key = get_record_key(record)
+            if key in seen or index.contains(key):
+                duplicates += 1
+                continue
+            seen.add(key)
+
+            if index.is_older( geo.parse_timestamp(record.get('DateUTC')) ):
+                older.append(record)
+            else:
+                current.append(record)
+
+        return current, older, duplicates
+
+    def mark_processed(self, records, index_channel):
+        index = self.get_index(index_channel)
+        for record in records:
+            index.add(record)
+
+    def get_persist_msg(self, index_channel):
+        ## Returns the aggregate to publish, or None when the index is unchanged or was
+        ## persisted within persist_interval_s
+        index = self.get_index(index_channel)
+        if not index.dirty:
+            return None
+        if index.persisted_at is not None and time.time() - index.persisted_at < self.persist_interval_s:
+            return None
+        return index.get_aggregate_msg()
+
+    def mark_persisted(self, index_channel):
+        index = self.get_index(index_channel)
+        index.dirty = False
+        index.persisted_at = time.time()
+
+    def invalidate(self):
+        self.cache.invalidate(self.agent_id)
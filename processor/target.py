@@ -1,5 +1,5 @@
 #!/usr/bin/python3
-import os, sys, time, json, traceback
+import os, sys, time, json, traceback, asyncio
 
 
 ## This is the definition for a tiny lambda function
@@ -12,16 +12,128 @@ import os, sys, time, json, traceback
 ## You can import the pydoover module to interact with Doover based on decisions made in this function
 ## Just add the current directory to the path first
 
-## attempt to delete any loaded pydoover modules that persist across lambdas
-if 'pydoover' in sys.modules:
-    del sys.modules['pydoover']
-try: del pydoover
-except: pass
-try: del pd
-except: pass
+## pydoover is kept loaded across warm lambda invocations, so that its pooled HTTP sessions,
+## channel cache and decoder tables are reused. Per-invocation state (the access token and
+## agent_id) is bound to a fresh client in create_doover_client on every invocation.
+## Set PYDOOVER_FORCE_RELOAD=1 to go back to reloading pydoover on each import.
+if os.environ.get('PYDOOVER_FORCE_RELOAD', '0') == '1':
+    if 'pydoover' in sys.modules:
+        del sys.modules['pydoover']
+    try: del pydoover
+    except: pass
+    try: del pd
+    except: pass
 
 # sys.path.append(os.path.dirname(__file__))
 import pydoover as pd
+import ii_decoder
+import task_log
+import instrumentation
+import ui_state_delta
+import track_reduction
+import record_index
+import trip_metrics
+import ui_schema
+
+
+## Internet Innovations uplink reason codes
+UPLINK_REASONS = {
+    0 :	'Reserved',
+    1 :	'Start of trip',
+    2 :	'End of trip',
+    3 :	'Elapsed time',
+    4 :	'Speed change',
+    5 :	'Heading change',
+    6 :	'Distance travelled',
+    7 :	'Maximum Speed',
+    8 :	'Stationary',
+    9 :	'Ignition Changed',
+    10 : 'Output Changed',
+    11 : 'Heartbeat',
+    12 : 'Harsh Brake ',
+    13 : 'Harsh Acceleration',
+    14 : 'Harsh Cornering',
+    15 : 'External Power Change  ',
+    16 : 'System Power Monitoring',
+    17 : 'Driver ID Tag Read',
+    18 : 'Over speed',
+    19 : 'Fuel sensor record',
+    20 : 'Towing Alert',
+    21 : 'Debug',
+    22 : 'SDI-12 sensor data',
+    23 : 'Accident',
+    24 : 'Accident Data',
+    25 : 'Sensor value elapsed time',
+    26 : 'Sensor value change',
+    27 : 'Sensor alarm',
+    28 : 'Rain Gauge Tipped',
+    29 : 'Tamper Alert',
+    30 : 'BLOB notification',
+    31 : 'Time and Attendance',
+    32 : 'Trip Restart',
+    33 : 'Tag Gained',
+    34 : 'Tag Update',
+    35 : 'Tag Lost',
+    36 : 'Recovery Mode On',
+    37 : 'Recovery Mode Off',
+    38 : 'Immobiliser On',
+    39 : 'Immobiliser Off',
+    40 : 'Garmin FMI Stop Response ',
+    41 : 'Lone Worker Alarm',
+    42 : 'Device Counters',
+    43 : 'Connected Device Data',
+    44 : 'Entered Geo-Fence ',
+    45 : 'Exited Geo-Fence ',
+    46 : 'High-G Event',
+    47 : 'Third party data record',
+    48 : 'Duress',
+    49 : 'Cell Tower Connection',
+    50 : 'Bluetooth Tag Data',
+}
+
+
+## The channels each message_type resolves up front, when the task config has no "resolve_channels"
+## Any other channel is only looked up if it is used
+DEFAULT_RESOLVE_CHANNELS = {
+    "UPLINK" : ["ui_state"],
+    "DOWNLINK" : [],
+    "DEPLOY" : ["ui_state"],
+}
+
+## The client settings that can be given under "http_pool" in the package config
+HTTP_POOL_OPTIONS = (
+    "debug_mode",
+    "verify_ssl",
+    "pool_size",
+    "keep_alive",
+    "max_retries",
+    "retry_backoff",
+    "connect_timeout",
+    "read_timeout",
+    "circuit_failure_threshold",
+    "circuit_reset_timeout",
+    "token_refresh_margin",
+    "compress_requests",
+    "compress_threshold",
+    "compress_level",
+)
+
+
+class lazy_channel:
+
+    ## Stands in for a pydoover channel, which is only looked up on first use
+
+    def __init__(self, resolve):
+        self.resolve = resolve
+        self.resolved = None
+
+    def get_channel(self):
+        if self.resolved is None:
+            self.resolved = self.resolve()
+        return self.resolved
+
+    def __getattr__(self, name):
+        return getattr(self.get_channel(), name)
 
 
 class target:
@@ -40,6 +152,7 @@ class target:
         #     'agent_settings' : {
         #       'deployment_config' : {} # a dictionary of the deployment config for this agent
         #     }
+        #     'doover_client' : Optional - a long lived pydoover.doover_iface to use instead of creating one, as passed by worker.py
 
 
     ## This function is invoked after the singleton instance is created
@@ -47,41 +160,43 @@ class target:
 
         start_time = time.time()
 
-        self.create_doover_client()
+        ## Counted in pydoover, which stays loaded for the life of the process
+        invocation_number, loaded_at = pd.count_invocation()
 
-        self.add_to_log( "kwargs = " + str(self.kwargs) )
+        start_type = "cold" if invocation_number == 1 else "warm"
+
+        self.metrics = instrumentation.invocation_metrics(
+            task_id=self.kwargs.get('task_id'),
+            agent_id=self.kwargs.get('agent_id'),
+            message_type=self.get_package_config('message_type'),
+            start_type=start_type,
+        )
+
+        with self.timed("create_client"):
+            self.create_doover_client()
+
+        self.add_to_log( "kwargs = " + str(self.get_loggable_kwargs()) )
         self.add_to_log( str( start_time ) )
 
+        if invocation_number == 1:
+            self.add_to_log( "Cold start - module loaded " + str(round(start_time - loaded_at, 3)) + "s before invocation" )
+        else:
+            self.add_to_log( "Warm start - invocation " + str(invocation_number) + " in this container" )
+
         try:
 
-            ## Get the oem_uplink channel
-            oem_uplink_channel = self.cli.get_channel(
-                channel_name="dm_oem_uplink_recv",
-                agent_id=self.kwargs['agent_id']
-            )
+            message_type = self.get_package_config('message_type')
 
-            ## Get the state channel
-            ui_state_channel = self.cli.get_channel(
-                channel_name="ui_state",
-                agent_id=self.kwargs['agent_id']
-            )
+            ## Resolve the channels this task is known to need in parallel, the rest are
+            ## only looked up if they are used
+            self.resolve_channels( self.get_resolve_channels(message_type) )
 
-            ## Get the cmds channel
-            ui_cmds_channel = self.cli.get_channel(
-                channel_name="ui_cmds",
-                agent_id=self.kwargs['agent_id']
-            )
+            oem_uplink_channel = self.get_lazy_channel("dm_oem_uplink_recv")
+            ui_state_channel = self.get_lazy_channel("ui_state")
+            ui_cmds_channel = self.get_lazy_channel("ui_cmds")
+            location_channel = self.get_lazy_channel("location")
 
-            ## Get the location channel
-            location_channel = self.cli.get_channel(
-                channel_name="location",
-                agent_id=self.kwargs['agent_id']
-            )
-            
             ## Do any processing you would like to do here
-            message_type = None
-            if 'message_type' in self.kwargs['package_config'] and 'message_type' is not None:
-                message_type = self.kwargs['package_config']['message_type']
 
             if message_type == "DEPLOY":
                 self.deploy(oem_uplink_channel, ui_state_channel, ui_cmds_channel, location_channel)
@@ -93,8 +208,10 @@ class target:
                 self.uplink(oem_uplink_channel, ui_state_channel, ui_cmds_channel, location_channel)
 
         except Exception as e:
-            self.add_to_log("ERROR attempting to process message - " + str(e))
-            self.add_to_log(traceback.format_exc())
+            self.add_to_log("Error attempting to process message - " + str(e), level="ERROR")
+            self.add_to_log(traceback.format_exc(), level="ERROR")
+
+        self.add_to_log( "Processing took " + str(round(time.time() - start_time, 3)) + "s (" + start_type + " start)" )
 
         self.complete_log()
 
@@ -103,494 +220,672 @@ class target:
     def deploy(self, oem_uplink_channel, ui_state_channel, ui_cmds_channel, location_channel):
         ## Run any deployment code here
 
-        ui_obj = {
+        ## The schema is only built and serialised once per process, see ui_schema.py
+        schema = ui_schema.get_ui_schema()
+
+        ## Skip the schema publish when the ui_state aggregate already holds the same schema,
+        ## unless forced with "deploy_force" : true
+        deployed = False
+        if not self.get_package_config('deploy_force', False):
+            try:
+                with self.timed("schema_check"):
+                    aggregate = ui_state_channel.get_aggregate()
+            except Exception as e:
+                self.add_to_log( "Could not read ui_state aggregate - " + str(e), level="WARNING" )
+                aggregate = None
+            deployed = schema.is_deployed(aggregate)
+
+        if deployed:
+            self.add_to_log( "ui_state schema " + schema.schema_hash + " already deployed - skipping schema publish" )
+        else:
+            self.add_to_log( "Publishing ui_state schema " + schema.schema_hash )
+            self.publish_to_channel(
+                ui_state_channel,
+                msg_str=schema.msg_str
+            )
+
+            ## The redeployed schema may have reset any current values
+            ui_state_delta.invalidate_ui_state_cache(self.kwargs['agent_id'])
+
+        ## Publish a dummy message to oem_uplink to trigger a new process of data
+        ## This is sent on every deploy, as a redeploy may be meant to reprocess the data
+        ## even when the schema is unchanged
+        self.publish_to_channel(
+            oem_uplink_channel,
+            msg_str=pd.dumps({}),
+            save_log=False,
+            log_aggregate=False
+        )
+
+        ## Read by fleet_deploy.py for its report
+        self.deploy_status = "unchanged" if deployed else "deployed"
+
+
+    def downlink(self, oem_uplink_channel, ui_state_channel, ui_cmds_channel, location_channel):
+        ## Run any downlink processing code here
+        pass
+
+
+    def uplink(self, oem_uplink_channel, ui_state_channel, ui_cmds_channel, location_channel):
+        ## Run any uplink processing code here
+
+        if 'msg_obj' in self.kwargs and self.kwargs['msg_obj'] is not None:
+            msg_id = self.kwargs['msg_obj']['message']
+            channel_id = self.kwargs['msg_obj']['channel']
+            payload = self.kwargs['msg_obj']['payload']
+
+        if not msg_id:
+            self.add_to_log( "No trigger message passed - skipping processing" )
+            return
+        
+
+        if not 'Records' in payload:
+            self.add_to_log( "No records in payload - skipping processing" )
+            return
+
+        ## Drop records that were already processed, and hold back records older than the
+        ## newest processed so they cannot overwrite newer state, see record_index.py
+        records = payload['Records']
+        older_records = []
+        record_filter = self.get_record_filter()
+        if record_filter is not None:
+            index_channel = self.get_lazy_channel( self.get_record_index_config().get('channel', "ii_record_index") )
+            try:
+                with self.timed("record_index"):
+                    records, older_records, duplicates = self.split_records(record_filter, records, index_channel)
+            except Exception as e:
+                ## Without the index (e.g. the API is failing) every record is processed as
+                ## new, rather than dropping the uplink
+                self.add_to_log( "Could not read the record index, processing records unfiltered - " + str(e), level="WARNING" )
+                record_filter = None
+            else:
+                if duplicates > 0 or len(older_records) > 0:
+                    self.add_to_log( "Record index dropped " + str(duplicates) + " duplicate and held back " + str(len(older_records)) + " older records" )
+
+        ## Decode every record before publishing anything
+        with self.timed("decode"):
+            decoder = self.get_record_decoder()
+            decoded_records = self.decode_records(decoder, records)
+            older_decoded_records = self.decode_records(decoder, older_records)
+
+        ## "uplink_mode" : "batch" publishes the whole set of records at once
+        ## otherwise each record is published in turn
+        uplink_mode = self.get_package_config('uplink_mode', 'per_record')
+
+        ## ui_state publishes only carry the children that changed, unless disabled
+        ## with "ui_state_delta" : { "enabled" : false }
+        delta = self.get_ui_state_delta()
+
+        ## Optionally thin out the location track, see track_reduction.py
+        reducer = self.get_track_reducer()
+        track_ids = None
+        if reducer is not None:
+            with self.timed("track_reduction"):
+                track_records = reducer.reduce(decoded_records)
+            track_ids = set( id(d) for d in track_records )
+            self.add_to_log( "Track reduction kept " + str(len(track_ids)) + " of " + str(sum(1 for d in decoded_records if d.position is not None)) + " positions" )
+
+        try:
+            if len(older_decoded_records) > 0:
+                self.publish_history(older_decoded_records)
+
+            if uplink_mode == "batch":
+                self.publish_records_batch(decoded_records, ui_state_channel, location_channel, delta, track_ids)
+            else:
+                ## Devices can send a payload's records newest first, so they are put in time
+                ## order (as publish_records_batch does) for the location channel and ui_state to
+                ## end on the newest record. No record here is then older than one already
+                ## published from this payload. The location and ui_state publishes for each
+                ## record go out together.
+                for decoded in sorted( decoded_records, key=lambda d: d.device_time_utc or "" ):
+                    publishes = []
+
+                    if decoded.position is not None and (track_ids is None or id(decoded) in track_ids):
+                        publishes.append((
+                            location_channel,
+                            pd.dumps(decoded.position),
+                            True,
+                        ))
+
+                    ui_state_msg = self.get_ui_state_msg(decoded)
+                    ui_state_msg, full = self.reduce_ui_state_msg(delta, ui_state_msg, ui_state_channel)
+                    if ui_state_msg is not None:
+                        publishes.append((
+                            ui_state_channel,
+                            pd.dumps(ui_state_msg),
+                            True,
+                        ))
+
+                    self.publish_all(publishes)
+
+                    if delta is not None and ui_state_msg is not None:
+                        delta.mark_published(ui_state_msg, full=full)
+
+            if record_filter is not None:
+                ## Buffered publishes are sent first, and the records are only marked if every
+                ## one of them succeeded, so that records lost to a failed publish are processed
+                ## again when the device resends them
+                if self.is_buffered_publish() and not self.flush_publishes():
+                    self.add_to_log( "Buffered publishes failed - records not marked as processed", level="WARNING" )
+                else:
+                    ## decode_records stops at the first record without fields, so only the records
+                    ## that were decoded (and so published) are marked
+                    ## This is done before the trip metrics, so that a failure there cannot lead to
+                    ## the published records being processed again
+                    processed = records[:len(decoded_records)] + older_records[:len(older_decoded_records)]
+                    record_filter.mark_processed(processed, index_channel)
+                    self.persist_record_index(record_filter, index_channel)
+
+            ## Trip metrics are updated from every new record, including the older ones
+            trips = self.get_trip_metrics()
+            if trips is not None:
+                self.publish_trip_metrics(trips, decoded_records + older_decoded_records, deduplicated=record_filter is not None)
+
+        except Exception:
+            ## The last published state is no longer known for certain
+            if delta is not None:
+                delta.invalidate()
+            if reducer is not None:
+                reducer.invalidate()
+            raise
+
+
+    def split_records(self, record_filter, records, index_channel):
+        try:
+            return record_filter.split(records, index_channel)
+        except Exception as e:
+            if not pd.is_missing_channel_error(e):
+                raise
+
+        ## Agents deployed before the record index have no index channel, which is created
+        ## when the new index is first persisted
+        self.add_to_log( "No record index channel yet - starting from an empty index" )
+        record_filter.reset_index()
+        return record_filter.split(records, index_channel)
+
+
+    def decode_records(self, decoder, records):
+        decoded_records = []
+        for record in records:
+            if not 'Fields' in record:
+                self.add_to_log( "No fields in record - skipping processing" )
+                break
+
+            decoded_records.append( decoder.decode(record) )
+        return decoded_records
+
+
+    def publish_history(self, decoded_records):
+        ## Records older than the newest processed only go to the history channel, as a
+        ## single track message, leaving the location and ui_state aggregates as they are
+        history_channel_name = self.get_record_index_config().get('history_channel', "location_history")
+        if not history_channel_name:
+            return
+
+        track = []
+        for decoded in sorted( decoded_records, key=lambda d: d.device_time_utc or "" ):
+            if decoded.position is not None:
+                point = dict(decoded.position)
+                point['time'] = decoded.device_time_utc
+                point['reason'] = decoded.device_uplink_reason
+                track.append(point)
+
+        if len(track) == 0:
+            return
+
+        self.add_to_log( "Publishing " + str(len(track)) + " older positions to " + history_channel_name )
+        self.publish_to_channel(
+            self.get_channel(history_channel_name),
+            msg_str=pd.dumps({'track' : track}),
+        )
+
+
+    def publish_trip_metrics(self, trips, decoded_records, deduplicated=False):
+        if len(decoded_records) == 0:
+            return
+
+        trip_metrics_channel = self.get_channel( self.get_package_config('trip_metrics', {}).get('channel', "trip_metrics") )
+        try:
+            with self.timed("trip_metrics"):
+                state = trips.update(decoded_records, trip_metrics_channel, deduplicated=deduplicated)
+        except Exception as e:
+            ## The totals can only be advanced from the stored state, so if it cannot be read
+            ## the metrics are skipped rather than published from zero over it
+            if not pd.is_missing_channel_error(e):
+                self.add_to_log( "Could not read trip metrics, skipping them - " + str(e), level="WARNING" )
+                return
+            ## The channel is created by the first publish to it
+            self.add_to_log( "No trip metrics channel yet - starting from a fresh state" )
+            state = trips.apply_records(trip_metrics.new_state(), decoded_records, deduplicated=deduplicated)
+
+        self.publish_to_channel(
+            trip_metrics_channel,
+            msg_str=pd.dumps(state),
+            save_log=False,
+        )
+
+
+    def persist_record_index(self, record_filter, index_channel):
+        msg = record_filter.get_persist_msg(index_channel)
+        if msg is None:
+            return
+        self.publish_to_channel(
+            index_channel,
+            msg_str=pd.dumps(msg),
+            save_log=False,
+        )
+        record_filter.mark_persisted(index_channel)
+
+
+    def publish_records_batch(self, decoded_records, ui_state_channel, location_channel, delta=None, track_ids=None):
+
+        if len(decoded_records) == 0:
+            return
+
+        ## DateUTC is an ISO formatted string, so sorting on it orders the records in time
+        ## The sort is stable, so records with the same time stay in the order received
+        ordered = sorted( decoded_records, key=lambda d: d.device_time_utc or "" )
+
+        publishes = []
+
+        ## The location track is sent as a single message, with the newest position at the
+        ## top level so the channel aggregate still holds the current location
+        track = []
+        for decoded in ordered:
+            if decoded.position is not None and (track_ids is None or id(decoded) in track_ids):
+                point = dict(decoded.position)
+                point['time'] = decoded.device_time_utc
+                track.append(point)
+
+        if len(track) > 0:
+            location_msg = dict(track[-1])
+            del location_msg['time']
+            location_msg['track'] = track
+            publishes.append((
+                location_channel,
+                pd.dumps(location_msg),
+                True,
+            ))
+
+        ## ui_state only needs the newest record that carries the ignition state
+        ui_state_msg = None
+        full = False
+        for decoded in reversed(ordered):
+            ui_state_msg = self.get_ui_state_msg(decoded)
+            if ui_state_msg is not None:
+                ui_state_msg, full = self.reduce_ui_state_msg(delta, ui_state_msg, ui_state_channel)
+                break
+
+        if ui_state_msg is not None:
+            publishes.append((
+                ui_state_channel,
+                pd.dumps(ui_state_msg),
+                True,
+            ))
+
+        self.add_to_log( "Batch publishing " + str(len(ordered)) + " records with " + str(len(publishes)) + " publishes" )
+        self.publish_all(publishes)
+
+        if delta is not None and ui_state_msg is not None:
+            delta.mark_published(ui_state_msg, full=full)
+
+
+    def get_record_decoder(self):
+        odometer_offset = self.get_agent_settings('ODO_OFFSET')
+        machine_hours_offset = self.get_agent_settings('MACHINE_HOURS_OFFSET')
+
+        if odometer_offset is not None:
+            self.add_to_log("Applying odometer offset of " + str(odometer_offset))
+
+        if machine_hours_offset is not None:
+            self.add_to_log("Applying machine hours offset of " + str(machine_hours_offset))
+
+        return ii_decoder.record_decoder(
+            odometer_offset=odometer_offset,
+            machine_hours_offset=machine_hours_offset,
+        )
+
+
+    def get_track_reducer(self):
+        config = self.get_package_config('track_reduction', {})
+        if not config.get('enabled', False):
+            return None
+
+        return track_reduction.track_reducer(
+            agent_id=self.kwargs['agent_id'],
+            min_distance_m=config.get('min_distance_m'),
+            min_interval_s=config.get('min_interval_s'),
+            simplify_tolerance_m=config.get('simplify_tolerance_m'),
+            keep_reasons=config.get('keep_reasons'),
+        )
+
+
+    def get_record_index_config(self):
+        return self.get_package_config('record_index', {})
+
+
+    def get_record_filter(self):
+        config = self.get_record_index_config()
+        if not config.get('enabled', False):
+            return None
+
+        return record_index.record_filter(
+            agent_id=self.kwargs['agent_id'],
+            max_keys=config.get('max_keys', record_index.DEFAULT_MAX_KEYS),
+            persist_interval_s=config.get('persist_interval_s', 60),
+        )
+
+
+    def get_trip_metrics(self):
+        config = self.get_package_config('trip_metrics', {})
+        if not config.get('enabled', False):
+            return None
+
+        return trip_metrics.trip_metrics(
+            agent_id=self.kwargs['agent_id'],
+            idle_speed_kmh=config.get('idle_speed_kmh', 1),
+            max_gap_s=config.get('max_gap_s', 3600),
+        )
+
+
+    def get_ui_state_delta(self):
+        config = self.get_package_config('ui_state_delta', {})
+        if not config.get('enabled', True):
+            return None
+
+        return ui_state_delta.ui_state_delta(
+            agent_id=self.kwargs['agent_id'],
+            deadbands=config.get('deadbands'),
+            passive_children=config.get('passive_children'),
+            cache_ttl=config.get('cache_ttl'),
+            full_refresh_s=config.get('full_refresh_s', 3600),
+        )
+
+
+    def reduce_ui_state_msg(self, delta, ui_state_msg, ui_state_channel):
+        ## Returns (msg to publish or None, whether it is the full message)
+        if delta is None or ui_state_msg is None:
+            return ui_state_msg, True
+
+        try:
+            with self.timed("ui_state_delta"):
+                reduced = delta.reduce(ui_state_msg, ui_state_channel)
+        except Exception as e:
+            ## Without the last published values nothing is known to be unchanged, so the
+            ## whole message is sent rather than dropping the update
+            self.add_to_log( "Could not read ui_state aggregate, publishing full ui_state - " + str(e), level="WARNING" )
+            return ui_state_msg, True
+
+        if reduced is None:
+            self.add_to_log( "ui_state unchanged - skipping publish" )
+        elif reduced is not ui_state_msg:
+            self.add_to_log( "Publishing ui_state changes for " + str(sorted(reduced['state']['children'].keys())) )
+
+        return reduced, reduced is ui_state_msg
+
+
+    def get_ui_state_msg(self, decoded):
+
+        ignition_on = decoded.ignition_on
+        speed_kmh = decoded.speed_kmh
+
+        if ignition_on is None:
+            return None
+
+        if not ignition_on:
+            status_icon = "off"
+            display_string = "Off"
+        elif speed_kmh is None or speed_kmh <= 1:
+            status_icon = "idle"
+            display_string = "Idle"
+        else:
+            status_icon = None
+            display_string = "Running"
+
+        return {
             "state" : {
-                "type" : "uiContainer",
-                "displayString" : "",
+                "displayString" : display_string,
+                "statusIcon" : status_icon,
                 "children" : {
                     "location" : {
-                        "type" : "uiVariable",
-                        "varType" : "location",
-                        "hide" : True,
-                        "name" : "location",
-                        "displayString" : "Location",
+                        "currentValue" : decoded.position,
                     },
-                    "sensorReading" : {
-                        "type" : "uiVariable",
-                        "varType" : "float",
-                        "name" : "sensorReading",
-                        "displayString" : "Sensor Reading",
-                        "decPrecision": 1,
-                        "form": "radialGauge",
-                        "ranges": [
-                            {
-                                "label" : "Low",
-                                "min" : 0,
-                                "max" : 20,
-                                "colour" : "blue",
-                                "showOnGraph" : True
-                            },
-                            {
-                                # "label" : "Ok",
-                                "min" : 20,
-                                "max" : 80,
-                                "colour" : "green",
-                                "showOnGraph" : True
-                            },
-                            {
-                                "label" : "Fast",
-                                "min" : 80,
-                                "max" : 120,
-                                "colour" : "yellow",
-                                "showOnGraph" : True
-                            }
-                        ]
+                    "speed" : {
+                        "currentValue" : speed_kmh,
                     },
                     "gpsAccuracy" : {
-                        "type" : "uiVariable",
-                        "varType" : "float",
-                        "name" : "gpsAccuracy",
-                        "displayString" : "GPS accuracy (m)",
-                        "decPrecision": 0,
-                        "ranges": [
-                            {
-                                "label" : "Good",
-                                "min" : 0,
-                                "max" : 15,
-                                "colour" : "green",
-                                "showOnGraph" : True
-                            },
-                            {
-                                "label" : "Ok",
-                                "min" : 15,
-                                "max" : 30,
-                                "colour" : "blue",
-                                "showOnGraph" : True
-                            },
-                            {
-                                "label" : "Bad",
-                                "min" : 30,
-                                "max" : 80,
-                                "colour" : "yellow",
-                                "showOnGraph" : True
-                            },
-                            {
-                                "label" : "Lost",
-                                "min" : 80,
-                                "max" : 100,
-                                "colour" : "red",
-                                "showOnGraph" : True
-                            }
-                        ]
+                        "currentValue" : decoded.gps_accuracy_m,
                     },
                     "ignitionOn" : {
-                        "type" : "uiVariable",
-                        "varType" : "bool",
-                        "name" : "ignitionOn",
-                        "displayString" : "Ignition On",
+                        "currentValue" : ignition_on,
                     },
                     "deviceRunHours" : {
-                        "type" : "uiVariable",
-                        "varType" : "float",
-                        "name" : "deviceRunHours",
-                        "displayString" : "Machine Hours (hrs)",
-                        "decPrecision": 2,
+                        "currentValue" : decoded.device_run_hours,
                     },
                     "deviceOdometer" : {
-                        "type" : "uiVariable",
-                        "varType" : "float",
-                        "name" : "deviceOdometer",
-                        "displayString" : "Machine Odometer (km)",
-                        "decPrecision": 1,
+                        "currentValue" : decoded.device_odometer,
                     },
                     "sysVoltage" : {
-                        "type" : "uiVariable",
-                        "varType" : "float",
-                        "name" : "sysVoltage",
-                        "displayString" : "System Voltage (V)",
-                        "decPrecision": 1,
-                        "ranges": [
-                            {
-                                "label" : "Low",
-                                "min" : 9,
-                                "max" : 11.5,
-                                "colour" : "yellow",
-                                "showOnGraph" : True
-                            },
-                            {
-                                # "label" : "Ok",
-                                "min" : 11.5,
-                                "max" : 13.0,
-                                "colour" : "blue",
-                                "showOnGraph" : True
-                            },
-                            {
-                                "label" : "Charging",
-                                "min" : 13.0,
-                                "max" : 14.2,
-                                "colour" : "green",
-                                "showOnGraph" : True
-                            },
-                            {
-                                "label" : "Over Voltage",
-                                "min" : 14.2,
-                                "max" : 15.0,
-                                "colour" : "yellow",
-                                "showOnGraph" : True
-                            }
-                        ]
+                        "currentValue" : decoded.sys_voltage,
                     },
                     "battVoltage" : {
-                        "type" : "uiVariable",
-                        "varType" : "float",
-                        "name" : "battVoltage",
-                        "displayString" : "Tracker Battery (V)",
-                        "decPrecision": 1,
-                        "ranges": [
-                            {
-                                "label" : "Low",
-                                "min" : 3.0,
-                                "max" : 3.5,
-                                "colour" : "yellow",
-                                "showOnGraph" : True
-                            },
-                            {
-                                # "label" : "Ok",
-                                "min" : 3.5,
-                                "max" : 3.8,
-                                "colour" : "blue",
-                                "showOnGraph" : True
-                            },
-                            {
-                                "label" : "Good",
-                                "min" : 3.8,
-                                "max" : 4.2,
-                                "colour" : "green",
-                                "showOnGraph" : True
-                            },
-                            {
-                                "label" : "Over Voltage",
-                                "min" : 4.2,
-                                "max" : 4.5,
-                                "colour" : "yellow",
-                                "showOnGraph" : True
-                            }
-                        ]
+                        "currentValue" : decoded.batt_voltage,
                     },
                     "dataSignalStrength" : {
-                        "type" : "uiVariable",
-                        "varType" : "float",
-                        "name" : "dataSignalStrength",
-                        "displayString" : "Cellular Signal (%)",
-                        "decPrecision": 0,
-                        "ranges": [
-                            {
-                                "label" : "Low",
-                                "min" : 0,
-                                "max" : 30,
-                                "colour" : "yellow",
-                                "showOnGraph" : True
-                            },
-                            {
-                                "label" : "Ok",
-                                "min" : 30,
-                                "max" : 60,
-                                "colour" : "blue",
-                                "showOnGraph" : True
-                            },
-                            {
-                                "label" : "Strong",
-                                "min" : 60,
-                                "max" : 100,
-                                "colour" : "green",
-                                "showOnGraph" : True
-                            }
-                        ]
+                        "currentValue" : decoded.data_signal_strength,
                     },
                     "deviceTemp" : {
-                        "type" : "uiVariable",
-                        "varType" : "float",
-                        "name" : "deviceTemp",
-                        "displayString" : "Device Temperature (C)",
-                        "decPrecision": 0,
-                        "ranges": [
-                            {
-                                "label" : "Low",
-                                "min" : 0,
-                                "max" : 20,
-                                "colour" : "blue",
-                                "showOnGraph" : True
-                            },
-                            {
-                                # "label" : "Ok",
-                                "min" : 20,
-                                "max" : 35,
-                                "colour" : "green",
-                                "showOnGraph" : True
-                            },
-                            {
-                                "label" : "Warm",
-                                "min" : 35,
-                                "max" : 50,
-                                "colour" : "yellow",
-                                "showOnGraph" : True
-                            }
-                        ]
+                        "currentValue" : decoded.device_temp,
                     },
                     "lastUplinkReason" : {
-                        "type" : "uiVariable",
-                        "varType" : "text",
-                        "name" : "lastUplinkReason",
-                        "displayString" : "Reason for uplink",
+                        "currentValue" : self.uplink_reason_translate(decoded.device_uplink_reason),
                     },
                     "deviceTimeUtc" : {
-                        "type" : "uiVariable",
-                        "varType" : "datetime",
-                        "name" : "deviceTimeUtc",
-                        "displayString" : "Device Time (UTC)",
+                        "currentValue" : decoded.device_time_utc,
                     },
-                    "node_connection_info": {
-                        "type": "uiConnectionInfo",
-                        "name": "node_connection_info",
-                        "connectionType": "periodic",
-                        # "connectionPeriod": 1800,
-                        # "nextConnection": 1800
-                        "connectionPeriod": 600,
-                        "nextConnection": 600,
-                    }
                 }
             }
         }
 
-        ui_state_channel.publish(
-            msg_str=json.dumps(ui_obj)
-        )
+    def uplink_reason_translate(self, reason_code):
+        if reason_code in UPLINK_REASONS:
+            return UPLINK_REASONS[reason_code]
+        else:
+            return "Unknown reason"
 
-        ## Publish a dummy message to oem_uplink to trigger a new process of data
-        oem_uplink_channel.publish(
-            msg_str=json.dumps({}),
-            save_log=False,
-            log_aggregate=False
-        )
 
+    def get_pool_config(self):
+        ## Unknown settings are logged and dropped, rather than failing every invocation
+        pool_config = {}
+        for key, value in self.get_package_config('http_pool', {}).items():
+            if key in HTTP_POOL_OPTIONS:
+                pool_config[key] = value
+            else:
+                self.add_to_log( "Ignoring unknown http_pool setting " + str(key), level="WARNING" )
+        return pool_config
 
-    def downlink(self, oem_uplink_channel, ui_state_channel, ui_cmds_channel, location_channel):
-        ## Run any downlink processing code here
-        pass
+    def create_doover_client(self):
+        ## Optional connection pool, timeout and circuit breaker settings can be supplied in the package config
+        ## e.g. "http_pool" : { "pool_size" : 10, "keep_alive" : true, "max_retries" : 3, "read_timeout" : 10 }
+        pool_config = self.get_pool_config()
+
+        ## A worker shares one client between invocations - requests made from this thread
+        ## are still accounted to this invocation's metrics
+        if self.kwargs.get('doover_client') is not None:
+            self.cli = self.kwargs['doover_client']
+            self.cli.api_client.bind_metrics(self.get_metrics())
+            self.async_cli = pd.async_doover_iface(
+                agent_id=self.kwargs['agent_id'],
+                sync_client=self.cli.api_client,
+                **pool_config
+            )
 
+        else:
+            self.cli = pd.doover_iface(
+                agent_id=self.kwargs['agent_id'],
+                access_token=self.kwargs['access_token'],
+                endpoint=self.kwargs['api_endpoint'],
+                metrics=self.get_metrics(),
+                **pool_config
+            )
 
-    def uplink(self, oem_uplink_channel, ui_state_channel, ui_cmds_channel, location_channel):
-        ## Run any uplink processing code here
+            self.async_cli = pd.async_doover_iface(
+                agent_id=self.kwargs['agent_id'],
+                access_token=self.kwargs['access_token'],
+                endpoint=self.kwargs['api_endpoint'],
+                metrics=self.get_metrics(),
+                **pool_config
+            )
 
-        if 'msg_obj' in self.kwargs and self.kwargs['msg_obj'] is not None:
-            msg_id = self.kwargs['msg_obj']['message']
-            channel_id = self.kwargs['msg_obj']['channel']
-            payload = self.kwargs['msg_obj']['payload']
+        ## Buffered publishing is set up under "buffered_publish" in the package config e.g.
+        ## { "enabled" : true, "max_pending" : 50, "flush_interval_s" : 0.5, "coalesce_channels" : ["ui_state"] }
+        buffered_config = self.get_package_config('buffered_publish', {})
+        if buffered_config.get('enabled', False):
+            self.cli.set_publish_writer_options(
+                max_pending=buffered_config.get('max_pending', 50),
+                flush_interval=buffered_config.get('flush_interval_s', 0.5),
+                max_attempts=buffered_config.get('max_attempts', 3),
+                coalesce_channels=buffered_config.get('coalesce_channels', ['ui_state']),
+            )
 
-        if not msg_id:
-            self.add_to_log( "No trigger message passed - skipping processing" )
-            return
-        
+    def get_resolve_channels(self, message_type):
+        ## The channel manifest for the task e.g. "resolve_channels" : ["ui_state", "location"]
+        resolve_channels = self.get_package_config('resolve_channels')
+        if resolve_channels is None:
+            resolve_channels = DEFAULT_RESOLVE_CHANNELS.get(message_type, [])
+        return resolve_channels
 
-        if not 'Records' in payload:
-            self.add_to_log( "No records in payload - skipping processing" )
+    def resolve_channels(self, channel_names):
+        if not hasattr(self, 'channels'):
+            self.channels = {}
+
+        channel_names = [name for name in channel_names if name not in self.channels]
+        if len(channel_names) == 0:
             return
-        
-        for record in payload['Records']:
-            if not 'Fields' in record:
-                self.add_to_log( "No fields in record - skipping processing" )
-                return
 
-            fields = record['Fields']
-
-            device_uplink_reason = record['Reason']
-            device_time_utc = record['DateUTC']
-
-            position = None
-            gps_accuracy_m = None
-            speed_kmh = None
-            ignition_on = None
-            device_run_hours = None
-            device_odometer = None
-            sys_voltage = None
-            batt_voltage = None
-            device_temp = None
-            data_signal_strength = None
-
-
-            for f in fields:
-
-                if not 'FType' in f:
-                    continue
-
-                if f['FType'] == 0:
-                    gps_accuracy_m = 99
-                    if f['Lat'] != 0 and f['Long'] != 0:
-                        position = {
-                            'lat': f['Lat'],
-                            'long': f['Long'],
-                            'alt': f['Alt'],
-                        }
-                        speed_kmh = f['Spd'] * ( 3.6 / 100)
-                        gps_accuracy_m = f['PosAcc']
-
-                if f['FType'] == 2:
-                    ignition_on = (f['DIn'] & 0b001 != 0)
-
-                if f['FType'] == 6:
-                    batt_voltage = f['AnalogueData']['1'] / 1000
-                    sys_voltage = f['AnalogueData']['2'] / 100
-                    device_temp = f['AnalogueData']['3'] / 100
-                    data_signal_strength = round( f['AnalogueData']['4'] * (100/31) ) ## Signal quality between 0-31
-
-                if f['FType'] == 27:
-                    device_odometer = f['Odo'] / 100
-                    device_run_hours = f['RH'] / (60 * 60)
-
-                    odometer_offset = self.get_agent_settings('ODO_OFFSET')
-                    machine_hours_offset = self.get_agent_settings('MACHINE_HOURS_OFFSET')
-
-                    if odometer_offset is not None:
-                        self.add_to_log("Applying odometer offset of " + str(odometer_offset))
-                        device_odometer = device_odometer + odometer_offset
-
-                    if machine_hours_offset is not None:
-                        self.add_to_log("Applying machine hours offset of " + str(machine_hours_offset))
-                        device_run_hours = device_run_hours + machine_hours_offset
-
-            if position is not None:
-                location_channel.publish(
-                    msg_str=json.dumps(position),
-                    save_log=True
+        ## A channel that could not be resolved is still published to by name
+        with self.timed("channel_resolution"):
+            try:
+                self.channels.update( self.cli.resolve_channels(channel_names, agent_id=self.kwargs['agent_id']) )
+            except pd.circuit_open_error:
+                raise
+            except Exception as e:
+                self.add_to_log( "Could not resolve channels " + str(channel_names) + " - " + str(e), level="WARNING" )
+
+    def get_channel(self, channel_name):
+        if not hasattr(self, 'channels'):
+            self.channels = {}
+
+        if channel_name not in self.channels:
+            with self.timed("channel_resolution"):
+                self.channels[channel_name] = self.cli.get_channel(
+                    channel_name=channel_name,
+                    agent_id=self.kwargs['agent_id']
                 )
+        return self.channels[channel_name]
+
+    def get_lazy_channel(self, channel_name):
+        return lazy_channel( lambda: self.get_channel(channel_name) )
+
+    def is_buffered_publish(self):
+        return self.get_package_config('buffered_publish', {}).get('enabled', False)
+
+    def flush_publishes(self, close=False):
+        ## Sends any buffered publishes, logging those that failed every attempt, and returns
+        ## whether they were all sent
+        if not hasattr(self, 'cli') or not self.is_buffered_publish():
+            return True
+
+        with self.timed("publish_flush"):
+            if close and self.kwargs.get('doover_client') is None:
+                ## This invocation's own client is not used again, so its writer threads are stopped
+                failed = self.cli.close_publishes(agent_id=self.kwargs['agent_id'])
+            else:
+                failed = self.cli.flush_publishes(agent_id=self.kwargs['agent_id'])
+
+        if len(failed) > 0:
+            ## The cached ui_state, last track point and record index may not match what was published
+            ui_state_delta.invalidate_ui_state_cache(self.kwargs['agent_id'])
+            track_reduction.get_last_point_cache().invalidate(self.kwargs['agent_id'])
+            record_index.get_record_index_cache().invalidate(self.kwargs['agent_id'])
+
+        for f in failed:
+            self.add_to_log( "Buffered publish to " + str(f['channel'].channel_name) + " failed - " + str(f['error']), level="ERROR" )
+
+        return len(failed) == 0
+
+    def get_metrics(self):
+        if not hasattr(self, 'metrics') or self.metrics is None:
+            self.metrics = instrumentation.invocation_metrics(
+                task_id=self.kwargs.get('task_id'),
+                agent_id=self.kwargs.get('agent_id'),
+            )
+        return self.metrics
+
+    def timed(self, phase_name):
+        return self.get_metrics().phase(phase_name)
+
+    def is_retry_safe(self, ch):
+        ## Publishes to these channels only update the aggregate, so repeating one is harmless
+        ## and they are retried on a timeout or 5xx e.g. "retry_safe_channels" : ["ui_state"]
+        return ch.channel_name in self.get_package_config('retry_safe_channels', ['ui_state'])
+
+    def publish_to_channel(self, ch, msg_str, save_log=True, log_aggregate=False):
+        with self.timed("publish:" + str(ch.channel_name)):
+            return ch.publish(
+                msg_str=msg_str,
+                save_log=save_log,
+                log_aggregate=log_aggregate,
+                retry_safe=self.is_retry_safe(ch),
+                buffered=self.is_buffered_publish(),
+            )
 
-            if ignition_on is not None:
+    def get_package_config(self, key, default=None):
+        if 'package_config' in self.kwargs and self.kwargs['package_config'] is not None:
+            if key in self.kwargs['package_config'] and self.kwargs['package_config'][key] is not None:
+                return self.kwargs['package_config'][key]
+        return default
 
-                if not ignition_on:
-                    status_icon = "off"
-                    display_string = "Off"
-                elif speed_kmh is None or speed_kmh <= 1:
-                    status_icon = "idle"
-                    display_string = "Idle"
-                else:
-                    status_icon = None
-                    display_string = "Running"
-
-                ui_state_channel.publish(
-                    msg_str=json.dumps({
-                        "state" : {
-                            "displayString" : display_string,
-                            "statusIcon" : status_icon,
-                            "children" : {
-                                "location" : {
-                                    "currentValue" : position,
-                                },
-                                "speed" : {
-                                    "currentValue" : speed_kmh,
-                                },
-                                "gpsAccuracy" : {
-                                    "currentValue" : gps_accuracy_m,
-                                },
-                                "ignitionOn" : {
-                                    "currentValue" : ignition_on,
-                                },
-                                "deviceRunHours" : {
-                                    "currentValue" : device_run_hours,
-                                },
-                                "deviceOdometer" : {
-                                    "currentValue" : device_odometer,
-                                },
-                                "sysVoltage" : {
-                                    "currentValue" : sys_voltage,
-                                },
-                                "battVoltage" : {
-                                    "currentValue" : batt_voltage,
-                                },
-                                "dataSignalStrength" : {
-                                    "currentValue" : data_signal_strength,
-                                },
-                                "deviceTemp" : {
-                                    "currentValue" : device_temp,
-                                },
-                                "lastUplinkReason" : {
-                                    "currentValue" : self.uplink_reason_translate(device_uplink_reason),
-                                },
-                                "deviceTimeUtc" : {
-                                    "currentValue" : device_time_utc,
-                                },
-                            }
-                        }
-                    }),
-                    save_log=True
-                )
+    def publish_all(self, publishes):
+        ## publishes is a list of (channel, msg_str, save_log) tuples
+        ## These are sent concurrently unless disabled with "concurrent_publish" : false
+        ## Buffered publishes are only queued here, so they skip the event loop
+        concurrent = self.get_package_config('concurrent_publish', True) and not self.is_buffered_publish()
 
-    def uplink_reason_translate(self, reason_code):
-        reasons = {
-            0 :	'Reserved',
-            1 :	'Start of trip',
-            2 :	'End of trip',
-            3 :	'Elapsed time',
-            4 :	'Speed change',
-            5 :	'Heading change',
-            6 :	'Distance travelled',
-            7 :	'Maximum Speed',
-            8 :	'Stationary',
-            9 :	'Ignition Changed',
-            10 : 'Output Changed',
-            11 : 'Heartbeat',
-            12 : 'Harsh Brake ',
-            13 : 'Harsh Acceleration',
-            14 : 'Harsh Cornering',
-            15 : 'External Power Change  ',
-            16 : 'System Power Monitoring',
-            17 : 'Driver ID Tag Read',
-            18 : 'Over speed',
-            19 : 'Fuel sensor record',
-            20 : 'Towing Alert',
-            21 : 'Debug',
-            22 : 'SDI-12 sensor data',
-            23 : 'Accident',
-            24 : 'Accident Data',
-            25 : 'Sensor value elapsed time',
-            26 : 'Sensor value change',
-            27 : 'Sensor alarm',
-            28 : 'Rain Gauge Tipped',
-            29 : 'Tamper Alert',
-            30 : 'BLOB notification',
-            31 : 'Time and Attendance',
-            32 : 'Trip Restart',
-            33 : 'Tag Gained',
-            34 : 'Tag Update',
-            35 : 'Tag Lost',
-            36 : 'Recovery Mode On',
-            37 : 'Recovery Mode Off',
-            38 : 'Immobiliser On',
-            39 : 'Immobiliser Off',
-            40 : 'Garmin FMI Stop Response ',
-            41 : 'Lone Worker Alarm',
-            42 : 'Device Counters',
-            43 : 'Connected Device Data',
-            44 : 'Entered Geo-Fence ',
-            45 : 'Exited Geo-Fence ',
-            46 : 'High-G Event',
-            47 : 'Third party data record',
-            48 : 'Duress',
-            49 : 'Cell Tower Connection',
-            50 : 'Bluetooth Tag Data',
-        }
+        try:
+            asyncio.get_running_loop()
+            loop_running = True
+        except RuntimeError:
+            loop_running = False
+
+        if not concurrent or loop_running or len(publishes) < 2:
+            for ch, msg_str, save_log in publishes:
+                self.publish_to_channel(ch, msg_str, save_log=save_log)
+            return
 
-        if reason_code in reasons:
-            return reasons[reason_code]
-        else:
-            return "Unknown reason"
+        ## The thread's event loop is kept between calls and invocations, so the async client's
+        ## pooled session and its connections are reused by warm invocations
+        pd.run_coroutine(self.publish_all_async(publishes))
+
+    async def publish_all_async(self, publishes):
+        tasks = []
+        for ch, msg_str, save_log in publishes:
+            async_ch = await self.async_cli.get_channel(
+                channel_id=ch.channel_id,
+                channel_name=ch.channel_name,
+                agent_id=ch.agent_id,
+            )
+            async_ch.channel_id_cached = ch.channel_id_cached
+            tasks.append( self.timed_async_publish(async_ch, msg_str, save_log) )
 
+        await asyncio.gather(*tasks)
 
-    def create_doover_client(self):
-        self.cli = pd.doover_iface(
-            agent_id=self.kwargs['agent_id'],
-            access_token=self.kwargs['access_token'],
-            endpoint=self.kwargs['api_endpoint'],
-        )
+    async def timed_async_publish(self, async_ch, msg_str, save_log):
+        start = time.perf_counter()
+        try:
+            return await async_ch.publish(msg_str=msg_str, save_log=save_log, retry_safe=self.is_retry_safe(async_ch))
+        finally:
+            self.get_metrics().add_phase_time("publish:" + str(async_ch.channel_name), time.perf_counter() - start)
 
     def get_agent_settings(self, filter_key=None):
         output = None
@@ -598,19 +893,67 @@ class target:
             output = self.kwargs['agent_settings']['deployment_config']
 
         if filter_key is not None and output is not None:
-            if filter_key in output:
-                output = output[filter_key]
+            output = output.get(filter_key)
             
         return output
 
-    def add_to_log(self, msg):
-        if not hasattr(self, '_log'):
-            self._log = ""
-        self._log = self._log + str(msg) + "\n"
+    def get_loggable_kwargs(self):
+        ## The access token is never logged, and large payloads are cut down by the log's entry cap
+        output = dict(self.kwargs)
+        if 'access_token' in output and output['access_token'] is not None:
+            output['access_token'] = "***"
+        output.pop('doover_client', None)
+        return output
 
-    def complete_log(self):
-        if hasattr(self, '_log') and self._log is not None:
-            log_channel = self.cli.get_channel( channel_id=self.kwargs['log_channel'] )
+    def get_log(self):
+        if not hasattr(self, '_log') or self._log is None:
+            ## Optional log settings can be supplied in the package config
+            ## e.g. "log" : { "level" : "INFO", "max_entry_length" : 4000, "flush_batch_size" : 50 }
+            log_config = self.get_package_config('log', {})
+
+            flush_callback = None
+            if self.kwargs.get('log_channel') is not None:
+                flush_callback = self.publish_log
+
+            self._log = task_log.task_log(
+                level=log_config.get('level', "INFO"),
+                max_entries=log_config.get('max_entries', 1000),
+                max_entry_length=log_config.get('max_entry_length', 4000),
+                max_total_length=log_config.get('max_total_length', 256000),
+                flush_callback=flush_callback,
+                flush_batch_size=log_config.get('flush_batch_size'),
+            )
+        return self._log
+
+    def get_log_text(self):
+        return self.get_log().get_text()
+
+    def add_to_log(self, msg, level="INFO"):
+        self.get_log().add(msg, level=level)
+
+    def publish_log(self, text):
+        if not hasattr(self, 'cli'):
+            raise Exception("Doover client not created - cannot publish log")
+        log_channel = self.cli.get_channel( channel_id=self.kwargs['log_channel'] )
+        with self.timed("log_publish"):
             log_channel.publish(
-                msg_str=self._log
+                msg_str=text
             )
+
+    def complete_log(self):
+        ## Buffered publishes are sent first so that any failures make it into the log
+        self.flush_publishes(close=True)
+
+        ## The metrics summary is logged as a single json line before the final flush,
+        ## and passed to any metrics hooks once the flush has been timed too
+        metrics = self.get_metrics()
+        self.add_to_log( "Invocation metrics = " + json.dumps(metrics.get_summary()) )
+
+        if hasattr(self, '_log') and self._log is not None:
+            with self.timed("log_flush"):
+                self._log.flush()
+
+        metrics.emit()
+
+        if self.kwargs.get('doover_client') is not None:
+            self.cli.api_client.bind_metrics(None)
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+
+## Bounded log for a single processor invocation
+
+## Entries are held in a ring buffer capped by entry count and total size, and each entry
+## is truncated to a maximum length, so large multi-record uplinks cannot grow the log
+## without bound. When a flush_callback is given, pending entries can be flushed in
+## batches while processing is still running, so that a timed out invocation still
+## leaves most of its log behind.
+
+from collections import deque
+
+
+LOG_LEVELS = {
+    "DEBUG" : 10,
+    "INFO" : 20,
+    "WARNING" : 30,
+    "ERROR" : 40,
+}
+
+
+def truncate(msg, max_length):
+    if max_length is None or len(msg) <= max_length:
+        return msg
+    return msg[:max_length] + "... [truncated " + str(len(msg) - max_length) + " chars]"
+
+
+class task_log:
+
+    def __init__(
+            self,
+            level="INFO",
+            max_entries=1000,
+            max_entry_length=4000,
+            max_total_length=256000,
+            flush_callback=None,
+            flush_batch_size=None,
+        ):
+
+        self.level = LOG_LEVELS.get(str(level).upper(), LOG_LEVELS["INFO"])
+
+        self.max_entries = max_entries
+        self.max_entry_length = max_entry_length
+        self.max_total_length = max_total_length
+
+        ## flush_callback is called with the text of each batch of flushed entries
+        self.flush_callback = flush_callback
+        self.flush_batch_size = flush_batch_size
+
+        self.entries = deque()
+        self.total_length = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.level_counts = {}
+
+        ## Kept apart from the entries, which may since have been flushed or dropped
+        self.first_error = None
+
+    def is_enabled_for(self, level):
+        return LOG_LEVELS.get(level, LOG_LEVELS["INFO"]) >= self.level
+
+    def add(self, msg, level="INFO"):
+        self.level_counts[level] = self.level_counts.get(level, 0) + 1
+        if level == "ERROR" and self.first_error is None:
+            self.first_error = truncate(str(msg), self.max_entry_length)
+        if not self.is_enabled_for(level):
+            return
+
+        entry = truncate(str(msg), self.max_entry_length)
+        if level != "INFO":
+            entry = level + " - " + entry
+
+        self.entries.append(entry)
+        self.total_length += len(entry) + 1
+
+        ## Drop the oldest unflushed entries once over either cap
+        while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.total_length > self.max_total_length):
+            dropped = self.entries.popleft()
+            self.total_length -= len(dropped) + 1
+            self.dropped += 1
+
+        if self.flush_batch_size is not None and len(self.entries) >= self.flush_batch_size:
+            try:
+                self.flush()
+            except Exception:
+                ## Logging must never stop processing - keep the entries for the final flush
+                self.flush_batch_size = None
+
+    def debug(self, msg):
+        self.add(msg, level="DEBUG")
+
+    def info(self, msg):
+        self.add(msg, level="INFO")
+
+    def warning(self, msg):
+        self.add(msg, level="WARNING")
+
+    def error(self, msg):
+        self.add(msg, level="ERROR")
+
+    def has_pending(self):
+        return len(self.entries) > 0 or self.dropped > 0
+
+    def get_text(self):
+        lines = []
+        if self.dropped > 0:
+            lines.append("... " + str(self.dropped) + " earlier log entries dropped")
+        lines.extend(self.entries)
+        if len(lines) == 0:
+            return ""
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        ## Hands any pending entries to flush_callback and clears them
+        if self.flush_callback is None or not self.has_pending():
+            return False
+
+        text = self.get_text()
+        self.flush_callback(text)
+
+        self.flushed += len(self.entries)
+        self.entries.clear()
+        self.total_length = 0
+        self.dropped = 0
+        return True
@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+
+## Track reduction for the location channel
+
+## Picks which decoded records have their position published to the location channel.
+## Points are first thinned with minimum distance and time thresholds, measured from the
+## last point kept (including the last point kept by an earlier invocation in this process),
+## and the rest are then simplified with Douglas-Peucker to within a tolerance in metres.
+##
+## Records with a reason in keep_reasons are always kept - by default start and end of
+## trip (1 / 2) and entering and exiting a geofence (44 / 45). The newest point of a batch
+## is also kept unless it is within min_distance_m of the last kept point, so the location
+## aggregate stays current.
+##
+## Configured in the package config e.g.
+##
+##   "track_reduction" : {
+##       "enabled" : true,
+##       "min_distance_m" : 25,
+##       "min_interval_s" : 30,
+##       "simplify_tolerance_m" : 10,
+##       "keep_reasons" : [1, 2, 44, 45]
+##   }
+
+import math, time, threading
+
+import geo
+
+
+DEFAULT_KEEP_REASONS = (1, 2, 44, 45)
+
+
+## Process level record of the last point kept for each agent, so that thresholds
+## carry across invocations in a warm container
+class last_point_cache:
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, agent_id):
+        with self.lock:
+            entry = self.entries.get(str(agent_id))
+            if entry is None:
+                return None
+            if time.time() - entry['cached_at'] > self.ttl:
+                del self.entries[str(agent_id)]
+                return None
+            return entry
+
+    def set(self, agent_id, position, timestamp):
+        with self.lock:
+            self.entries[str(agent_id)] = {
+                'position' : position,
+                'timestamp' : timestamp,
+                'cached_at' : time.time(),
+            }
+
+    def invalidate(self, agent_id=None):
+        with self.lock:
+            if agent_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(str(agent_id), None)
+
+
+_last_point_cache = last_point_cache()
+
+
+def get_last_point_cache():
+    return _last_point_cache
+
+
+def cross_track_distance_m(point, start, end):
+    ## Distance in metres from point to the segment start -> end, using a local flat
+    ## projection around start which is accurate enough over the length of a segment
+    scale_long = math.cos(math.radians(start['lat']))
+    metres_per_degree = math.pi * geo.EARTH_RADIUS_M / 180
+
+    def project(p):
+        return (
+            (p['long'] - start['long']) * scale_long * metres_per_degree,
+            (p['lat'] - start['lat']) * metres_per_degree,
+        )
+
+    px, py = project(point)
+    ex, ey = project(end)
+
+    length_sq = ex * ex + ey * ey
+    if length_sq == 0:
+        return math.hypot(px, py)
+
+    t = max(0.0, min(1.0, (px * ex + py * ey) / length_sq))
+    return math.hypot(px - t * ex, py - t * ey)
+
+
+def douglas_peucker(positions, tolerance_m):
+    ## Returns the indexes of positions kept, always including the first and last
+    if len(positions) < 3:
+        return list(range(len(positions)))
+
+    keep = [False] * len(positions)
+    keep[0] = True
+    keep[-1] = True
+
+    stack = [(0, len(positions) - 1)]
+    while stack:
+        first, last = stack.pop()
+        max_distance = -1
+        max_index = None
+        for i in range(first + 1, last):
+            distance = cross_track_distance_m(positions[i], positions[first], positions[last])
+            if distance > max_distance:
+                max_distance = distance
+                max_index = i
+
+        if max_index is not None and max_distance > tolerance_m:
+            keep[max_index] = True
+            stack.append((first, max_index))
+            stack.append((max_index, last))
+
+    return [i for i in range(len(positions)) if keep[i]]
+
+
+class track_reducer:
+
+    def __init__(
+            self,
+            agent_id=None,
+            min_distance_m=None,
+            min_interval_s=None,
+            simplify_tolerance_m=None,
+            keep_reasons=None,
+            cache=None,
+        ):
+
+        self.agent_id = agent_id
+        self.min_distance_m = min_distance_m
+        self.min_interval_s = min_interval_s
+        self.simplify_tolerance_m = simplify_tolerance_m
+        self.keep_reasons = set(DEFAULT_KEEP_REASONS if keep_reasons is None else keep_reasons)
+        self.cache = cache or _last_point_cache
+
+    def is_protected(self, decoded):
+        return decoded.device_uplink_reason in self.keep_reasons
+
+    def too_close(self, position, timestamp, last_position, last_timestamp):
+        if last_position is None:
+            return False
+        if self.min_distance_m and geo.position_distance_m(position, last_position) < self.min_distance_m:
+            return True
+        if self.min_interval_s and timestamp is not None and last_timestamp is not None:
+            if timestamp - last_timestamp < self.min_interval_s:
+                return True
+        return False
+
+    def reduce(self, decoded_records):
+        ## Returns the decoded records whose position should be published, oldest first
+        with_position = [d for d in decoded_records if d.position is not None]
+        if len(with_position) == 0:
+            return []
+
+        ## DateUTC strings sort in time order, and the sort is stable for equal times
+        ordered = sorted( with_position, key=lambda d: d.device_time_utc or "" )
+        timestamps = [geo.parse_timestamp(d.device_time_utc) for d in ordered]
+
+        last_position = None
+        last_timestamp = None
+        last_point = None
+        if self.agent_id is not None:
+            last_point = self.cache.get(self.agent_id)
+        if last_point is not None:
+            last_position = last_point['position']
+            last_timestamp = last_point['timestamp']
+
+        ## Minimum distance and time thresholds
+        candidates = []
+        protected = set()
+        newest = len(ordered) - 1
+        for i, decoded in enumerate(ordered):
+            if self.is_protected(decoded):
+                protected.add(len(candidates))
+            elif self.too_close(decoded.position, timestamps[i], last_position, last_timestamp):
+                ## The newest point is still kept when only the time threshold drops it,
+                ## so that the location aggregate ends on the current position
+                if i != newest or self.too_close(decoded.position, None, last_position, None):
+                    continue
+
+            candidates.append(i)
+            last_position = decoded.position
+            last_timestamp = timestamps[i]
+
+        ## Douglas-Peucker between each pair of protected points, which are never simplified away
+        kept = candidates
+        if self.simplify_tolerance_m and len(candidates) > 2:
+            anchors = sorted( set([0, len(candidates) - 1]) | protected )
+            kept_indexes = set(anchors)
+            for start, end in zip(anchors[:-1], anchors[1:]):
+                positions = [ordered[candidates[j]].position for j in range(start, end + 1)]
+                for j in douglas_peucker(positions, self.simplify_tolerance_m):
+                    kept_indexes.add(start + j)
+            kept = [candidates[j] for j in sorted(kept_indexes)]
+
+        result = [ordered[i] for i in kept]
+
+        if self.agent_id is not None and len(result) > 0:
+            self.cache.set(self.agent_id, result[-1].position, geo.parse_timestamp(result[-1].device_time_utc))
+
+        return result
+
+    def invalidate(self):
+        if self.agent_id is not None:
+            self.cache.invalidate(self.agent_id)
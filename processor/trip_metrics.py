@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+
+## Incremental trip metrics
+
+## Derived per device metrics - distance, engine on time, idle time, max speed and harsh
+## event counts - for the current trip, the last completed trip and the device's lifetime.
+## They are updated in O(1) per decoded record from a small state object, which is persisted
+## in the aggregate of a channel (trip_metrics by default), so nothing ever has to rescan the
+## location or ui_state history. The aggregate is read on every invocation rather than cached
+## in the process, so a warm container never publishes over totals that another container
+## has since advanced.
+##
+## Each interval between two records is credited using the state at the start of it - the
+## engine was on for the interval if the ignition was on at the earlier record, and idle if
+## it was also at or below idle_speed_kmh. Intervals longer than max_gap_s (e.g. the device
+## was out of coverage or powered down) are not credited. Distance is the odometer delta
+## where the device reports one, falling back to the GPS distance between the two records.
+##
+## A trip starts on a start of trip record (reason 1) or the ignition turning on, and ends
+## on an end of trip record (reason 2), the ignition turning off or the next trip starting.
+##
+## Records at or before the last one applied are resends of records already counted, and are
+## ignored. When the record index has already dropped duplicates (deduplicated=True), older
+## records are known to be new, and count towards harsh events and max speed only.
+##
+## Configured in the package config e.g.
+##
+##   "trip_metrics" : {
+##       "enabled" : true,
+##       "channel" : "trip_metrics",
+##       "idle_speed_kmh" : 1,
+##       "max_gap_s" : 3600
+##   }
+
+import geo
+
+
+TRIP_START_REASON = 1
+TRIP_END_REASON = 2
+
+## Harsh event reason codes -> the counter they increment
+HARSH_REASONS = {
+    12 : 'harsh_brake',
+    13 : 'harsh_acceleration',
+    14 : 'harsh_cornering',
+}
+
+## The fastest a vehicle is assumed to travel, used to reject odometer jumps e.g. an offset change
+MAX_PLAUSIBLE_SPEED_KMH = 250
+
+
+def new_counters():
+    return {
+        'distance_km' : 0.0,
+        'engine_on_s' : 0.0,
+        'idle_s' : 0.0,
+        'max_speed_kmh' : 0.0,
+        'harsh_brake' : 0,
+        'harsh_acceleration' : 0,
+        'harsh_cornering' : 0,
+    }
+
+
+def new_state():
+    return {
+        'trip' : None,          ## counters of the current trip, with 'started_at', or None
+        'last_trip' : None,     ## counters of the last completed trip, with 'started_at' and 'ended_at'
+        'totals' : new_counters(),
+        'last' : None,          ## the last record applied - time, odometer, position, ignition_on, speed_kmh
+    }
+
+
+def load_state(aggregate):
+    ## Builds the state from the channel aggregate, which may be empty or hold anything else
+    state = new_state()
+    if not isinstance(aggregate, dict):
+        return state
+
+    for key in state:
+        if key in aggregate:
+            state[key] = aggregate[key]
+
+    if not isinstance(state['totals'], dict):
+        state['totals'] = new_counters()
+    for key, value in new_counters().items():
+        state['totals'].setdefault(key, value)
+
+    return state
+
+
+def get_interval_distance_km(last, odometer, position, interval_s):
+    if odometer is not None and last.get('odometer') is not None:
+        distance = odometer - last['odometer']
+        if 0 <= distance <= max(1.0, interval_s / 3600 * MAX_PLAUSIBLE_SPEED_KMH):
+            return distance
+
+    if position is not None and last.get('position') is not None:
+        try:
+            return geo.position_distance_m(position, last['position']) / 1000
+        except (KeyError, TypeError):
+            pass
+
+    return 0.0
+
+
+def add_interval(counters, interval_s, distance_km, engine_on, idle):
+    counters['distance_km'] += distance_km
+    if engine_on:
+        counters['engine_on_s'] += interval_s
+        if idle:
+            counters['idle_s'] += interval_s
+
+
+def add_event(counters, speed_kmh, reason):
+    if speed_kmh is not None and speed_kmh > counters['max_speed_kmh']:
+        counters['max_speed_kmh'] = speed_kmh
+    counter = HARSH_REASONS.get(reason)
+    if counter is not None:
+        counters[counter] += 1
+
+
+class trip_metrics:
+
+    def __init__(self, agent_id, idle_speed_kmh=1, max_gap_s=3600):
+        self.agent_id = agent_id
+        self.idle_speed_kmh = idle_speed_kmh
+        self.max_gap_s = max_gap_s
+
+    def get_state(self, trip_metrics_channel):
+        return load_state( trip_metrics_channel.get_aggregate() )
+
+    def start_trip(self, state, timestamp):
+        ## A start while a trip is open (e.g. the end of trip record was lost) closes that trip
+        ## first, so its counters become the last trip rather than being dropped
+        self.end_trip(state, timestamp)
+        state['trip'] = new_counters()
+        state['trip']['started_at'] = timestamp
+
+    def end_trip(self, state, timestamp):
+        if state['trip'] is None:
+            return
+        state['trip']['ended_at'] = timestamp
+        state['last_trip'] = state['trip']
+        state['trip'] = None
+
+    def apply(self, state, decoded, deduplicated=False):
+        ## Updates state with one decoded record
+        timestamp = geo.parse_timestamp(decoded.device_time_utc)
+        last = state['last']
+        reason = decoded.device_uplink_reason
+
+        if last is not None and last.get('time') is not None:
+            ## Without a time the record cannot be placed, so it may be a resend
+            if timestamp is None:
+                return
+
+            if timestamp == last['time'] or (timestamp < last['time'] and not deduplicated):
+                return
+
+            ## Records known to be new but out of order can only add events, not intervals
+            ## or trip boundaries
+            if timestamp < last['time']:
+                add_event(state['totals'], decoded.speed_kmh, reason)
+                if state['trip'] is not None:
+                    add_event(state['trip'], decoded.speed_kmh, reason)
+                return
+
+        if last is not None and timestamp is not None and last.get('time') is not None:
+            interval_s = timestamp - last['time']
+            if interval_s <= self.max_gap_s:
+                distance_km = get_interval_distance_km(last, decoded.device_odometer, decoded.position, interval_s)
+                engine_on = last.get('ignition_on') is True
+                idle = engine_on and (last.get('speed_kmh') or 0) <= self.idle_speed_kmh
+                add_interval(state['totals'], interval_s, distance_km, engine_on, idle)
+                if state['trip'] is not None:
+                    add_interval(state['trip'], interval_s, distance_km, engine_on, idle)
+
+        ## Trip boundaries
+        was_on = last.get('ignition_on') if last is not None else None
+        if reason == TRIP_START_REASON or (decoded.ignition_on is True and was_on is False and state['trip'] is None):
+            self.start_trip(state, timestamp)
+
+        add_event(state['totals'], decoded.speed_kmh, reason)
+        if state['trip'] is not None:
+            add_event(state['trip'], decoded.speed_kmh, reason)
+
+        if reason == TRIP_END_REASON or (decoded.ignition_on is False and was_on is True):
+            self.end_trip(state, timestamp)
+
+        ## Values the record does not carry are kept from the last record
+        new_last = dict(last or {})
+        new_last['time'] = timestamp if timestamp is not None else new_last.get('time')
+        for key, value in (
+                ('odometer', decoded.device_odometer),
+                ('position', decoded.position),
+                ('ignition_on', decoded.ignition_on),
+                ('speed_kmh', decoded.speed_kmh),
+            ):
+            if value is not None:
+                new_last[key] = value
+        state['last'] = new_last
+
+    def update(self, decoded_records, trip_metrics_channel, deduplicated=False):
+        ## Applies the records to the state in the channel aggregate and returns the state to publish
+        ## An empty aggregate starts a fresh state, while an error reading it is raised
+        return self.apply_records(self.get_state(trip_metrics_channel), decoded_records, deduplicated=deduplicated)
+
+    def apply_records(self, state, decoded_records, deduplicated=False):
+        ## Applies the records oldest first, updating state in place and returning it
+        ## deduplicated is True when the records have been through the record index
+        for decoded in sorted( decoded_records, key=lambda d: d.device_time_utc or "" ):
+            self.apply(state, decoded, deduplicated=deduplicated)
+        return state
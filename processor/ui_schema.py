@@ -0,0 +1,309 @@
+#!/usr/bin/python3
+
+## The ui_state schema published on DEPLOY
+
+## The schema is built and serialised once per process. Its hash is published inside the
+## state as "schemaHash", so a redeploy can compare against the ui_state aggregate and skip
+## publishing the schema again when it has not changed. Keeping it inside the state means
+## resetting ui_state with {"state" : null} also clears the hash.
+
+import json, hashlib, threading
+
+
+def build_ui_schema():
+
+    return {
+        "state" : {
+            "type" : "uiContainer",
+            "displayString" : "",
+            "children" : {
+                "location" : {
+                    "type" : "uiVariable",
+                    "varType" : "location",
+                    "hide" : True,
+                    "name" : "location",
+                    "displayString" : "Location",
+                },
+                "sensorReading" : {
+                    "type" : "uiVariable",
+                    "varType" : "float",
+                    "name" : "sensorReading",
+                    "displayString" : "Sensor Reading",
+                    "decPrecision": 1,
+                    "form": "radialGauge",
+                    "ranges": [
+                        {
+                            "label" : "Low",
+                            "min" : 0,
+                            "max" : 20,
+                            "colour" : "blue",
+                            "showOnGraph" : True
+                        },
+                        {
+                            # "label" : "Ok",
+                            "min" : 20,
+                            "max" : 80,
+                            "colour" : "green",
+                            "showOnGraph" : True
+                        },
+                        {
+                            "label" : "Fast",
+                            "min" : 80,
+                            "max" : 120,
+                            "colour" : "yellow",
+                            "showOnGraph" : True
+                        }
+                    ]
+                },
+                "gpsAccuracy" : {
+                    "type" : "uiVariable",
+                    "varType" : "float",
+                    "name" : "gpsAccuracy",
+                    "displayString" : "GPS accuracy (m)",
+                    "decPrecision": 0,
+                    "ranges": [
+                        {
+                            "label" : "Good",
+                            "min" : 0,
+                            "max" : 15,
+                            "colour" : "green",
+                            "showOnGraph" : True
+                        },
+                        {
+                            "label" : "Ok",
+                            "min" : 15,
+                            "max" : 30,
+                            "colour" : "blue",
+                            "showOnGraph" : True
+                        },
+                        {
+                            "label" : "Bad",
+                            "min" : 30,
+                            "max" : 80,
+                            "colour" : "yellow",
+                            "showOnGraph" : True
+                        },
+                        {
+                            "label" : "Lost",
+                            "min" : 80,
+                            "max" : 100,
+                            "colour" : "red",
+                            "showOnGraph" : True
+                        }
+                    ]
+                },
+                "ignitionOn" : {
+                    "type" : "uiVariable",
+                    "varType" : "bool",
+                    "name" : "ignitionOn",
+                    "displayString" : "Ignition On",
+                },
+                "deviceRunHours" : {
+                    "type" : "uiVariable",
+                    "varType" : "float",
+                    "name" : "deviceRunHours",
+                    "displayString" : "Machine Hours (hrs)",
+                    "decPrecision": 2,
+                },
+                "deviceOdometer" : {
+                    "type" : "uiVariable",
+                    "varType" : "float",
+                    "name" : "deviceOdometer",
+                    "displayString" : "Machine Odometer (km)",
+                    "decPrecision": 1,
+                },
+                "sysVoltage" : {
+                    "type" : "uiVariable",
+                    "varType" : "float",
+                    "name" : "sysVoltage",
+                    "displayString" : "System Voltage (V)",
+                    "decPrecision": 1,
+                    "ranges": [
+                        {
+                            "label" : "Low",
+                            "min" : 9,
+                            "max" : 11.5,
+                            "colour" : "yellow",
+                            "showOnGraph" : True
+                        },
+                        {
+                            # "label" : "Ok",
+                            "min" : 11.5,
+                            "max" : 13.0,
+                            "colour" : "blue",
+                            "showOnGraph" : True
+                        },
+                        {
+                            "label" : "Charging",
+                            "min" : 13.0,
+                            "max" : 14.2,
+                            "colour" : "green",
+                            "showOnGraph" : True
+                        },
+                        {
+                            "label" : "Over Voltage",
+                            "min" : 14.2,
+                            "max" : 15.0,
+                            "colour" : "yellow",
+                            "showOnGraph" : True
+                        }
+                    ]
+                },
+                "battVoltage" : {
+                    "type" : "uiVariable",
+                    "varType" : "float",
+                    "name" : "battVoltage",
+                    "displayString" : "Tracker Battery (V)",
+                    "decPrecision": 1,
+                    "ranges": [
+                        {
+                            "label" : "Low",
+                            "min" : 3.0,
+                            "max" : 3.5,
+                            "colour" : "yellow",
+                            "showOnGraph" : True
+                        },
+                        {
+                            # "label" : "Ok",
+                            "min" : 3.5,
+                            "max" : 3.8,
+                            "colour" : "blue",
+                            "showOnGraph" : True
+                        },
+                        {
+                            "label" : "Good",
+                            "min" : 3.8,
+                            "max" : 4.2,
+                            "colour" : "green",
+                            "showOnGraph" : True
+                        },
+                        {
+                            "label" : "Over Voltage",
+                            "min" : 4.2,
+                            "max" : 4.5,
+                            "colour" : "yellow",
+                            "showOnGraph" : True
+                        }
+                    ]
+                },
+                "dataSignalStrength" : {
+                    "type" : "uiVariable",
+                    "varType" : "float",
+                    "name" : "dataSignalStrength",
+                    "displayString" : "Cellular Signal (%)",
+                    "decPrecision": 0,
+                    "ranges": [
+                        {
+                            "label" : "Low",
+                            "min" : 0,
+                            "max" : 30,
+                            "colour" : "yellow",
+                            "showOnGraph" : True
+                        },
+                        {
+                            "label" : "Ok",
+                            "min" : 30,
+                            "max" : 60,
+                            "colour" : "blue",
+                            "showOnGraph" : True
+                        },
+                        {
+                            "label" : "Strong",
+                            "min" : 60,
+                            "max" : 100,
+                            "colour" : "green",
+                            "showOnGraph" : True
+                        }
+                    ]
+                },
+                "deviceTemp" : {
+                    "type" : "uiVariable",
+                    "varType" : "float",
+                    "name" : "deviceTemp",
+                    "displayString" : "Device Temperature (C)",
+                    "decPrecision": 0,
+                    "ranges": [
+                        {
+                            "label" : "Low",
+                            "min" : 0,
+                            "max" : 20,
+                            "colour" : "blue",
+                            "showOnGraph" : True
+                        },
+                        {
+                            # "label" : "Ok",
+                            "min" : 20,
+                            "max" : 35,
+                            "colour" : "green",
+                            "showOnGraph" : True
+                        },
+                        {
+                            "label" : "Warm",
+                            "min" : 35,
+                            "max" : 50,
+                            "colour" : "yellow",
+                            "showOnGraph" : True
+                        }
+                    ]
+                },
+                "lastUplinkReason" : {
+                    "type" : "uiVariable",
+                    "varType" : "text",
+                    "name" : "lastUplinkReason",
+                    "displayString" : "Reason for uplink",
+                },
+                "deviceTimeUtc" : {
+                    "type" : "uiVariable",
+                    "varType" : "datetime",
+                    "name" : "deviceTimeUtc",
+                    "displayString" : "Device Time (UTC)",
+                },
+                "node_connection_info": {
+                    "type": "uiConnectionInfo",
+                    "name": "node_connection_info",
+                    "connectionType": "periodic",
+                    # "connectionPeriod": 1800,
+                    # "nextConnection": 1800
+                    "connectionPeriod": 600,
+                    "nextConnection": 600,
+                }
+            }
+        }
+    }
+
+
+def hash_schema(ui_obj):
+    ## Key order does not change the hash
+    canonical = json.dumps(ui_obj, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()[:16]
+
+
+class ui_schema:
+
+    def __init__(self, ui_obj):
+        self.ui_obj = ui_obj
+        self.schema_hash = hash_schema(ui_obj)
+
+        msg = dict(ui_obj)
+        msg['state'] = dict(ui_obj['state'])
+        msg['state']['schemaHash'] = self.schema_hash
+        self.msg_str = json.dumps(msg)
+
+    def is_deployed(self, aggregate):
+        ## True when the ui_state aggregate already holds this schema, with its children
+        if not isinstance(aggregate, dict) or not isinstance(aggregate.get('state'), dict):
+            return False
+        state = aggregate['state']
+        return state.get('schemaHash') == self.schema_hash and bool(state.get('children'))
+
+
+_ui_schema = None
+_ui_schema_lock = threading.Lock()
+
+
+def get_ui_schema():
+    global _ui_schema
+    with _ui_schema_lock:
+        if _ui_schema is None:
+            _ui_schema = ui_schema(build_ui_schema())
+        return _ui_schema
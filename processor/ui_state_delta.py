@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+
+## Delta-only ui_state publishing
+
+## The last published currentValue of every ui_state child is kept per agent in a process
+## level cache. It is seeded from the ui_state channel aggregate at most once per cache_ttl,
+## and each new ui_state message is then reduced to only the
+## children that have changed since. Numeric children only count as changed once they move
+## by more than their deadband, and location once it moves by more than its deadband in metres.
+##
+## Passive children (the device time and uplink reason) change on every record, so they are
+## sent along with any other change but never cause a publish on their own. A heartbeat from
+## a parked vehicle therefore publishes nothing at all.
+##
+## Every child, including booleans like ignitionOn and strings like displayString, is compared
+## against the cache rather than the aggregate. If another container or a UI command changes
+## the aggregate, a value this container believes is already published is not resent until
+## its cache entry expires. The default cache_ttl is kept short (60s) to bound that window,
+## at the cost of one aggregate read per agent per minute.
+##
+## Configured in the package config e.g.
+##
+##   "ui_state_delta" : {
+##       "enabled" : true,
+##       "cache_ttl" : 60,
+##       "full_refresh_s" : 3600,
+##       "deadbands" : { "sysVoltage" : 0.1, "dataSignalStrength" : 1 }
+##   }
+
+import time, threading
+
+import geo
+
+
+DEFAULT_DEADBANDS = {
+    'location' : 10,            ## metres
+    'speed' : 1,                ## km/h
+    'gpsAccuracy' : 5,          ## metres
+    'deviceRunHours' : 0.01,    ## hours
+    'deviceOdometer' : 0.1,     ## km
+    'sysVoltage' : 0.1,         ## V
+    'battVoltage' : 0.05,       ## V
+    'dataSignalStrength' : 1,   ## %
+    'deviceTemp' : 1,           ## C
+}
+
+DEFAULT_PASSIVE_CHILDREN = ('deviceTimeUtc', 'lastUplinkReason')
+
+## The top level keys of the ui_state "state" object that are compared as-is
+STATE_KEYS = ('displayString', 'statusIcon')
+
+
+class ui_state_cache:
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, agent_id, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            entry = self.entries.get(str(agent_id))
+            if entry is None:
+                return None
+            if time.time() - entry['loaded_at'] > ttl:
+                del self.entries[str(agent_id)]
+                return None
+            return entry
+
+    def set(self, agent_id, state, values):
+        now = time.time()
+        with self.lock:
+            self.entries[str(agent_id)] = {
+                'state' : dict(state),
+                'values' : dict(values),
+                'loaded_at' : now,
+                'full_at' : now,
+            }
+
+    def update(self, agent_id, state, values, full=False):
+        with self.lock:
+            entry = self.entries.get(str(agent_id))
+            if entry is None:
+                return
+            entry['state'].update(state)
+            entry['values'].update(values)
+            if full:
+                entry['full_at'] = time.time()
+
+    def invalidate(self, agent_id=None):
+        with self.lock:
+            if agent_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(str(agent_id), None)
+
+
+_ui_state_cache = ui_state_cache()
+
+
+def get_ui_state_cache():
+    return _ui_state_cache
+
+
+def invalidate_ui_state_cache(agent_id=None):
+    _ui_state_cache.invalidate(agent_id)
+
+
+def split_ui_state(msg):
+    ## Returns the top level state values and the currentValue of every child
+    ## from either a ui_state message or the ui_state channel aggregate
+    state = {}
+    values = {}
+    if not isinstance(msg, dict) or not isinstance(msg.get('state'), dict):
+        return state, values
+
+    for key in STATE_KEYS:
+        if key in msg['state']:
+            state[key] = msg['state'][key]
+
+    children = msg['state'].get('children') or {}
+    for name, child in children.items():
+        if isinstance(child, dict) and 'currentValue' in child:
+            values[name] = child['currentValue']
+
+    return state, values
+
+
+def value_changed(name, new_value, old_value, deadbands):
+    if new_value is None or old_value is None:
+        return new_value is not old_value
+
+    deadband = deadbands.get(name)
+    if not deadband:
+        return new_value != old_value
+
+    if isinstance(new_value, dict) and isinstance(old_value, dict):
+        try:
+            return geo.position_distance_m(new_value, old_value) > deadband
+        except (KeyError, TypeError):
+            return new_value != old_value
+
+    if isinstance(new_value, bool) or isinstance(old_value, bool):
+        return new_value != old_value
+
+    try:
+        return abs(new_value - old_value) > deadband
+    except TypeError:
+        return new_value != old_value
+
+
+class ui_state_delta:
+
+    def __init__(self, agent_id, deadbands=None, passive_children=None, cache_ttl=None, full_refresh_s=3600, cache=None):
+        self.agent_id = agent_id
+
+        self.deadbands = dict(DEFAULT_DEADBANDS)
+        if deadbands is not None:
+            self.deadbands.update(deadbands)
+
+        self.passive_children = DEFAULT_PASSIVE_CHILDREN if passive_children is None else tuple(passive_children)
+        self.cache_ttl = cache_ttl
+        self.full_refresh_s = full_refresh_s
+        self.cache = cache or _ui_state_cache
+
+    def get_last_published(self, ui_state_channel):
+        ## The aggregate is only read when there is no fresh cache entry for this agent
+        entry = self.cache.get(self.agent_id, ttl=self.cache_ttl)
+        if entry is not None:
+            return entry, False
+
+        state, values = split_ui_state( ui_state_channel.get_aggregate() )
+        self.cache.set(self.agent_id, state, values)
+        return self.cache.get(self.agent_id, ttl=self.cache_ttl), True
+
+    def reduce(self, msg, ui_state_channel):
+        ## Returns the message to publish - the full message, only the changed parts of it,
+        ## or None when nothing has changed
+        entry, _ = self.get_last_published(ui_state_channel)
+        if entry is None:
+            return msg
+
+        if self.full_refresh_s is not None and time.time() - entry['full_at'] > self.full_refresh_s:
+            return msg
+
+        new_state, new_values = split_ui_state(msg)
+
+        changed_state = {}
+        for key, value in new_state.items():
+            if key not in entry['state'] or entry['state'][key] != value:
+                changed_state[key] = value
+
+        changed_children = {}
+        passive_children = {}
+        for name, value in new_values.items():
+            if name in self.passive_children:
+                passive_children[name] = value
+                continue
+            if name not in entry['values'] or value_changed(name, value, entry['values'][name], self.deadbands):
+                changed_children[name] = value
+
+        if len(changed_state) == 0 and len(changed_children) == 0:
+            return None
+
+        changed_children.update(passive_children)
+
+        reduced = dict(changed_state)
+        reduced['children'] = {}
+        for name, value in changed_children.items():
+            reduced['children'][name] = {'currentValue' : value}
+
+        return {'state' : reduced}
+
+    def mark_published(self, msg, full=False):
+        ## Called once a message from reduce() has been published
+        ## full is True when reduce() returned the whole message rather than a delta
+        state, values = split_ui_state(msg)
+        self.cache.update(self.agent_id, state, values, full=full)
+
+    def invalidate(self):
+        self.cache.invalidate(self.agent_id)
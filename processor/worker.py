@@ -0,0 +1,521 @@
+#!/usr/bin/python3
+
+## Long running worker mode
+
+## An alternative to the lambda style entry point, where every message builds its own target
+## and client. A worker pulls uplink messages from a queue and runs target.execute for each of
+## them on a pool of threads or processes, so that one pooled doover_iface (and its keep-alive
+## sessions, channel cache and token) and the per-agent ui_state and track caches stay warm
+## across messages.
+##
+## Messages are routed to pool workers by a hash of their agent_id, so the messages of one
+## agent are always processed in order, by the same worker, against the same caches.
+##
+## Two queues are provided as stand-ins for a real message queue - local_queue (in process)
+## and file_queue (a spool directory that several worker processes can consume from). Any
+## object with put(message), get(timeout) -> (receipt, message) or None, ack(receipt) and
+## nack(receipt) can be used as the source. Messages that were processed are acked, and
+## messages that failed are nacked rather than acked, so they are kept to be retried.
+##
+## In process mode a child that dies (e.g. killed for running out of memory) is replaced, and
+## the messages it had been given are nacked.
+##
+## A message is a dict e.g.
+##
+##   {
+##       "agent_id" : "9843b273-6580-4520-bdb0-0afb7bfec049",
+##       "msg_obj" : { "message" : "...", "channel" : "ii_oem_uplink_recv", "payload" : { ... } },
+##       "task_id" : Optional,
+##       "log_channel" : Optional,
+##       "package_config" : Optional - merged over the worker's package_config
+##   }
+##
+## Usage :
+##   python processor/worker.py --queue-dir /tmp/uplinks --enqueue uplinks.jsonl --agent-id <agent_id>
+##   python processor/worker.py --queue-dir /tmp/uplinks --endpoint https://my.doover.com --token <token> [--concurrency 8] [--processes]
+
+import os, json, time, uuid, zlib, queue, argparse, threading, traceback, multiprocessing
+
+import pydoover as pd
+import target
+
+
+UPLINK_CHANNEL_NAME = "ii_oem_uplink_recv"
+
+
+class local_queue:
+
+    ## The receipt is the message itself. Failed messages are kept in failed, and can be put
+    ## back with requeue_failed()
+
+    def __init__(self, maxsize=0):
+        self.queue = queue.Queue(maxsize)
+        self.failed = []
+
+    def put(self, message):
+        self.queue.put(message)
+
+    def get(self, timeout=None):
+        try:
+            message = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        return message, message
+
+    def ack(self, receipt):
+        pass
+
+    def nack(self, receipt):
+        self.failed.append(receipt)
+
+    def requeue_failed(self):
+        failed = self.failed
+        self.failed = []
+        for message in failed:
+            self.queue.put(message)
+        return len(failed)
+
+
+class file_queue:
+
+    ## Each message is a json file. put() writes it into pending/ and get() claims the oldest
+    ## by renaming it into processing/, which only one consumer can do. ack() deletes it, and
+    ## nack() moves it into failed/, where requeue_failed() can put it back. recover() puts
+    ## back anything left in processing/ by a worker that did not finish.
+
+    def __init__(self, path, poll_interval=0.05):
+        self.path = path
+        self.pending_dir = os.path.join(path, "pending")
+        self.processing_dir = os.path.join(path, "processing")
+        self.failed_dir = os.path.join(path, "failed")
+        self.poll_interval = poll_interval
+        self.listing = []
+
+        os.makedirs(self.pending_dir, exist_ok=True)
+        os.makedirs(self.processing_dir, exist_ok=True)
+        os.makedirs(self.failed_dir, exist_ok=True)
+
+    def put(self, message):
+        ## Names sort in the order messages were put
+        name = "%020d-%s.json" % (time.time_ns(), uuid.uuid4().hex)
+        temp_path = os.path.join(self.path, "." + name)
+        with open(temp_path, "w") as f:
+            json.dump(message, f)
+        os.rename(temp_path, os.path.join(self.pending_dir, name))
+
+    def claim(self):
+        while True:
+            if len(self.listing) == 0:
+                self.listing = sorted(os.listdir(self.pending_dir), reverse=True)
+                if len(self.listing) == 0:
+                    return None
+
+            name = self.listing.pop()
+            processing_path = os.path.join(self.processing_dir, name)
+            try:
+                os.rename(os.path.join(self.pending_dir, name), processing_path)
+            except FileNotFoundError:
+                ## Claimed by another consumer
+                continue
+
+            with open(processing_path) as f:
+                return processing_path, json.load(f)
+
+    def get(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            result = self.claim()
+            if result is not None:
+                return result
+            if deadline is not None and time.time() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def ack(self, receipt):
+        try:
+            os.remove(receipt)
+        except FileNotFoundError:
+            pass
+
+    def nack(self, receipt):
+        try:
+            os.rename(receipt, os.path.join(self.failed_dir, os.path.basename(receipt)))
+        except FileNotFoundError:
+            pass
+
+    def move_all(self, from_dir):
+        names = os.listdir(from_dir)
+        for name in names:
+            os.rename(os.path.join(from_dir, name), os.path.join(self.pending_dir, name))
+        self.listing = []
+        return len(names)
+
+    def recover(self):
+        ## Only call this when no other worker is consuming from the same directory
+        return self.move_all(self.processing_dir)
+
+    def requeue_failed(self):
+        return self.move_all(self.failed_dir)
+
+    def __len__(self):
+        return len(os.listdir(self.pending_dir))
+
+
+def get_partition(agent_id, partitions):
+    ## A stable hash, so that processes route an agent the same way
+    return zlib.crc32(str(agent_id).encode()) % partitions
+
+
+def get_target_kwargs(message, worker_config, doover_client):
+    package_config = dict(worker_config['package_config'])
+    package_config.update(message.get('package_config') or {})
+
+    return {
+        'agent_id' : message['agent_id'],
+        'access_token' : doover_client.access_token,
+        'api_endpoint' : worker_config['api_endpoint'],
+        'package_config' : package_config,
+        'msg_obj' : message.get('msg_obj'),
+        'task_id' : message.get('task_id', worker_config.get('task_id')),
+        'log_channel' : message.get('log_channel'),
+        'agent_settings' : message.get('agent_settings') or {'deployment_config' : {}},
+        'doover_client' : doover_client,
+    }
+
+
+def process_message(message, worker_config, doover_client):
+    ## Returns whether the message was processed without errors, and how long it took
+    start = time.perf_counter()
+    ok = True
+    try:
+        t = target.target( **get_target_kwargs(message, worker_config, doover_client) )
+        t.execute()
+        if t.get_log().level_counts.get("ERROR", 0) > 0:
+            ok = False
+    except Exception:
+        traceback.print_exc()
+        ok = False
+    return ok, time.perf_counter() - start
+
+
+def create_doover_client(worker_config):
+    return pd.doover_iface(
+        access_token=worker_config['access_token'],
+        endpoint=worker_config['api_endpoint'],
+        access_token_expiry=worker_config.get('access_token_expiry'),
+        token_refresh_callback=worker_config.get('token_refresh_callback'),
+        **worker_config.get('client_options', {})
+    )
+
+
+def run_pool_worker(inbox, results, worker_config, doover_client=None):
+    ## Processes messages from inbox until a None is received, putting (dispatch_id, ok, seconds)
+    ## on results for each. Child processes create their own client.
+    if doover_client is None:
+        doover_client = create_doover_client(worker_config)
+
+    while True:
+        item = inbox.get()
+        if item is None:
+            break
+        dispatch_id, message = item
+        ok, elapsed = process_message(message, worker_config, doover_client)
+        results.put((dispatch_id, ok, elapsed))
+
+
+class uplink_worker:
+
+    def __init__(
+            self,
+            source,
+            api_endpoint,
+            access_token,
+            access_token_expiry=None,
+            token_refresh_callback=None,
+            package_config=None,
+            concurrency=4,
+            use_processes=False,
+            max_in_flight=None,
+            client_options=None,
+        ):
+
+        self.source = source
+        self.concurrency = concurrency
+        self.use_processes = use_processes
+
+        ## Bounds how many messages are taken from the source but not yet acked
+        self.max_in_flight = max_in_flight or concurrency * 4
+
+        ## token_refresh_callback must be picklable when use_processes is set
+        self.worker_config = {
+            'api_endpoint' : api_endpoint,
+            'access_token' : access_token,
+            'access_token_expiry' : access_token_expiry,
+            'token_refresh_callback' : token_refresh_callback,
+            'package_config' : package_config or {"message_type" : "UPLINK"},
+            'client_options' : client_options or {},
+        }
+
+        self.doover_client = None
+        self.context = None
+        self.inboxes = []
+        self.workers = []
+        self.results = None
+        self.in_flight = 0
+
+        ## dispatch_id -> (partition, receipt) of each message given to a pool worker
+        self.dispatched = {}
+        self.next_dispatch_id = 0
+        self.running = False
+        self.stopping = False
+
+        self.stats = {
+            'received' : 0,
+            'processed' : 0,
+            'errors' : 0,
+            'processing_s' : 0.0,
+            'worker_restarts' : 0,
+            'started_at' : None,
+            'stopped_at' : None,
+        }
+
+    def start(self):
+        if self.running:
+            return
+
+        if self.use_processes:
+            self.context = multiprocessing.get_context("spawn")
+            self.results = self.context.Queue()
+            for i in range(self.concurrency):
+                inbox, worker = self.create_process_worker()
+                self.inboxes.append(inbox)
+                self.workers.append(worker)
+        else:
+            ## Threads share one client, and with it one pooled session
+            self.doover_client = create_doover_client(self.worker_config)
+            self.results = queue.Queue()
+            for i in range(self.concurrency):
+                inbox = queue.Queue()
+                worker = threading.Thread(
+                    target=run_pool_worker,
+                    args=(inbox, self.results, self.worker_config, self.doover_client),
+                    daemon=True,
+                )
+                self.inboxes.append(inbox)
+                self.workers.append(worker)
+
+        for worker in self.workers:
+            worker.start()
+
+        self.running = True
+        self.stopping = False
+        self.stats['started_at'] = time.time()
+
+    def create_process_worker(self):
+        inbox = self.context.Queue()
+        worker = self.context.Process(
+            target=run_pool_worker,
+            args=(inbox, self.results, self.worker_config),
+            daemon=True,
+        )
+        return inbox, worker
+
+    def dispatch(self, receipt, message):
+        partition = get_partition(message.get('agent_id'), self.concurrency)
+        dispatch_id = self.next_dispatch_id
+        self.next_dispatch_id += 1
+        self.dispatched[dispatch_id] = (partition, receipt)
+        self.inboxes[partition].put((dispatch_id, message))
+        self.in_flight += 1
+        self.stats['received'] += 1
+
+    def finish(self, dispatch_id, ok, elapsed):
+        partition, receipt = self.dispatched.pop(dispatch_id)
+        if ok:
+            self.source.ack(receipt)
+        else:
+            ## Failed messages are not acked, so they can be retried
+            self.source.nack(receipt)
+            self.stats['errors'] += 1
+        self.in_flight -= 1
+        self.stats['processed'] += 1
+        self.stats['processing_s'] += elapsed
+
+    def handle_result(self, result):
+        dispatch_id, ok, elapsed = result
+        ## Results for messages already failed by check_workers are ignored
+        if dispatch_id in self.dispatched:
+            self.finish(dispatch_id, ok, elapsed)
+
+    def check_workers(self, restart=True):
+        ## Fails the messages given to any child process that has died, and replaces it
+        if not self.use_processes:
+            return
+
+        for partition, worker in enumerate(self.workers):
+            if worker.is_alive():
+                continue
+
+            ## Anything it finished before it died is handled first
+            self.collect_results(timeout=0)
+            lost = [d for d, (p, receipt) in self.dispatched.items() if p == partition]
+            if len(lost) == 0 and not restart:
+                continue
+
+            print("Worker " + str(partition) + " exited with " + str(worker.exitcode) + " - failing " + str(len(lost)) + " messages")
+            for dispatch_id in lost:
+                self.finish(dispatch_id, False, 0.0)
+
+            if restart:
+                inbox, worker = self.create_process_worker()
+                worker.start()
+                self.inboxes[partition] = inbox
+                self.workers[partition] = worker
+                self.stats['worker_restarts'] += 1
+
+    def collect_results(self, timeout=None):
+        ## Handles every finished result, waiting up to timeout for the first
+        try:
+            self.handle_result( self.results.get(timeout=timeout) )
+        except queue.Empty:
+            return
+        while True:
+            try:
+                self.handle_result( self.results.get_nowait() )
+            except queue.Empty:
+                return
+
+    def run(self, max_messages=None, idle_timeout=None, poll_interval=0.1):
+        ## Processes messages until stop() is called, max_messages have been received, or
+        ## the source has been empty for idle_timeout seconds. Returns the stats.
+        self.start()
+        idle_since = time.time()
+        try:
+            while not self.stopping:
+                if max_messages is not None and self.stats['received'] >= max_messages:
+                    break
+
+                self.check_workers()
+
+                if self.in_flight >= self.max_in_flight:
+                    self.collect_results(timeout=poll_interval)
+                    continue
+
+                self.collect_results(timeout=0)
+
+                item = self.source.get(timeout=poll_interval)
+                if item is None:
+                    if idle_timeout is not None and self.in_flight == 0 and time.time() - idle_since > idle_timeout:
+                        break
+                    continue
+
+                idle_since = time.time()
+                self.dispatch(*item)
+        finally:
+            self.shutdown()
+
+        return self.get_stats()
+
+    def stop(self):
+        ## Can be called from another thread or a signal handler - messages already
+        ## dispatched are finished before run() returns
+        self.stopping = True
+
+    def shutdown(self):
+        if not self.running:
+            return
+
+        for inbox in self.inboxes:
+            inbox.put(None)
+
+        while self.in_flight > 0:
+            self.collect_results(timeout=1)
+            self.check_workers(restart=False)
+
+        for worker in self.workers:
+            worker.join()
+
+        if self.doover_client is not None:
+            self.doover_client.flush_publishes()
+
+        self.inboxes = []
+        self.workers = []
+        self.running = False
+        self.stats['stopped_at'] = time.time()
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        if stats['started_at'] is not None:
+            elapsed = (stats['stopped_at'] or time.time()) - stats['started_at']
+            stats['elapsed_s'] = elapsed
+            stats['messages_per_sec'] = stats['processed'] / elapsed if elapsed > 0 else 0
+        stats['in_flight'] = self.in_flight
+        return stats
+
+
+def make_uplink_message(agent_id, payload, i=0):
+    return {
+        'agent_id' : agent_id,
+        'msg_obj' : {
+            'message' : "queued-" + str(i),
+            'channel' : UPLINK_CHANNEL_NAME,
+            'payload' : payload,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Long running uplink worker")
+    parser.add_argument("--queue-dir", required=True)
+    parser.add_argument("--endpoint", default="https://my.doover.dev")
+    parser.add_argument("--token", default=os.environ.get('DOOVER_ACCESS_TOKEN'))
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--processes", action="store_true", help="use a process pool rather than threads")
+    parser.add_argument("--package-config", default='{"message_type": "UPLINK"}')
+    parser.add_argument("--max-messages", type=int, default=None)
+    parser.add_argument("--idle-timeout", type=float, default=None, help="exit once the queue has been empty this long")
+    parser.add_argument("--enqueue", default=None, help="queue the uplink payloads in this file and exit")
+    parser.add_argument("--agent-id", default=None, help="agent the enqueued payloads belong to")
+    parser.add_argument("--requeue-failed", action="store_true", help="retry the messages that failed on an earlier run")
+    args = parser.parse_args()
+
+    source = file_queue(args.queue_dir)
+
+    if args.enqueue is not None:
+        if args.agent_id is None:
+            parser.error("--agent-id is required with --enqueue")
+        import ii_bulk_decoder
+        count = 0
+        for payload in ii_bulk_decoder.iter_payloads_from_file(args.enqueue):
+            source.put( make_uplink_message(args.agent_id, payload, count) )
+            count += 1
+        print("Queued " + str(count) + " messages")
+        return
+
+    recovered = source.recover()
+    if recovered > 0:
+        print("Requeued " + str(recovered) + " unfinished messages")
+
+    if args.requeue_failed:
+        print("Requeued " + str(source.requeue_failed()) + " failed messages")
+
+    worker = uplink_worker(
+        source,
+        api_endpoint=args.endpoint,
+        access_token=args.token,
+        package_config=json.loads(args.package_config),
+        concurrency=args.concurrency,
+        use_processes=args.processes,
+    )
+
+    try:
+        stats = worker.run(max_messages=args.max_messages, idle_timeout=args.idle_timeout)
+    except KeyboardInterrupt:
+        worker.stop()
+        stats = worker.get_stats()
+
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
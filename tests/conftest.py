@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+
+## The processor modules import each other by name, as they do when deployed from processor/,
+## and the bench helpers (stub_server, the legacy decode loop) are imported the same way
+
+import os, sys, json
+
+import pytest
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(root, "bench"))
+sys.path.insert(0, os.path.join(root, "processor"))
+
+import pydoover
+import target
+import record_index
+import track_reduction
+import ui_state_delta
+from stub_server import stub_server, load_deployment_channel_messages
+
+AGENT_ID = "test-agent"
+
+
+@pytest.fixture
+def stub():
+    ## A local stub Doover API, with the process channel cache cleared either side
+    pydoover.invalidate_channel_cache()
+    server = stub_server(gzip_min_size=None).start()
+    try:
+        yield server
+    finally:
+        server.stop()
+        pydoover.invalidate_channel_cache()
+
+
+class fake_channel:
+
+    ## Stands in for a pydoover channel, holding the aggregate as published and round tripped
+    ## through json like the API does. get_aggregate raises error when one is given.
+
+    def __init__(self, aggregate=None, error=None):
+        self.aggregate = aggregate
+        self.error = error
+
+    def get_aggregate(self):
+        if self.error is not None:
+            raise self.error
+        return json.loads(json.dumps(self.aggregate))
+
+    def publish(self, state):
+        self.aggregate = json.loads(json.dumps(state))
+
+
+@pytest.fixture
+def agent(stub):
+    ## The stub server with AGENT_ID's channels deployed from doover_config.json, and the
+    ## processor's per agent caches cleared either side
+    def clear():
+        ui_state_delta.invalidate_ui_state_cache()
+        record_index.get_record_index_cache().invalidate()
+        track_reduction.get_last_point_cache().invalidate()
+
+    clear()
+    stub.state.deploy_agent(AGENT_ID, load_deployment_channel_messages(os.path.join(root, "doover_config.json")))
+    try:
+        yield stub
+    finally:
+        clear()
+
+
+def run_target(server, package_config, payload, channel_name="dm_oem_uplink_recv", message_id="test-message", **kwargs):
+    ## One invocation of target.py, as Doover would run it for a message on channel_name
+    t = target.target(
+        agent_id=AGENT_ID,
+        access_token="test-token",
+        api_endpoint=server.endpoint,
+        package_config=package_config,
+        msg_obj={'message' : message_id, 'channel' : channel_name, 'payload' : payload},
+        task_id="test-task",
+        agent_settings={'deployment_config' : {}},
+        **kwargs
+    )
+    t.execute()
+    return t
+
+
+def get_published(server, channel_name):
+    ## The payloads published to one of AGENT_ID's channels, oldest first
+    ch = server.state.get_channel(agent_id=AGENT_ID, channel_name=channel_name, create=False)
+    if ch is None:
+        return []
+    return [m['payload'] for m in ch['messages']]
+
+
+def make_client(server, **kwargs):
+    ## A doover_iface against the stub server that fails fast rather than backing off
+    kwargs.setdefault('agent_id', AGENT_ID)
+    kwargs.setdefault('access_token', "test-token")
+    kwargs.setdefault('retry_backoff', 0)
+    return pydoover.doover_iface(endpoint=server.endpoint, **kwargs)
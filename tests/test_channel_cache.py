@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+
+## Channel id cache, and falling back to the channel name when a cached id is gone
+
+import json
+
+import pytest
+
+import pydoover
+from conftest import make_client
+
+
+def recreate_channel(server, agent_id, channel_name):
+    ## As a redeploy does - the channel keeps its name but gets a new id
+    state = server.state
+    with state.lock:
+        channel_id = state.channel_names.pop((agent_id, channel_name))
+        del state.channels[channel_id]
+    state.deploy_agent(agent_id, [{'channel_name' : channel_name, 'channel_message' : {'value' : 2}}])
+    return state.get_channel(agent_id=agent_id, channel_name=channel_name)['channel']
+
+
+def test_channel_id_is_cached(stub):
+    stub.state.deploy_agent("test-agent", [{'channel_name' : "ui_state", 'channel_message' : {'value' : 1}}])
+    client = make_client(stub)
+
+    client.get_channel(channel_name="ui_state", agent_id="test-agent").get_aggregate()
+    ch = client.get_channel(channel_name="ui_state", agent_id="test-agent")
+
+    assert ch.channel_id_cached
+    assert ch.channel_id == stub.state.get_channel(agent_id="test-agent", channel_name="ui_state")['channel']
+
+
+def test_missing_cached_id_falls_back_to_name(stub):
+    stub.state.deploy_agent("test-agent", [{'channel_name' : "ui_state", 'channel_message' : {'value' : 1}}])
+    client = make_client(stub)
+    client.get_channel(channel_name="ui_state", agent_id="test-agent").get_aggregate()
+
+    new_id = recreate_channel(stub, "test-agent", "ui_state")
+    ch = client.get_channel(channel_name="ui_state", agent_id="test-agent")
+
+    assert ch.get_aggregate() == {'value' : 2}
+    assert pydoover.get_channel_cache().get("test-agent", "ui_state")['channel_id'] == new_id
+
+
+def cache_then_recreate(stub):
+    ## Returns a channel addressed by a cached id that has since been recreated, and the new id
+    stub.state.deploy_agent("test-agent", [{'channel_name' : "location", 'channel_message' : {'value' : 1}}])
+    client = make_client(stub)
+    client.get_channel(channel_name="location", agent_id="test-agent").get_aggregate()
+
+    new_id = recreate_channel(stub, "test-agent", "location")
+    ch = client.get_channel(channel_name="location", agent_id="test-agent")
+    assert ch.channel_id_cached
+    return ch, new_id
+
+
+def test_get_messages_falls_back_from_missing_cached_id(stub):
+    ch, new_id = cache_then_recreate(stub)
+
+    messages = ch.get_messages()
+    assert [m.channel_id for m in messages] == [new_id]
+    assert ch.fetch_payloads(messages) == [{'value' : 2}]
+
+
+def test_iter_messages_falls_back_from_missing_cached_id(stub):
+    ch, new_id = cache_then_recreate(stub)
+
+    messages = list(ch.iter_messages(page_size=2))
+    assert [m.channel_id for m in messages] == [new_id]
+    assert pydoover.get_channel_cache().get("test-agent", "location")['channel_id'] == new_id
+
+
+def test_fetch_payloads_falls_back_from_missing_cached_id(stub):
+    ch, new_id = cache_then_recreate(stub)
+
+    ## message_log objects made against the stale id, as a caller holding them would have
+    messages = [ch.make_message_log(m) for m in stub.state.get_channel(channel_id=new_id)['messages']]
+    assert ch.fetch_payloads(messages) == [{'value' : 2}]
+    assert ch.channel_id == new_id
+    assert ch.api_client.batch_messages_supported is True
+
+
+def test_async_get_messages_falls_back_from_missing_cached_id(stub):
+    ch, new_id = cache_then_recreate(stub)
+    client = pydoover.async_doover_iface(agent_id="test-agent", access_token="test-token", endpoint=stub.endpoint, retry_backoff=0)
+
+    async def get_payloads():
+        async_ch = await client.get_channel(channel_name="location", agent_id="test-agent")
+        assert async_ch.channel_id_cached
+        messages = await async_ch.get_messages()
+        walked = [m async for m in async_ch.iter_messages()]
+        return [m.channel_id for m in messages + walked], await async_ch.fetch_payloads(messages)
+
+    channel_ids, payloads = pydoover.run_coroutine(get_payloads())
+    assert channel_ids == [new_id, new_id]
+    assert payloads == [{'value' : 2}]
+
+
+def test_other_errors_keep_cached_id(stub):
+    stub.state.deploy_agent("test-agent", [{'channel_name' : "ui_state", 'channel_message' : {'value' : 1}}])
+    client = make_client(stub, max_retries=0)
+    client.get_channel(channel_name="ui_state", agent_id="test-agent").get_aggregate()
+    cached_id = pydoover.get_channel_cache().get("test-agent", "ui_state")['channel_id']
+
+    stub.state.reset_counts()
+    stub.state.error_rate = 1
+    with pytest.raises(pydoover.doover_api_error):
+        client.get_channel(channel_name="ui_state", agent_id="test-agent").publish(json.dumps({'value' : 3}))
+    stub.state.error_rate = 0
+
+    ## Only the one publish is sent, to the cached id, and the id is kept
+    assert stub.state.request_counts == {'POST channel' : 1}
+    assert pydoover.get_channel_cache().get("test-agent", "ui_state")['channel_id'] == cached_id
+
+
+def test_invalidate_channel_cache(stub):
+    stub.state.deploy_agent("test-agent", [{'channel_name' : "ui_state", 'channel_message' : {'value' : 1}}])
+    client = make_client(stub)
+    client.get_channel(channel_name="ui_state", agent_id="test-agent").get_aggregate()
+
+    client.invalidate_channel_cache(agent_id="test-agent", channel_name="ui_state")
+    assert not client.get_channel(channel_name="ui_state", agent_id="test-agent").channel_id_cached
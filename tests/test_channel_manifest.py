@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+
+## Channels resolved up front from a task's channel manifest ("resolve_channels"), and the
+## lazy channels target.py uses for the rest
+
+import os, json
+
+import target
+from conftest import run_target, get_published
+
+UPLINK = {'message_type' : "UPLINK", 'ui_state_delta' : {'enabled' : False}}
+
+
+def load_payloads():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bench", "payloads", "sample_uplinks.jsonl")
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def test_lazy_channel_resolves_on_first_use():
+    calls = []
+
+    class resolved:
+        channel_name = "location"
+
+    def resolve():
+        calls.append(1)
+        return resolved()
+
+    ch = target.lazy_channel(resolve)
+    assert calls == []
+    assert ch.channel_name == "location"
+    assert ch.channel_name == "location"
+    assert calls == [1]
+
+
+def test_unused_channels_make_no_requests(agent):
+    ## A DOWNLINK task resolves nothing up front, and uses none of its channels
+    agent.state.reset_counts()
+    t = run_target(agent, {'message_type' : "DOWNLINK"}, {})
+
+    assert agent.state.total_requests == 0
+    assert t.channels == {}
+
+
+def test_channel_missing_from_manifest_is_resolved_when_used(agent):
+    agent.state.reset_counts()
+    t = run_target(agent, dict(UPLINK, resolve_channels=[]), load_payloads()[0])
+
+    ## ui_state and location are only created when published to, by name, without a lookup
+    assert sorted(t.channels.keys()) == ["location", "ui_state"]
+    assert all(not ch.channel_id_cached for ch in t.channels.values())
+    assert list(agent.state.request_counts.keys()) == ["POST channel"]
+    assert len(get_published(agent, "location")) == 2
+
+
+def test_manifest_channels_are_resolved_up_front(agent):
+    agent.state.reset_counts()
+    t = run_target(agent, dict(UPLINK, resolve_channels=["ui_state", "location"]), load_payloads()[0])
+
+    assert agent.state.request_counts['GET channel'] == 2
+    assert all(ch.channel_id is not None for ch in t.channels.values())
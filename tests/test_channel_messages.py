@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+
+## Walking a channel's messages a page at a time with channel.iter_messages, and fetching
+## their payloads in batches of ids
+
+import json
+
+import pydoover
+from conftest import make_client
+
+
+def publish_messages(stub, count, channel_name="uplinks"):
+    ch = stub.state.get_channel(agent_id="test-agent", channel_name=channel_name)
+    for i in range(count):
+        stub.state.publish(ch, json.dumps({'value' : i}))
+    return ch
+
+
+def get_channel(stub, channel_name="uplinks"):
+    ch = make_client(stub).get_channel(channel_name=channel_name, agent_id="test-agent")
+    ch.update()
+    stub.state.reset_counts()
+    return ch
+
+
+def test_messages_are_walked_across_pages(stub):
+    published = publish_messages(stub, 5)
+    ch = get_channel(stub)
+
+    messages = list(ch.iter_messages(page_size=2))
+
+    assert [m.message_id for m in messages] == [m['message'] for m in published['messages']]
+    assert stub.state.request_counts == {'GET channel/messages' : 3}
+
+
+def test_full_last_page_needs_one_more_request(stub):
+    publish_messages(stub, 4)
+    ch = get_channel(stub)
+
+    assert len(list(ch.iter_messages(page_size=2))) == 4
+    assert stub.state.request_counts == {'GET channel/messages' : 3}
+
+
+def test_limit_stops_part_way_through_a_page(stub):
+    published = publish_messages(stub, 5)
+    ch = get_channel(stub)
+
+    messages = list(ch.iter_messages(limit=3, page_size=2))
+
+    assert [m.message_id for m in messages] == [m['message'] for m in published['messages'][:3]]
+    assert stub.state.request_counts == {'GET channel/messages' : 2}
+
+
+def test_empty_channel_yields_nothing(stub):
+    stub.state.get_channel(agent_id="test-agent", channel_name="uplinks")
+    ch = get_channel(stub)
+
+    assert list(ch.iter_messages(page_size=2)) == []
+    assert stub.state.request_counts == {'GET channel/messages' : 1}
+
+
+def test_channel_id_is_looked_up_before_paging(stub):
+    publish_messages(stub, 2)
+    ch = make_client(stub).get_channel(channel_name="uplinks", agent_id="test-agent")
+
+    assert len(list(ch.iter_messages())) == 2
+    assert stub.state.request_counts == {'GET channel' : 1, 'GET channel/messages' : 1}
+
+
+def test_payloads_are_fetched_in_batches_of_ids(stub):
+    publish_messages(stub, 5)
+    ch = get_channel(stub)
+    messages = list(ch.iter_messages())
+    stub.state.reset_counts()
+
+    assert ch.fetch_payloads(messages, batch_size=2) == [{'value' : i} for i in range(5)]
+    ## Three batches of ids, and no message fetched on its own
+    assert stub.state.request_counts == {'GET channel/messages' : 3}
+
+
+def test_async_messages_are_walked_across_pages(stub):
+    published = publish_messages(stub, 5)
+    client = pydoover.async_doover_iface(agent_id="test-agent", access_token="test-token", endpoint=stub.endpoint, retry_backoff=0)
+
+    async def walk():
+        ch = await client.get_channel(channel_name="uplinks", agent_id="test-agent")
+        messages = [m async for m in ch.iter_messages(page_size=2)]
+        return messages, await ch.fetch_payloads(messages, batch_size=2)
+
+    messages, payloads = pydoover.run_coroutine(walk())
+
+    assert [m.message_id for m in messages] == [m['message'] for m in published['messages']]
+    assert payloads == [{'value' : i} for i in range(5)]
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+
+## Gzipped request bodies above compress_threshold, and gzipped responses, against the stub server
+
+import json
+
+import pytest
+
+import pydoover
+import instrumentation
+from conftest import make_client, get_published
+
+
+def make_body(length):
+    ## A json message of about length bytes, which compresses well
+    return json.dumps({'text' : "x" * length})
+
+
+def publish(client, msg_str):
+    client.get_channel(channel_name="uplinks", agent_id="test-agent").publish(msg_str)
+
+
+def test_body_above_threshold_is_gzipped(stub):
+    client = make_client(stub, compress_requests=True, compress_threshold=1024)
+    body = make_body(2000)
+
+    stub.state.reset_counts()
+    publish(client, body)
+
+    assert stub.state.bytes_received < len(body)
+    assert get_published(stub, "uplinks") == [json.loads(body)]
+
+
+def test_body_below_threshold_is_sent_plain(stub):
+    client = make_client(stub, compress_requests=True, compress_threshold=1024)
+    body = make_body(500)
+
+    stub.state.reset_counts()
+    publish(client, body)
+
+    assert stub.state.bytes_received == len(body)
+    assert get_published(stub, "uplinks") == [json.loads(body)]
+
+
+def test_bodies_are_plain_unless_enabled(stub):
+    client = make_client(stub, compress_threshold=1024)
+    body = make_body(2000)
+
+    stub.state.reset_counts()
+    publish(client, body)
+
+    assert stub.state.bytes_received == len(body)
+
+
+def test_gzipped_response_is_decoded_and_counted_as_sent(stub):
+    stub.state.gzip_min_size = 256
+    ch = stub.state.get_channel(agent_id="test-agent", channel_name="uplinks")
+    stub.state.publish(ch, make_body(2000))
+
+    metrics = instrumentation.invocation_metrics()
+    client = make_client(stub, metrics=metrics)
+    stub.state.reset_counts()
+
+    assert client.get_channel(channel_name="uplinks", agent_id="test-agent").get_aggregate() == json.loads(make_body(2000))
+    ## The bytes received are the compressed bytes the server sent
+    assert metrics.get_summary()['http']['bytes_received'] == stub.state.bytes_sent
+    assert stub.state.bytes_sent < 2000
+
+
+@pytest.mark.skipif(pydoover.aiohttp is None, reason="aiohttp is not installed")
+def test_async_client_round_trip(stub):
+    stub.state.gzip_min_size = 256
+    client = pydoover.async_doover_iface(
+        agent_id="test-agent",
+        access_token="test-token",
+        endpoint=stub.endpoint,
+        retry_backoff=0,
+        compress_requests=True,
+        compress_threshold=1024,
+    )
+    body = make_body(2000)
+
+    async def round_trip():
+        ch = await client.get_channel(channel_name="uplinks", agent_id="test-agent")
+        await ch.publish(body)
+        ch.json_result = None
+        return await ch.get_aggregate()
+
+    stub.state.reset_counts()
+    assert pydoover.run_coroutine(round_trip()) == json.loads(body)
+    assert stub.state.bytes_received < len(body)
+    assert stub.state.bytes_sent < len(body)
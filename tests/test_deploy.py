@@ -0,0 +1,33 @@
+#!/usr/bin/python3
+
+## The DEPLOY path of target.py against the stub server
+
+from conftest import run_target, get_published
+
+DEPLOY = {'message_type' : "DEPLOY"}
+
+
+def test_first_deploy_publishes_schema_and_trigger(agent):
+    t = run_target(agent, DEPLOY, {'new_deployment' : True}, channel_name="deployments")
+
+    assert t.deploy_status == "deployed"
+    assert len(get_published(agent, "ui_state")) == 2
+    assert get_published(agent, "dm_oem_uplink_recv") == [{}]
+
+
+def test_unchanged_redeploy_still_sends_trigger(agent):
+    run_target(agent, DEPLOY, {'new_deployment' : True}, channel_name="deployments")
+    t = run_target(agent, DEPLOY, {'new_deployment' : True}, channel_name="deployments")
+
+    ## The schema is not published again, but the data is still reprocessed
+    assert t.deploy_status == "unchanged"
+    assert len(get_published(agent, "ui_state")) == 2
+    assert get_published(agent, "dm_oem_uplink_recv") == [{}, {}]
+
+
+def test_forced_redeploy_publishes_schema(agent):
+    run_target(agent, DEPLOY, {'new_deployment' : True}, channel_name="deployments")
+    t = run_target(agent, dict(DEPLOY, deploy_force=True), {'new_deployment' : True}, channel_name="deployments")
+
+    assert t.deploy_status == "deployed"
+    assert len(get_published(agent, "ui_state")) == 3
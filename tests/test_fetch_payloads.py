@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+
+## channel.fetch_payloads, with and without the batch message request
+
+import json
+
+import pytest
+
+import pydoover
+import instrumentation
+from conftest import make_client
+
+
+def publish_messages(stub, count):
+    ch = stub.state.get_channel(agent_id="test-agent", channel_name="uplinks")
+    for i in range(count):
+        stub.state.publish(ch, json.dumps({'value' : i}))
+
+
+def get_messages(client):
+    ch = client.get_channel(channel_name="uplinks", agent_id="test-agent")
+    return ch, ch.get_messages()
+
+
+def test_payloads_are_fetched_in_one_batch(stub):
+    publish_messages(stub, 5)
+    ch, messages = get_messages(make_client(stub))
+
+    stub.state.reset_counts()
+    assert ch.fetch_payloads(messages) == [{'value' : i} for i in range(5)]
+    assert stub.state.request_counts == {'GET channel/messages' : 1}
+    assert ch.api_client.batch_messages_supported is True
+
+
+@pytest.mark.parametrize("status_code", [400, 404, 501])
+def test_unsupported_status_stops_batches(stub, status_code):
+    publish_messages(stub, 2)
+    ch, messages = get_messages(make_client(stub, max_retries=0))
+
+    stub.state.error_rate = 1
+    stub.state.error_status = status_code
+    assert ch.api_client.get_message_details_batch(ch.channel_id, [m.message_id for m in messages]) is None
+    assert ch.api_client.batch_messages_supported is False
+
+
+@pytest.mark.parametrize("status_code", [401, 429, 503])
+def test_other_failures_do_not_stop_batches(stub, status_code):
+    publish_messages(stub, 2)
+    ch, messages = get_messages(make_client(stub, max_retries=0))
+
+    stub.state.error_rate = 1
+    stub.state.error_status = status_code
+    with pytest.raises(pydoover.doover_api_error):
+        ch.api_client.get_message_details_batch(ch.channel_id, [m.message_id for m in messages])
+    assert ch.api_client.batch_messages_supported is None
+
+
+def test_response_without_payloads_stops_batches(stub):
+    publish_messages(stub, 2)
+    ch, messages = get_messages(make_client(stub))
+
+    ## A server that ignores the ids parameter returns the message list without payloads
+    assert ch.api_client.read_message_batch(json.dumps({'messages' : [{'message' : m.message_id} for m in messages]})) is None
+    assert ch.api_client.batch_messages_supported is False
+
+
+def test_partial_batch_fetches_the_rest_one_by_one(stub, monkeypatch):
+    publish_messages(stub, 3)
+    ch, messages = get_messages(make_client(stub))
+
+    first = stub.state.get_channel(agent_id="test-agent", channel_name="uplinks")['messages'][0]
+    monkeypatch.setattr(ch.api_client, 'get_message_details_batch', lambda channel_id, message_ids: {first['message'] : first})
+
+    stub.state.reset_counts()
+    assert ch.fetch_payloads(messages) == [{'value' : i} for i in range(3)]
+    assert stub.state.request_counts == {'GET channel/message' : 2}
+
+
+def test_pool_requests_are_accounted_to_caller_metrics(stub):
+    publish_messages(stub, 4)
+    ch, messages = get_messages(make_client(stub))
+    ch.api_client.batch_messages_supported = False
+
+    metrics = instrumentation.invocation_metrics()
+    ch.api_client.bind_metrics(metrics)
+    try:
+        ch.fetch_payloads(messages, concurrency=4)
+    finally:
+        ch.api_client.bind_metrics(None)
+
+    endpoints = metrics.get_summary()['endpoints']
+    assert endpoints['GET /ch/v1/channel/{channel_id}/message/{message_id}']['requests'] == 4
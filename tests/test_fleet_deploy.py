@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+## The fleet deploy fan-out in fleet_deploy.py, against the stub server
+
+import os
+
+import target
+import fleet_deploy
+from stub_server import load_deployment_channel_messages
+
+AGENT_IDS = ["agent-" + str(i) for i in range(4)]
+
+
+def deploy_agents(server, agent_ids):
+    channel_messages = load_deployment_channel_messages(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "doover_config.json"))
+    for agent_id in agent_ids:
+        server.state.deploy_agent(agent_id, channel_messages)
+
+
+def make_deploy(server, agent_ids=AGENT_IDS, **kwargs):
+    kwargs.setdefault('client_options', {'retry_backoff' : 0})
+    return fleet_deploy.fleet_deploy(agent_ids, api_endpoint=server.endpoint, access_token="test-token", **kwargs)
+
+
+def test_second_run_is_unchanged(stub):
+    deploy_agents(stub, AGENT_IDS)
+
+    first = make_deploy(stub, concurrency=2).run()
+    assert first['status_counts'] == {'deployed' : len(AGENT_IDS)}
+
+    second = make_deploy(stub, concurrency=2).run()
+    assert second['status_counts'] == {'unchanged' : len(AGENT_IDS)}
+    assert [r['agent_id'] for r in second['results']] == AGENT_IDS
+    assert all(r['error'] is None for r in second['results'])
+
+
+def test_errors_are_counted_as_failed(stub, monkeypatch):
+    deploy_agents(stub, AGENT_IDS)
+    deploy = target.target.deploy
+
+    def failing_deploy(self, *args):
+        if self.kwargs['agent_id'] == "agent-1":
+            raise Exception("schema publish failed")
+        return deploy(self, *args)
+
+    monkeypatch.setattr(target.target, "deploy", failing_deploy)
+    report = make_deploy(stub, concurrency=2).run()
+
+    assert report['status_counts'] == {'deployed' : 3, 'failed' : 1}
+    failed = report['results'][1]
+    assert failed['status'] == "failed"
+    assert failed['error'] == "Error attempting to process message - schema publish failed"
+
+
+def test_requests_are_rate_limited(stub):
+    deploy_agents(stub, AGENT_IDS)
+    stub.state.reset_counts()
+
+    report = make_deploy(stub, concurrency=4, requests_per_s=40, burst=1).run()
+
+    ## After the first, requests are spaced 1 / requests_per_s apart
+    assert report['status_counts'] == {'deployed' : len(AGENT_IDS)}
+    assert report['http_requests'] == stub.state.total_requests
+    assert report['elapsed_s'] >= (stub.state.total_requests - 1) / 40 * 0.9
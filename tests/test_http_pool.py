@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+## Client settings from the package config, and the pooled session shared between clients
+
+import os, json, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import pydoover as pd
+import target
+from conftest import run_target
+
+
+def load_payloads():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bench", "payloads", "sample_uplinks.jsonl")
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def make_target(http_pool):
+    return target.target(
+        agent_id="test-agent",
+        access_token="test-token",
+        api_endpoint="http://127.0.0.1:1",
+        package_config={"message_type" : "UPLINK", "http_pool" : http_pool},
+    )
+
+
+def test_unknown_http_pool_setting_is_dropped_with_warning():
+    t = make_target({"pool_size" : 4, "pool_sise" : 8})
+    t.create_doover_client()
+
+    assert t.get_pool_config() == {"pool_size" : 4}
+    warnings = [e for e in t.get_log().entries if e.startswith("WARNING - ") and "pool_sise" in e]
+    assert len(warnings) > 0
+
+
+def test_known_http_pool_settings_reach_the_client():
+    t = make_target({"max_retries" : 1, "read_timeout" : 2})
+    t.create_doover_client()
+
+    assert t.cli.api_client.max_retries == 1
+    assert t.cli.api_client.timeout[1] == 2
+
+
+class cookie_handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = b'{}'
+        self.send_response(200)
+        self.send_header("Set-Cookie", "session=agent-a; Path=/")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def test_pooled_session_does_not_keep_cookies():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), cookie_handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        endpoint = "http://127.0.0.1:" + str(httpd.server_address[1])
+        cli = pd.doover_api_iface(access_token="test-token", endpoint=endpoint)
+        cli.make_request("GET", "/")
+        assert len(cli.session.cookies) == 0
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@pytest.mark.parametrize("use_aiohttp", [True, False])
+def test_warm_invocations_reuse_connections(agent, monkeypatch, use_aiohttp):
+    ## The per record publishes go through the async client, with aiohttp or on the executor
+    if use_aiohttp and pd.aiohttp is None:
+        pytest.skip("aiohttp is not installed")
+    if not use_aiohttp:
+        monkeypatch.setattr(pd, "aiohttp", None)
+
+    uplink = {"message_type" : "UPLINK", "ui_state_delta" : {"enabled" : False}}
+    payloads = load_payloads()
+    run_target(agent, uplink, payloads[0], message_id="first")
+
+    agent.state.reset_counts()
+    t = run_target(agent, uplink, payloads[1], message_id="second")
+
+    assert t.get_log().level_counts.get("ERROR", 0) == 0
+    assert agent.state.request_counts.get("POST channel", 0) >= 2
+    assert agent.state.connections == 0
@@ -0,0 +1,45 @@
+#!/usr/bin/python3
+
+## ii_bulk_decoder against the per record decoder, using the checks in bench/bench_bulk_decoder.py
+
+import random
+
+import pytest
+
+import ii_bulk_decoder
+import bench_bulk_decoder
+
+
+def make_payloads(count=50, records_per_payload=5):
+    random.seed(0)
+    return [bench_bulk_decoder.make_payload(i, records_per_payload) for i in range(count)]
+
+
+@pytest.mark.skipif(ii_bulk_decoder.np is None, reason="NumPy is not installed")
+def test_numpy_matches_per_record_decoder():
+    payloads = make_payloads()
+    columns = ii_bulk_decoder.bulk_decode(payloads, odometer_offset=12.5, machine_hours_offset=3)
+    bench_bulk_decoder.check_matches(payloads, columns, 12.5, 3)
+
+
+def test_array_matches_per_record_decoder():
+    payloads = make_payloads()
+    columns = ii_bulk_decoder.bulk_decode(payloads, odometer_offset=12.5, machine_hours_offset=3, use_numpy=False)
+    bench_bulk_decoder.check_matches(payloads, columns, 12.5, 3)
+
+
+def test_null_seq_no_is_missing():
+    payload = make_payloads(count=1, records_per_payload=3)[0]
+    payload['Records'][0]['SeqNo'] = None
+    payload['Records'][1]['SeqNo'] = 0
+    del payload['Records'][2]['SeqNo']
+
+    columns = ii_bulk_decoder.bulk_decode([payload], use_numpy=False)
+    assert list(columns['seq_no']) == [-1, 0, -1]
+
+
+def test_array_path_is_not_picked_without_numpy(monkeypatch):
+    monkeypatch.setattr(ii_bulk_decoder, 'np', None)
+    with pytest.raises(Exception):
+        ii_bulk_decoder.bulk_decode(make_payloads(count=1))
+    assert len( ii_bulk_decoder.bulk_decode(make_payloads(count=1), use_numpy=False) ) == 5
@@ -0,0 +1,32 @@
+#!/usr/bin/python3
+
+## record_decoder against the original inline FType loop kept in bench/bench_decoder.py
+
+import random
+
+import ii_decoder
+import bench_decoder
+
+
+def test_decoder_matches_legacy_loop():
+    random.seed(0)
+    agent_settings = {'deployment_config' : {'ODO_OFFSET' : 12.5, 'MACHINE_HOURS_OFFSET' : 3}}
+    decoder = ii_decoder.record_decoder(odometer_offset=12.5, machine_hours_offset=3)
+
+    for i in range(200):
+        record = bench_decoder.make_record(i)
+        assert bench_decoder.as_tuple(decoder.decode(record)) == bench_decoder.legacy_decode(record, agent_settings)
+
+
+def test_no_fix_has_no_position():
+    record = {"Reason" : 3, "DateUTC" : "2024-01-01T00:00:00", "Fields" : [{"FType" : 0, "Lat" : 0, "Long" : 0, "Alt" : 0, "Spd" : 500, "PosAcc" : 5}]}
+    decoded = ii_decoder.record_decoder().decode(record)
+    assert decoded.position is None
+    assert decoded.speed_kmh is None
+    assert decoded.gps_accuracy_m == 99
+
+
+def test_unknown_fields_are_kept():
+    record = {"Reason" : 3, "DateUTC" : "2024-01-01T00:00:00", "Fields" : [{"FType" : 99, "Value" : 1}, {"Value" : 2}]}
+    decoded = ii_decoder.record_decoder().decode(record)
+    assert [f.ftype for f in decoded.unknown_fields] == [99]
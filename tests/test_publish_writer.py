@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+
+## Buffered publishing through publish_writer, against the stub server
+
+import json, time, threading
+
+import pytest
+
+import pydoover
+from conftest import make_client, get_published
+
+
+def make_buffered_client(stub, **options):
+    ## The background thread is held off, so that every send happens in flush(), and the
+    ## client makes one attempt per send so that only the writer retries
+    client = make_client(stub, max_retries=0)
+    options.setdefault('max_pending', 1000)
+    options.setdefault('flush_interval', 60)
+    options.setdefault('retry_backoff', 0)
+    client.set_publish_writer_options(**options)
+    return client
+
+
+def publish(client, channel_name, payloads, retry_safe=False):
+    ch = client.get_channel(channel_name=channel_name, agent_id="test-agent")
+    for payload in payloads:
+        ch.publish(json.dumps(payload), retry_safe=retry_safe, buffered=True)
+
+
+def test_messages_to_a_channel_are_sent_in_order(stub):
+    client = make_buffered_client(stub)
+    publish(client, "location", [{'i' : i} for i in range(5)])
+    publish(client, "ui_cmds", [{'cmds' : {}}])
+
+    assert client.flush_publishes() == []
+    assert get_published(stub, "location") == [{'i' : i} for i in range(5)]
+    assert get_published(stub, "ui_cmds") == [{'cmds' : {}}]
+
+
+def test_coalesced_channel_sends_one_merged_publish(stub):
+    client = make_buffered_client(stub, coalesce_channels=["ui_state"])
+    publish(client, "ui_state", [{'state' : {'a' : 1, 'b' : 1}}, {'state' : {'b' : 2}}, {'state' : {'c' : 3}}])
+
+    client.flush_publishes()
+    assert get_published(stub, "ui_state") == [{'state' : {'a' : 1, 'b' : 2, 'c' : 3}}]
+
+
+def test_failed_message_is_requeued_ahead_of_the_rest(stub):
+    client = make_buffered_client(stub, max_attempts=3)
+    publish(client, "location", [{'i' : i} for i in range(3)], retry_safe=True)
+
+    stub.state.fail_next(2)
+    assert client.flush_publishes() == []
+    assert get_published(stub, "location") == [{'i' : i} for i in range(3)]
+
+
+def test_message_is_dropped_after_max_attempts(stub):
+    client = make_buffered_client(stub, max_attempts=3)
+    publish(client, "location", [{'i' : i} for i in range(3)], retry_safe=True)
+
+    stub.state.fail_next(3)
+    failed = client.flush_publishes()
+
+    assert [json.loads(f['msg_str']) for f in failed] == [{'i' : 0}]
+    assert failed[0]['error'].status_code == 503
+    assert get_published(stub, "location") == [{'i' : 1}, {'i' : 2}]
+
+    ## Failures are only returned by the one flush
+    assert client.flush_publishes() == []
+
+
+def test_failures_are_returned_to_their_agent(stub):
+    client = make_buffered_client(stub, max_attempts=1)
+    other = client.get_channel(channel_name="location", agent_id="other-agent")
+    other.publish(json.dumps({'i' : 0}), retry_safe=True, buffered=True)
+
+    stub.state.fail_next(1)
+    assert client.flush_publishes(agent_id="test-agent") == []
+    assert len(client.flush_publishes(agent_id="other-agent")) == 1
+
+
+def test_message_not_retry_safe_is_not_resent_after_a_server_error(stub, monkeypatch):
+    ## The publish is stored, but its response is lost as a 503
+    client = make_buffered_client(stub, max_attempts=3)
+    publish_to_channel = client.api_client.publish_to_channel
+    errors = []
+
+    def stored_then_503(**kwargs):
+        publish_to_channel(**kwargs)
+        if len(errors) == 0:
+            errors.append(pydoover.doover_api_error("POST channel failed - 503", method="POST", status_code=503))
+            raise errors[0]
+
+    monkeypatch.setattr(client.api_client, "publish_to_channel", stored_then_503)
+    publish(client, "location", [{'i' : 0}, {'i' : 1}])
+
+    failed = client.flush_publishes()
+    assert [json.loads(f['msg_str']) for f in failed] == [{'i' : 0}]
+    assert failed[0]['error'] is errors[0]
+    assert get_published(stub, "location") == [{'i' : 0}, {'i' : 1}]
+
+
+def test_message_not_retry_safe_is_resent_when_it_was_never_sent(stub, monkeypatch):
+    client = make_buffered_client(stub, max_attempts=3)
+    publish_to_channel = client.api_client.publish_to_channel
+    errors = []
+
+    def circuit_open_once(**kwargs):
+        if len(errors) == 0:
+            errors.append(pydoover.circuit_open_error("circuit open", method="POST"))
+            raise errors[0]
+        return publish_to_channel(**kwargs)
+
+    monkeypatch.setattr(client.api_client, "publish_to_channel", circuit_open_once)
+    publish(client, "location", [{'i' : 0}, {'i' : 1}])
+
+    assert client.flush_publishes() == []
+    assert get_published(stub, "location") == [{'i' : 0}, {'i' : 1}]
+
+
+def test_connection_refused_is_an_unsent_error():
+    client = pydoover.doover_api_iface(endpoint="http://127.0.0.1:1", access_token="test-token", retry_backoff=0)
+    with pytest.raises(pydoover.doover_api_error) as e:
+        client.publish_to_channel(msg_str="{}", channel_id="c1", retry_safe=False)
+    assert e.value.status_code is None
+    assert pydoover.is_unsent_error(e.value)
+
+
+@pytest.mark.parametrize("concurrency", [2, 6])
+def test_concurrency_limits_channels_sent_at_once(stub, monkeypatch, concurrency):
+    counts = {'active' : 0, 'max' : 0}
+    lock = threading.Lock()
+    channel_publish = pydoover.channel.publish
+
+    def slow_publish(self, *args, **kwargs):
+        with lock:
+            counts['active'] += 1
+            counts['max'] = max(counts['max'], counts['active'])
+        try:
+            time.sleep(0.05)
+            return channel_publish(self, *args, **kwargs)
+        finally:
+            with lock:
+                counts['active'] -= 1
+
+    monkeypatch.setattr(pydoover.channel, "publish", slow_publish)
+
+    client = make_buffered_client(stub, concurrency=concurrency)
+    for i in range(6):
+        publish(client, "channel_" + str(i), [{'i' : i}])
+
+    assert client.close_publishes() == []
+    assert counts['max'] == concurrency
+    assert all(get_published(stub, "channel_" + str(i)) == [{'i' : i}] for i in range(6))
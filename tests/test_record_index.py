@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+
+## Record ordering within an uplink, and the record index of processed records, run through
+## target.py against the stub server
+
+import os, json
+
+import geo
+import pydoover
+import record_index
+from conftest import run_target, get_published, fake_channel
+
+UPLINK = {'message_type' : "UPLINK", 'ui_state_delta' : {'enabled' : False}}
+INDEXED_UPLINK = dict(UPLINK, record_index={'enabled' : True, 'persist_interval_s' : 0})
+
+
+def load_payloads():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bench", "payloads", "sample_uplinks.jsonl")
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def newest_first_payload():
+    ## Twelve records sent from 01:22 back to 01:00
+    payload = load_payloads()[2]
+    assert [r['DateUTC'] for r in payload['Records']] == sorted([r['DateUTC'] for r in payload['Records']], reverse=True)
+    return payload
+
+
+def get_aggregate(server, channel_name):
+    return server.state.get_channel(agent_id="test-agent", channel_name=channel_name)['aggregate']['payload']
+
+
+def test_newest_first_records_are_published_oldest_first(agent):
+    payload = newest_first_payload()
+    run_target(agent, UPLINK, payload)
+
+    ## Without ui_state_delta every record publishes its time to ui_state
+    times = [m['state']['children']['deviceTimeUtc']['currentValue'] for m in get_published(agent, "ui_state")[1:]]
+    assert times == sorted(r['DateUTC'] for r in payload['Records'])
+    assert get_aggregate(agent, "ui_state")['state']['children']['deviceTimeUtc']['currentValue'] == payload['Records'][0]['DateUTC']
+
+
+def test_newest_first_records_are_sorted_in_batch_mode(agent):
+    payload = newest_first_payload()
+    run_target(agent, dict(UPLINK, uplink_mode="batch"), payload)
+
+    ## One of the records has no gps fix
+    track = get_published(agent, "location")[-1]['track']
+    assert [p['time'] for p in track] == sorted(r['DateUTC'] for r in payload['Records'] if r['SeqNo'] != 1013)
+
+
+def test_resent_uplink_is_dropped(agent):
+    payload = newest_first_payload()
+    run_target(agent, INDEXED_UPLINK, payload, message_id="first")
+    published = len(get_published(agent, "location"))
+
+    t = run_target(agent, INDEXED_UPLINK, payload, message_id="resent")
+    assert len(get_published(agent, "location")) == published
+    assert "Record index dropped 12 duplicate" in t.get_log_text()
+
+
+def test_older_records_go_to_history(agent):
+    payloads = load_payloads()
+    run_target(agent, INDEXED_UPLINK, payloads[2], message_id="newer")
+    location_count = len(get_published(agent, "location"))
+
+    ## Records from 00:10 - 00:17 arrive after the 01:22 record was processed
+    run_target(agent, INDEXED_UPLINK, payloads[1], message_id="older")
+
+    assert len(get_published(agent, "location")) == location_count
+    track = get_published(agent, "location_history")[-1]['track']
+    assert [p['time'] for p in track] == [r['DateUTC'] for r in payloads[1]['Records']]
+    assert get_aggregate(agent, "ui_state")['state']['children']['deviceTimeUtc']['currentValue'] == payloads[2]['Records'][0]['DateUTC']
+
+
+def test_index_is_persisted_for_cold_starts(agent):
+    payload = newest_first_payload()
+    run_target(agent, INDEXED_UPLINK, payload, message_id="first")
+
+    aggregate = get_aggregate(agent, "ii_record_index")
+    assert aggregate['newest'] == geo.parse_timestamp(payload['Records'][0]['DateUTC'])
+    assert len(aggregate['keys']) == 12
+
+    ## A new container has no cached index, and reads it back from the channel
+    record_index.get_record_index_cache().invalidate()
+    t = run_target(agent, INDEXED_UPLINK, payload, message_id="resent")
+    assert "Record index dropped 12 duplicate" in t.get_log_text()
+
+
+def test_missing_index_channel_starts_an_empty_index(agent):
+    ## As for an agent deployed before the record index
+    with agent.state.lock:
+        channel_id = agent.state.channel_names.pop(("test-agent", "ii_record_index"))
+        del agent.state.channels[channel_id]
+
+    payload = newest_first_payload()
+    t = run_target(agent, INDEXED_UPLINK, payload, message_id="first")
+    assert "No record index channel yet" in t.get_log_text()
+    assert t.get_log().level_counts.get("WARNING", 0) == 0
+    assert len(get_aggregate(agent, "ii_record_index")['keys']) == 12
+
+    record_index.get_record_index_cache().invalidate()
+    t = run_target(agent, INDEXED_UPLINK, payload, message_id="resent")
+    assert "Record index dropped 12 duplicate" in t.get_log_text()
+
+
+def test_unreadable_index_processes_unfiltered(agent, monkeypatch):
+    def split(self, records, index_channel):
+        raise pydoover.doover_api_error("index read failed", status_code=503)
+    monkeypatch.setattr(record_index.record_filter, "split", split)
+
+    t = run_target(agent, INDEXED_UPLINK, newest_first_payload())
+    assert "WARNING - Could not read the record index" in t.get_log_text()
+    ## The deployed message, and the eleven records with a gps fix
+    assert len(get_published(agent, "location")) == 12
+    assert get_aggregate(agent, "ii_record_index") == {}
+
+
+def test_failed_buffered_publish_leaves_records_unmarked(agent, monkeypatch):
+    config = dict(INDEXED_UPLINK, buffered_publish={'enabled' : True, 'max_attempts' : 1})
+    channel_publish = pydoover.channel.publish
+
+    def failing_publish(self, msg_str, buffered=False, **kwargs):
+        if not buffered and self.channel_name == "location":
+            raise pydoover.doover_api_error("publish failed", status_code=503)
+        return channel_publish(self, msg_str, buffered=buffered, **kwargs)
+
+    monkeypatch.setattr(pydoover.channel, "publish", failing_publish)
+    payload = newest_first_payload()
+    t = run_target(agent, config, payload, message_id="first")
+    assert "records not marked as processed" in t.get_log_text()
+    assert get_aggregate(agent, "ii_record_index") == {}
+
+    ## The resent records are processed again, and this time marked
+    monkeypatch.setattr(pydoover.channel, "publish", channel_publish)
+    published = len(get_published(agent, "location"))
+    t = run_target(agent, config, payload, message_id="resent")
+    assert "Record index dropped" not in t.get_log_text()
+    assert len(get_published(agent, "location")) == published + 11
+    assert len(get_aggregate(agent, "ii_record_index")['keys']) == 12
+
+
+def test_index_keeps_newest_keys():
+    index = record_index.record_index(max_keys=2)
+    for minute in range(3):
+        index.add({'SeqNo' : minute, 'DateUTC' : "2024-01-01 00:0%d:00" % minute})
+
+    assert list(index.keys) == ["1|2024-01-01 00:01:00", "2|2024-01-01 00:02:00"]
+    assert index.newest == geo.parse_timestamp("2024-01-01 00:02:00")
+
+
+def test_split_drops_duplicates_within_an_uplink():
+    records = [{'SeqNo' : 1, 'DateUTC' : "2024-01-01 00:01:00"}] * 2
+    record_filter = record_index.record_filter("test-agent", cache=record_index.record_index_cache())
+    current, older, duplicates = record_filter.split(records, fake_channel())
+    assert (len(current), len(older), duplicates) == (1, 0, 1)
+
+
+def test_malformed_aggregate_loads_an_empty_index():
+    for aggregate in [None, "text", {'keys' : "x", 'newest' : True}]:
+        index = record_index.load_record_index(aggregate)
+        assert len(index.keys) == 0
+        assert index.newest is None
@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+
+## Request retries, backoff and the per endpoint circuit breaker, against the stub server
+
+import time
+
+import pytest
+
+import pydoover
+from conftest import make_client
+
+
+@pytest.fixture
+def ui_state(stub):
+    stub.state.deploy_agent("test-agent", [{'channel_name' : "ui_state", 'channel_message' : {'value' : 1}}])
+    stub.state.reset_counts()
+    return stub
+
+
+def get_details(client):
+    return client.api_client.get_channel_details(agent_id="test-agent", channel_name="ui_state", include_messages=False)
+
+
+def test_get_is_retried_until_it_succeeds(ui_state):
+    ui_state.state.fail_next(2)
+    assert get_details( make_client(ui_state, max_retries=3) )['aggregate']['payload'] == {'value' : 1}
+    assert ui_state.state.total_requests == 3
+
+
+def test_get_gives_up_after_max_retries(ui_state):
+    ui_state.state.fail_next(10)
+    with pytest.raises(pydoover.doover_api_error) as e:
+        get_details( make_client(ui_state, max_retries=2) )
+    assert e.value.status_code == 503
+    assert ui_state.state.total_requests == 3
+
+
+def test_client_error_is_not_retried(ui_state):
+    ui_state.state.fail_next(1, status=400)
+    with pytest.raises(pydoover.doover_api_error) as e:
+        get_details( make_client(ui_state, max_retries=3) )
+    assert e.value.status_code == 400
+    assert ui_state.state.total_requests == 1
+
+
+def test_post_is_only_retried_when_retry_safe(ui_state):
+    client = make_client(ui_state, max_retries=3)
+
+    ui_state.state.fail_next(1)
+    with pytest.raises(pydoover.doover_api_error):
+        client.api_client.publish_to_channel("{}", agent_id="test-agent", channel_name="ui_state")
+    assert ui_state.state.total_requests == 1
+
+    ui_state.state.fail_next(1)
+    client.api_client.publish_to_channel("{}", agent_id="test-agent", channel_name="ui_state", retry_safe=True)
+    assert ui_state.state.total_requests == 3
+
+
+def test_retry_delay_is_bounded():
+    for attempt in range(10):
+        assert 0 <= pydoover.get_retry_delay(attempt, 0.3) <= pydoover.MAX_RETRY_DELAY
+    ## Retry-After is honoured, up to the same cap
+    assert pydoover.get_retry_delay(0, 0.3, retry_after="2") >= 2
+    assert pydoover.get_retry_delay(0, 0.3, retry_after="60") == pydoover.MAX_RETRY_DELAY
+
+
+def test_circuit_opens_after_failure_threshold(ui_state):
+    client = make_client(ui_state, max_retries=0, circuit_failure_threshold=2, circuit_reset_timeout=30)
+
+    ui_state.state.fail_next(2)
+    for i in range(2):
+        with pytest.raises(pydoover.doover_api_error):
+            get_details(client)
+
+    ## Fails fast without reaching the server
+    with pytest.raises(pydoover.circuit_open_error):
+        get_details(client)
+    assert ui_state.state.total_requests == 2
+
+
+def test_trial_request_after_reset_timeout_closes_circuit(ui_state):
+    client = make_client(ui_state, max_retries=0, circuit_failure_threshold=1, circuit_reset_timeout=0.2)
+
+    ui_state.state.fail_next(1)
+    with pytest.raises(pydoover.doover_api_error):
+        get_details(client)
+    with pytest.raises(pydoover.circuit_open_error):
+        get_details(client)
+
+    time.sleep(0.25)
+    get_details(client)
+    assert client.api_client.circuit_breaker.state == "closed"
+
+
+def test_failed_trial_request_opens_circuit_again(ui_state):
+    client = make_client(ui_state, max_retries=0, circuit_failure_threshold=1, circuit_reset_timeout=0.2)
+
+    ui_state.state.fail_next(2)
+    with pytest.raises(pydoover.doover_api_error):
+        get_details(client)
+
+    time.sleep(0.25)
+    with pytest.raises(pydoover.doover_api_error):
+        get_details(client)
+    with pytest.raises(pydoover.circuit_open_error):
+        get_details(client)
+
+
+def test_breaker_is_shared_only_between_clients_with_the_same_settings(ui_state):
+    first = make_client(ui_state, circuit_failure_threshold=3, circuit_reset_timeout=5)
+    same = make_client(ui_state, circuit_failure_threshold=3, circuit_reset_timeout=5)
+    other = make_client(ui_state, circuit_failure_threshold=10, circuit_reset_timeout=60)
+
+    assert same.api_client.circuit_breaker is first.api_client.circuit_breaker
+    assert other.api_client.circuit_breaker is not first.api_client.circuit_breaker
+    assert other.api_client.circuit_breaker.failure_threshold == 10
+    assert other.api_client.circuit_breaker.reset_timeout == 60
@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+
+## The pluggable JSON serializers in pydoover, and choosing between them
+
+import os, json
+
+import pytest
+
+import pydoover
+import ui_schema
+
+
+def load_payloads():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bench", "payloads", "sample_uplinks.jsonl")
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def make_ui_state_msg():
+    ## The shape of target.get_ui_state_msg, with non-ASCII strings and floats
+    return {
+        "state" : {
+            "displayString" : "Running – 12 km/h",
+            "statusIcon" : None,
+            "children" : {
+                "location" : {"currentValue" : {"lat" : -33.8688, "long" : 151.2093, "alt" : 42}},
+                "speed" : {"currentValue" : 12.5},
+                "sysVoltage" : {"currentValue" : 0.1 + 0.2},
+                "deviceTemp" : {"currentValue" : -4.75e-3},
+                "lastUplinkReason" : {"currentValue" : "Démarrage 🚚 起動"},
+                "ignitionOn" : {"currentValue" : True},
+            },
+        }
+    }
+
+
+def get_shapes():
+    return load_payloads() + [make_ui_state_msg(), ui_schema.build_ui_schema()]
+
+
+@pytest.fixture
+def restore_serializer():
+    serializer = pydoover.get_serializer()
+    yield
+    pydoover.set_serializer(serializer)
+
+
+def test_backends_encode_and_decode_the_same_payloads():
+    pytest.importorskip("orjson")
+    stdlib = pydoover.stdlib_serializer()
+    fast = pydoover.orjson_serializer()
+
+    for payload in get_shapes():
+        assert fast.loads(fast.dumps(payload)) == stdlib.loads(stdlib.dumps(payload)) == payload
+        ## Each backend reads what the other writes, as str and as bytes
+        assert stdlib.loads(fast.dumps(payload)) == payload
+        assert fast.loads(stdlib.dumps(payload)) == payload
+        assert fast.loads(stdlib.dumps(payload).encode()) == stdlib.loads(fast.dumps(payload).encode())
+
+
+def test_orjson_writes_non_ascii_strings_unescaped():
+    pytest.importorskip("orjson")
+    msg_str = pydoover.orjson_serializer().dumps(make_ui_state_msg())
+    assert isinstance(msg_str, str)
+    assert "Démarrage 🚚 起動" in msg_str
+
+
+def test_pydoover_json_env_forces_the_stdlib_backend(monkeypatch):
+    pytest.importorskip("orjson")
+    monkeypatch.setenv("PYDOOVER_JSON", "json")
+    assert isinstance(pydoover.get_default_serializer(), pydoover.stdlib_serializer)
+
+    monkeypatch.delenv("PYDOOVER_JSON")
+    assert isinstance(pydoover.get_default_serializer(), pydoover.orjson_serializer)
+
+
+def test_falls_back_to_stdlib_without_orjson(monkeypatch, restore_serializer):
+    monkeypatch.setattr(pydoover, "orjson", None)
+    monkeypatch.delenv("PYDOOVER_JSON", raising=False)
+    assert isinstance(pydoover.get_default_serializer(), pydoover.stdlib_serializer)
+
+    pydoover.set_serializer("orjson")
+    assert pydoover.get_serializer().name == "json"
+    assert pydoover.loads(pydoover.dumps(make_ui_state_msg())) == make_ui_state_msg()
+
+
+def test_set_serializer_by_name_and_object(restore_serializer):
+    pydoover.set_serializer("json")
+    assert pydoover.get_serializer().name == "json"
+
+    class upper_serializer(pydoover.stdlib_serializer):
+        name = "upper"
+        def dumps(self, obj):
+            return super().dumps(obj).upper()
+
+    pydoover.set_serializer(upper_serializer())
+    assert pydoover.dumps({'a' : "b"}) == '{"A": "B"}'
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+
+## task_log entry truncation, the dropped entries marker and flushing to a log channel
+
+import task_log
+from conftest import make_client
+
+
+def test_long_entry_is_truncated():
+    log = task_log.task_log(max_entry_length=10)
+    log.info("x" * 25)
+    assert log.get_text() == "x" * 10 + "... [truncated 15 chars]\n"
+
+
+def test_entry_at_max_length_is_kept_whole():
+    log = task_log.task_log(max_entry_length=10)
+    log.info("x" * 10)
+    assert log.get_text() == "x" * 10 + "\n"
+
+
+def test_first_error_is_kept_after_it_is_dropped():
+    log = task_log.task_log(max_entries=2)
+    log.error("first failure")
+    log.error("second failure")
+    log.info("done")
+    assert log.first_error == "first failure"
+    assert log.level_counts["ERROR"] == 2
+    assert "first failure" not in log.get_text()
+
+
+def test_oldest_entries_are_dropped_over_max_entries():
+    log = task_log.task_log(max_entries=3)
+    for i in range(5):
+        log.info("entry " + str(i))
+    assert log.get_text() == "... 2 earlier log entries dropped\nentry 2\nentry 3\nentry 4\n"
+
+
+def test_oldest_entries_are_dropped_over_max_total_length():
+    ## Each entry takes 8 characters with its newline
+    log = task_log.task_log(max_total_length=20)
+    for i in range(4):
+        log.info("entry " + str(i))
+    assert log.get_text() == "... 2 earlier log entries dropped\nentry 2\nentry 3\n"
+
+
+def test_newest_entry_is_kept_over_max_total_length():
+    log = task_log.task_log(max_total_length=5)
+    log.info("first")
+    log.info("a longer entry")
+    assert log.get_text() == "... 1 earlier log entries dropped\na longer entry\n"
+
+
+def test_levels_below_the_log_level_are_counted_not_kept():
+    log = task_log.task_log(level="WARNING")
+    log.info("skipped")
+    log.warning("kept")
+    assert log.get_text() == "WARNING - kept\n"
+    assert log.level_counts == {'INFO' : 1, 'WARNING' : 1}
+
+
+def get_published(stub, channel_id):
+    return [m['payload'].decode() for m in stub.state.get_channel(channel_id=channel_id)['messages']]
+
+
+def test_batches_are_flushed_to_log_channel(stub):
+    log_channel = make_client(stub).get_channel(channel_id="test-log")
+
+    log = task_log.task_log(flush_batch_size=2, flush_callback=lambda text: log_channel.publish(msg_str=text))
+    for i in range(5):
+        log.info("entry " + str(i))
+    log.flush()
+
+    assert get_published(stub, "test-log") == ["entry 0\nentry 1\n", "entry 2\nentry 3\n", "entry 4\n"]
+
+
+def test_dropped_marker_is_flushed_once(stub):
+    log_channel = make_client(stub).get_channel(channel_id="test-log")
+
+    log = task_log.task_log(max_entries=2, flush_callback=lambda text: log_channel.publish(msg_str=text))
+    for i in range(4):
+        log.info("entry " + str(i))
+    log.flush()
+    log.info("entry 4")
+    log.flush()
+
+    assert get_published(stub, "test-log") == ["... 2 earlier log entries dropped\nentry 2\nentry 3\n", "entry 4\n"]
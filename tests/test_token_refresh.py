@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+
+## Access token refresh, before expiry and after a 401, against the stub server
+
+import time, threading
+
+import pytest
+
+import pydoover
+from conftest import make_client
+
+
+class token_source:
+
+    ## Hands out a new token on each refresh, and makes it the only one the stub accepts
+
+    def __init__(self, server):
+        self.server = server
+        self.refreshes = 0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            self.refreshes += 1
+            token = "token-" + str(self.refreshes)
+        self.server.state.valid_tokens = {token}
+        return token
+
+
+@pytest.fixture
+def ui_state(stub):
+    stub.state.deploy_agent("test-agent", [{'channel_name' : "ui_state", 'channel_message' : {'value' : 1}}])
+    return stub
+
+
+def get_details(client):
+    return client.api_client.get_channel_details(agent_id="test-agent", channel_name="ui_state", include_messages=False)
+
+
+def test_401_refreshes_token_and_retries(ui_state):
+    source = token_source(ui_state)
+    ui_state.state.valid_tokens = {"token-1"}
+    client = make_client(ui_state, access_token="old-token", token_refresh_callback=source)
+
+    assert get_details(client)['aggregate']['payload'] == {'value' : 1}
+    assert source.refreshes == 1
+    assert client.access_token == "token-1"
+
+
+def test_401_without_callback_is_raised(ui_state):
+    ui_state.state.valid_tokens = {"new-token"}
+    with pytest.raises(pydoover.doover_api_error) as e:
+        get_details( make_client(ui_state, access_token="old-token") )
+    assert e.value.status_code == 401
+
+
+def test_second_401_is_raised(ui_state):
+    ## The refreshed token is rejected too, so there is only the one retry
+    client = make_client(ui_state, access_token="old-token", token_refresh_callback=lambda: "also-rejected")
+    ui_state.state.valid_tokens = {"new-token"}
+
+    ui_state.state.reset_counts()
+    with pytest.raises(pydoover.doover_api_error) as e:
+        get_details(client)
+    assert e.value.status_code == 401
+    assert ui_state.state.total_requests == 2
+
+
+def test_expiring_token_is_refreshed_before_the_request(ui_state):
+    source = token_source(ui_state)
+    ui_state.state.valid_tokens = {"token-1"}
+    client = make_client(ui_state, access_token="old-token", access_token_expiry=time.time() + 30, token_refresh_margin=60, token_refresh_callback=source)
+
+    ui_state.state.reset_counts()
+    get_details(client)
+    assert source.refreshes == 1
+    assert ui_state.state.total_requests == 1
+
+
+def test_expiry_returned_by_callback_is_used(ui_state):
+    client = make_client(ui_state, access_token="old-token", access_token_expiry=time.time() - 1, token_refresh_callback=lambda: ("new-token", time.time() + 3600))
+    get_details(client)
+    assert client.access_token == "new-token"
+    assert not client.api_client.token_expiring()
+
+
+def test_concurrent_401s_refresh_once(ui_state):
+    source = token_source(ui_state)
+    ui_state.state.valid_tokens = {"token-1"}
+    client = make_client(ui_state, access_token="old-token", token_refresh_callback=source)
+
+    errors = []
+    def worker():
+        try:
+            get_details(client)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert source.refreshes == 1
@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+
+## track_reduction thresholds and the protected points Douglas-Peucker simplifies between
+
+from types import SimpleNamespace
+
+import track_reduction
+
+
+def make_point(i, lat, long=151.0, reason=3, seconds=None):
+    seconds = i * 60 if seconds is None else seconds
+    return SimpleNamespace(
+        position={'lat' : lat, 'long' : long},
+        device_time_utc="2024-01-01 %02d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60),
+        device_uplink_reason=reason,
+    )
+
+
+def make_line(count, step=0.001):
+    ## Points about 111 m apart along a straight line of longitude, a minute apart
+    return [make_point(i, -33.0 + i * step) for i in range(count)]
+
+
+def reduce(points, **kwargs):
+    reducer = track_reduction.track_reducer(cache=track_reduction.last_point_cache(), **kwargs)
+    return reducer.reduce(points)
+
+
+def test_straight_line_simplifies_to_end_points():
+    points = make_line(10)
+    assert reduce(points, simplify_tolerance_m=10) == [points[0], points[-1]]
+
+
+def test_protected_point_on_straight_line_is_kept():
+    points = make_line(10)
+    points[4].device_uplink_reason = 44
+    assert reduce(points, simplify_tolerance_m=10) == [points[0], points[4], points[-1]]
+
+
+def test_segments_either_side_of_protected_point_are_simplified():
+    ## The line is straight up to a corner at point 6, with a protected point 3 on it
+    points = make_line(7)
+    points.append(make_point(7, points[6].position['lat'], long=151.002))
+    points.append(make_point(8, points[6].position['lat'], long=151.004))
+    points[3].device_uplink_reason = 1
+    assert reduce(points, simplify_tolerance_m=10) == [points[0], points[3], points[6], points[8]]
+
+
+def test_deviation_within_tolerance_is_removed():
+    points = make_line(3)
+    ## Move the middle point about 5.5 m sideways
+    points[1].position = {'lat' : points[1].position['lat'], 'long' : 151.00006}
+    assert reduce(points, simplify_tolerance_m=10) == [points[0], points[2]]
+
+
+def test_deviation_over_tolerance_is_kept():
+    points = make_line(3)
+    ## Move the middle point about 18 m sideways
+    points[1].position = {'lat' : points[1].position['lat'], 'long' : 151.0002}
+    assert reduce(points, simplify_tolerance_m=10) == points
+
+
+def test_points_within_min_distance_are_dropped():
+    ## About 5.5 m apart, with the newest point also within min_distance_m of the last kept
+    points = make_line(5, step=0.00005)
+    assert reduce(points, min_distance_m=25) == [points[0]]
+
+
+def test_point_at_min_distance_is_kept():
+    points = [make_point(0, -33.0), make_point(1, -33.0003), make_point(2, -33.0006)]
+    ## About 33 m apart, over a 25 m threshold
+    assert reduce(points, min_distance_m=25) == points
+
+
+def test_points_within_min_interval_are_dropped_but_newest_is_kept():
+    points = [make_point(i, -33.0 + i * 0.001, seconds=i * 10) for i in range(5)]
+    ## 10 s apart with a 30 s threshold keeps 0 and 3, and the newest point only fails the time threshold
+    assert reduce(points, min_interval_s=30) == [points[0], points[3], points[4]]
+
+
+def test_protected_point_ignores_thresholds():
+    points = make_line(4, step=0.00001)
+    points[2].device_uplink_reason = 2
+    assert reduce(points, min_distance_m=25, min_interval_s=600) == [points[0], points[2]]
+
+
+def test_thresholds_carry_over_from_last_kept_point():
+    cache = track_reduction.last_point_cache()
+    reducer = track_reduction.track_reducer(agent_id="test-agent", min_distance_m=25, cache=cache)
+
+    first = make_line(2)
+    assert reducer.reduce(first) == first
+
+    ## A later batch starting within min_distance_m of the last point kept drops it
+    second = [make_point(2, first[-1].position['lat'] + 0.00005), make_point(3, first[-1].position['lat'] + 0.001)]
+    assert reducer.reduce(second) == [second[1]]
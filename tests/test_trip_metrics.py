@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+
+## trip_metrics with resent (duplicate) and out of order records
+
+import os, json
+from types import SimpleNamespace
+
+import geo
+import pydoover
+import trip_metrics
+from conftest import fake_channel, run_target, get_published
+
+
+def make_record(minute, reason=3, ignition_on=True, speed_kmh=40, odometer=None):
+    return SimpleNamespace(
+        device_time_utc="2024-01-01 00:%02d:00" % minute,
+        device_uplink_reason=reason,
+        ignition_on=ignition_on,
+        speed_kmh=speed_kmh,
+        device_odometer=odometer,
+        position=None,
+    )
+
+
+def apply_uplink(channel, records, deduplicated=False):
+    ## One invocation - the state is read from the channel, updated and published back
+    state = trip_metrics.trip_metrics("test-agent").update(records, channel, deduplicated=deduplicated)
+    channel.publish(state)
+    return state
+
+
+def test_resent_uplink_is_not_counted_twice():
+    channel = fake_channel()
+    records = [make_record(0, reason=1), make_record(1, reason=12), make_record(2)]
+
+    first = apply_uplink(channel, records)
+    second = apply_uplink(channel, records)
+
+    assert second['totals'] == first['totals']
+    assert second['totals']['harsh_brake'] == 1
+    assert second['totals']['engine_on_s'] == 120
+
+
+def test_second_trip_start_closes_the_open_trip():
+    channel = fake_channel()
+    state = apply_uplink(channel, [make_record(0, reason=1), make_record(1, reason=12), make_record(2, reason=1), make_record(3)])
+
+    assert state['last_trip']['engine_on_s'] == 120
+    assert state['last_trip']['harsh_brake'] == 1
+    assert state['last_trip']['ended_at'] == geo.parse_timestamp("2024-01-01 00:02:00")
+    assert state['trip']['started_at'] == geo.parse_timestamp("2024-01-01 00:02:00")
+    assert state['trip']['engine_on_s'] == 60
+    assert state['totals']['engine_on_s'] == 180
+
+
+def test_record_at_last_time_is_not_a_new_interval():
+    channel = fake_channel()
+    apply_uplink(channel, [make_record(0, reason=1), make_record(1, odometer=100.0)])
+    state = apply_uplink(channel, [make_record(1, reason=13, odometer=100.5)])
+
+    assert state['totals']['engine_on_s'] == 60
+    assert state['totals']['harsh_acceleration'] == 0
+
+
+def test_resent_trip_start_does_not_reset_open_trip():
+    channel = fake_channel()
+    apply_uplink(channel, [make_record(0, reason=1), make_record(1), make_record(2, reason=12)])
+    state = apply_uplink(channel, [make_record(0, reason=1)])
+
+    assert state['trip']['engine_on_s'] == 120
+    assert state['trip']['harsh_brake'] == 1
+
+
+def test_older_record_is_ignored_without_record_index():
+    channel = fake_channel()
+    apply_uplink(channel, [make_record(0, reason=1), make_record(5)])
+    state = apply_uplink(channel, [make_record(3, reason=14, speed_kmh=90)])
+
+    assert state['totals']['harsh_cornering'] == 0
+    assert state['totals']['max_speed_kmh'] == 40
+    assert state['last']['time'] == geo.parse_timestamp("2024-01-01 00:05:00")
+
+
+def test_older_record_adds_events_only_when_deduplicated():
+    channel = fake_channel()
+    apply_uplink(channel, [make_record(0, reason=1), make_record(5)])
+    state = apply_uplink(channel, [make_record(3, reason=2, ignition_on=False, speed_kmh=90)], deduplicated=True)
+
+    ## Counted as an event, but neither an interval nor the end of the trip
+    assert state['totals']['max_speed_kmh'] == 90
+    assert state['trip']['max_speed_kmh'] == 90
+    assert state['totals']['engine_on_s'] == 300
+    assert state['trip'] is not None
+    assert state['last']['time'] == geo.parse_timestamp("2024-01-01 00:05:00")
+
+
+def test_out_of_order_records_in_one_uplink_are_sorted():
+    channel = fake_channel()
+    state = apply_uplink(channel, [make_record(2, reason=2, ignition_on=False), make_record(0, reason=1), make_record(1)])
+
+    assert state['trip'] is None
+    assert state['last_trip']['engine_on_s'] == 120
+    assert state['totals']['engine_on_s'] == 120
+
+
+def test_state_is_read_from_channel_each_invocation():
+    ## Progress published by another container is picked up rather than overwritten
+    channel = fake_channel()
+    apply_uplink(channel, [make_record(0, reason=1), make_record(1)])
+
+    other = fake_channel(channel.get_aggregate())
+    apply_uplink(other, [make_record(2, reason=12)])
+    channel.aggregate = other.get_aggregate()
+
+    state = apply_uplink(channel, [make_record(3)])
+    assert state['totals']['harsh_brake'] == 1
+    assert state['totals']['engine_on_s'] == 180
+
+
+## The trip metrics channel read, run through target.py against the stub server
+
+UPLINK = {'message_type' : "UPLINK", 'trip_metrics' : {'enabled' : True}, 'record_index' : {'enabled' : True, 'persist_interval_s' : 0}}
+
+
+def load_payload(i):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bench", "payloads", "sample_uplinks.jsonl")
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()][i]
+
+
+def remove_channel(server, channel_name):
+    with server.state.lock:
+        channel_id = server.state.channel_names.pop(("test-agent", channel_name))
+        del server.state.channels[channel_id]
+
+
+def test_missing_channel_starts_fresh_state(agent):
+    remove_channel(agent, "trip_metrics")
+    t = run_target(agent, UPLINK, load_payload(1))
+
+    state = get_published(agent, "trip_metrics")[-1]
+    assert state['last_trip']['engine_on_s'] == 420
+    assert t.get_log().level_counts.get("WARNING", 0) == 0
+
+
+def test_empty_aggregate_starts_fresh_state(agent):
+    ## The channel as deployed from doover_config.json
+    run_target(agent, UPLINK, load_payload(1))
+    assert get_published(agent, "trip_metrics")[-1]['totals']['engine_on_s'] == 420
+
+
+def test_unreadable_state_skips_metrics_but_marks_records(agent, monkeypatch):
+    def get_state(self, channel):
+        raise pydoover.doover_api_error("GET failed", status_code=503)
+    monkeypatch.setattr(trip_metrics.trip_metrics, 'get_state', get_state)
+
+    published = len(get_published(agent, "trip_metrics"))
+    t = run_target(agent, UPLINK, load_payload(1))
+
+    assert "WARNING - Could not read trip metrics, skipping them" in t.get_log_text()
+    assert len(get_published(agent, "trip_metrics")) == published
+    assert len(agent.state.get_channel(agent_id="test-agent", channel_name="ii_record_index")['aggregate']['payload']['keys']) == 7
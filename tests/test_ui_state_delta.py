@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+
+## Deadband edges of ui_state_delta.reduce
+
+import pydoover
+import target
+import ui_state_delta
+from conftest import fake_channel
+
+
+def make_msg(children, display_string="Running", status_icon=None):
+    return {
+        "state" : {
+            "displayString" : display_string,
+            "statusIcon" : status_icon,
+            "children" : {name : {"currentValue" : value} for name, value in children.items()},
+        }
+    }
+
+
+def reduce(old_children, new_children, **kwargs):
+    delta = ui_state_delta.ui_state_delta("test-agent", cache=ui_state_delta.ui_state_cache(), **kwargs)
+    return delta.reduce( make_msg(new_children), fake_channel(make_msg(old_children)) )
+
+
+def changed_children(result):
+    if result is None:
+        return None
+    return set(result['state'].get('children', {}))
+
+
+def test_change_equal_to_deadband_is_not_published():
+    assert reduce({'speed' : 50}, {'speed' : 51}) is None
+
+
+def test_change_over_deadband_is_published():
+    assert changed_children( reduce({'speed' : 50}, {'speed' : 52}) ) == {'speed'}
+
+
+def test_negative_change_over_deadband_is_published():
+    assert changed_children( reduce({'speed' : 50}, {'speed' : 48}) ) == {'speed'}
+
+
+def test_configured_deadband_overrides_default():
+    assert reduce({'speed' : 50}, {'speed' : 54}, deadbands={'speed' : 5}) is None
+    assert changed_children( reduce({'speed' : 50}, {'speed' : 56}, deadbands={'speed' : 5}) ) == {'speed'}
+
+
+def test_zero_deadband_publishes_any_change():
+    assert changed_children( reduce({'speed' : 50}, {'speed' : 50.5}, deadbands={'speed' : 0}) ) == {'speed'}
+
+
+def test_none_to_value_is_published():
+    assert changed_children( reduce({'deviceTemp' : None}, {'deviceTemp' : 20}) ) == {'deviceTemp'}
+    assert changed_children( reduce({'deviceTemp' : 20}, {'deviceTemp' : None}) ) == {'deviceTemp'}
+
+
+def test_bool_change_is_published_despite_deadband():
+    assert changed_children( reduce({'ignitionOn' : False}, {'ignitionOn' : True}, deadbands={'ignitionOn' : 1}) ) == {'ignitionOn'}
+
+
+def test_location_within_deadband_metres_is_not_published():
+    ## 0.00005 degrees of latitude is about 5.6 m, inside the default 10 m
+    old = {'lat' : -33.0, 'long' : 151.0}
+    new = {'lat' : -33.00005, 'long' : 151.0}
+    assert reduce({'location' : old}, {'location' : new}) is None
+
+
+def test_location_over_deadband_metres_is_published():
+    ## 0.0002 degrees of latitude is about 22 m
+    old = {'lat' : -33.0, 'long' : 151.0}
+    new = {'lat' : -33.0002, 'long' : 151.0}
+    assert changed_children( reduce({'location' : old}, {'location' : new}) ) == {'location'}
+
+
+def test_passive_children_alone_are_not_published():
+    old = {'speed' : 50, 'deviceTimeUtc' : "2024-01-01 00:00:00"}
+    new = {'speed' : 50.5, 'deviceTimeUtc' : "2024-01-01 00:01:00"}
+    assert reduce(old, new) is None
+
+
+def test_passive_children_are_sent_with_a_change():
+    old = {'speed' : 50, 'deviceTimeUtc' : "2024-01-01 00:00:00"}
+    new = {'speed' : 60, 'deviceTimeUtc' : "2024-01-01 00:01:00"}
+    assert changed_children( reduce(old, new) ) == {'speed', 'deviceTimeUtc'}
+
+
+def test_new_child_is_published():
+    assert changed_children( reduce({'speed' : 50}, {'speed' : 50, 'sysVoltage' : 12.0}) ) == {'sysVoltage'}
+
+
+def test_empty_aggregate_publishes_full_message():
+    delta = ui_state_delta.ui_state_delta("test-agent", cache=ui_state_delta.ui_state_cache())
+    msg = make_msg({'speed' : 50})
+    assert delta.reduce(msg, fake_channel(None)) == {'state' : {'displayString' : "Running", 'statusIcon' : None, 'children' : {'speed' : {'currentValue' : 50}}}}
+
+
+def test_deadband_is_measured_from_last_published_value():
+    cache = ui_state_delta.ui_state_cache()
+    delta = ui_state_delta.ui_state_delta("test-agent", cache=cache)
+    channel = fake_channel(make_msg({'speed' : 50}))
+
+    ## Two steps of 1 km/h, each within the deadband, add up to a change over it
+    assert delta.reduce(make_msg({'speed' : 51}), channel) is None
+    result = delta.reduce(make_msg({'speed' : 52}), channel)
+    assert changed_children(result) == {'speed'}
+
+    delta.mark_published(result)
+    assert delta.reduce(make_msg({'speed' : 53}), channel) is None
+
+
+def test_cache_expires_after_ttl(monkeypatch):
+    cache = ui_state_delta.ui_state_cache()
+    delta = ui_state_delta.ui_state_delta("test-agent", cache=cache)
+    channel = fake_channel(make_msg({'ignitionOn' : True}))
+    delta.reduce(make_msg({'ignitionOn' : True}), channel)
+
+    ## Another writer turns ignition off, which is only seen once the cache entry expires
+    channel.aggregate = make_msg({'ignitionOn' : False})
+    assert delta.reduce(make_msg({'ignitionOn' : True}), channel) is None
+
+    now = ui_state_delta.time.time()
+    monkeypatch.setattr(ui_state_delta.time, 'time', lambda: now + cache.ttl + 1)
+    assert changed_children( delta.reduce(make_msg({'ignitionOn' : True}), channel) ) == {'ignitionOn'}
+
+
+def test_unreadable_aggregate_publishes_full_message():
+    t = target.target(agent_id="test-agent", package_config={})
+    delta = ui_state_delta.ui_state_delta("test-agent", cache=ui_state_delta.ui_state_cache())
+    msg = make_msg({'speed' : 50})
+
+    channel = fake_channel(error=pydoover.doover_api_error("GET failed", status_code=503))
+    assert t.reduce_ui_state_msg(delta, msg, channel) == (msg, True)
+    assert "WARNING - Could not read ui_state aggregate" in t.get_log_text()
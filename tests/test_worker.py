@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+## The long running queue worker in worker.py, and its queues
+
+import os, json, time, zlib, signal, threading
+
+import worker
+from conftest import AGENT_ID, get_published
+
+
+def load_payloads():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bench", "payloads", "sample_uplinks.jsonl")
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def make_worker(server, source, **kwargs):
+    kwargs.setdefault('package_config', {"message_type" : "UPLINK", "ui_state_delta" : {"enabled" : False}})
+    return worker.uplink_worker(
+        source,
+        api_endpoint=server.endpoint,
+        access_token="test-token",
+        client_options={'retry_backoff' : 0},
+        **kwargs
+    )
+
+
+def test_partition_is_a_stable_hash_of_the_agent():
+    for agent_id in ["agent-a", "agent-b", "9843b273-6580-4520-bdb0-0afb7bfec049"]:
+        assert worker.get_partition(agent_id, 4) == zlib.crc32(agent_id.encode()) % 4
+
+
+def test_agent_messages_are_processed_in_order_by_one_thread(stub, monkeypatch):
+    processed = []
+    lock = threading.Lock()
+
+    def process_message(message, worker_config, doover_client):
+        time.sleep(0.001)
+        with lock:
+            processed.append((message['agent_id'], message['msg_obj']['message'], threading.current_thread().name))
+        return True, 0.0
+
+    monkeypatch.setattr(worker, "process_message", process_message)
+
+    source = worker.local_queue()
+    for i in range(40):
+        source.put( worker.make_uplink_message("agent-" + str(i % 5), {}, i) )
+
+    stats = make_worker(stub, source, concurrency=4).run(max_messages=40)
+    assert stats['processed'] == 40
+
+    for agent in ["agent-" + str(i) for i in range(5)]:
+        messages = [p for p in processed if p[0] == agent]
+        assert [m[1] for m in messages] == ["queued-" + str(i) for i in range(40) if "agent-" + str(i % 5) == agent]
+        assert len(set(m[2] for m in messages)) == 1
+
+
+def test_thread_mode_processes_uplinks(agent):
+    source = worker.local_queue()
+    payloads = load_payloads()
+    for i, payload in enumerate(payloads):
+        source.put( worker.make_uplink_message(AGENT_ID, payload, i) )
+
+    stats = make_worker(agent, source, concurrency=2).run(max_messages=len(payloads))
+
+    assert (stats['processed'], stats['errors']) == (len(payloads), 0)
+    assert source.failed == []
+    ## The deployed message, and one per uplink record
+    assert len(get_published(agent, "ui_state")) == 1 + sum(len(p['Records']) for p in payloads)
+
+
+def test_failed_messages_are_nacked_and_can_be_requeued(stub, monkeypatch):
+    def process_message(message, worker_config, doover_client):
+        return message['msg_obj']['message'] != "queued-1", 0.0
+
+    monkeypatch.setattr(worker, "process_message", process_message)
+
+    source = worker.local_queue()
+    for i in range(3):
+        source.put( worker.make_uplink_message("agent-a", {}, i) )
+
+    stats = make_worker(stub, source, concurrency=2).run(max_messages=3)
+
+    assert stats['errors'] == 1
+    assert [m['msg_obj']['message'] for m in source.failed] == ["queued-1"]
+    assert source.requeue_failed() == 1
+    assert source.get(timeout=0)[1]['msg_obj']['message'] == "queued-1"
+
+
+def test_file_queue_ack_nack_and_requeue(tmp_path):
+    source = worker.file_queue(str(tmp_path))
+    for i in range(3):
+        source.put({'i' : i})
+    assert len(source) == 3
+
+    receipts = []
+    for i in range(3):
+        receipt, message = source.get(timeout=0)
+        assert message == {'i' : i}
+        receipts.append(receipt)
+    assert source.get(timeout=0) is None
+
+    source.ack(receipts[0])
+    source.nack(receipts[1])
+    assert os.listdir(source.failed_dir) == [os.path.basename(receipts[1])]
+
+    ## receipts[2] was claimed by a worker that never finished it
+    assert worker.file_queue(str(tmp_path)).recover() == 1
+    assert source.requeue_failed() == 1
+    assert sorted(source.get(timeout=0)[1]['i'] for i in range(2)) == [1, 2]
+
+
+def test_dead_worker_process_is_replaced_and_its_message_nacked(agent, tmp_path):
+    ## The first message is still being processed when its worker is killed
+    agent.state.latency_ms = 200
+    source = worker.file_queue(str(tmp_path))
+    payloads = load_payloads()
+    source.put( worker.make_uplink_message(AGENT_ID, payloads[0], 0) )
+
+    w = make_worker(agent, source, concurrency=1, use_processes=True)
+    result = {}
+    runner = threading.Thread(target=lambda: result.update(w.run(max_messages=2, poll_interval=0.05)))
+    runner.start()
+    try:
+        deadline = time.time() + 30
+        while w.in_flight == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        os.kill(w.workers[0].pid, signal.SIGKILL)
+
+        while w.stats['worker_restarts'] == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        source.put( worker.make_uplink_message(AGENT_ID, payloads[1], 1) )
+    finally:
+        runner.join(60)
+
+    assert not runner.is_alive()
+    assert (result['worker_restarts'], result['processed'], result['errors']) == (1, 2, 1)
+
+    ## The lost message is kept to be retried, and the replacement processed the second
+    failed = [json.load(open(os.path.join(source.failed_dir, name))) for name in os.listdir(source.failed_dir)]
+    assert [m['msg_obj']['message'] for m in failed] == ["queued-0"]
+    assert len(source) == 0 and os.listdir(source.processing_dir) == []